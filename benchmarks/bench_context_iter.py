@@ -0,0 +1,87 @@
+"""
+Benchmark TreeNode.context_iter against the copying traversal it replaced.
+
+Reports wall time per full pass over the tree, and the memory allocated while
+keeping every context of a pass alive (as a ContextIndex does).
+
+Usage:
+    python -m benchmarks.bench_context_iter --sessions 200 --acquisitions 20
+"""
+import argparse
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+from flywheel_bids.supporting_files import utils
+from flywheel_bids.supporting_files.project_tree import get_project_tree
+
+from tests.fake_client import FakeFlywheel, make_project
+
+
+def copying_context_iter(node, context=None):
+    """The recursive traversal that copied the context for every child"""
+    if not context:
+        context = {'parent_container_type': None}
+    context['container_type'] = node.type
+    context[node.type] = node
+    if node.type == 'session':
+        context['subject'] = node.data['subject']
+    if node.type == 'file':
+        context['ext'] = utils.get_extension(node.data['name'])
+    yield context
+    context['parent_container_type'] = node.type
+    for child in node.children:
+        for ctx in copying_context_iter(child, context.copy()):
+            yield ctx
+
+
+def layered_context_iter(node):
+    return node.context_iter()
+
+
+def run_pass(iter_fn, tree):
+    """Visit every context, looking up values like the curation passes do"""
+    count = 0
+    for context in iter_fn(tree):
+        container = context[context['container_type']]
+        utils.dict_lookup(context, 'session.label')
+        count += container is not None
+    return count
+
+
+def measure_memory(iter_fn, tree):
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    contexts = list(iter_fn(tree))
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del contexts
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark context iteration')
+    parser.add_argument('--sessions', type=int, default=200)
+    parser.add_argument('--acquisitions', type=int, default=20)
+    parser.add_argument('--passes', type=int, default=3)
+    args = parser.parse_args()
+
+    tree = get_project_tree(FakeFlywheel(make_project(args.sessions, args.acquisitions)), 'project')
+
+    for name, iter_fn in (('copying', copying_context_iter), ('layered', layered_context_iter)):
+        start = time.time()
+        for _ in range(args.passes):
+            count = run_pass(iter_fn, tree)
+        elapsed = (time.time() - start) / args.passes
+        peak = measure_memory(iter_fn, tree)
+        print('{:<8s} contexts={:<7d} time/pass={:.3f}s retained={}'.format(name, count, elapsed,
+            '{:.1f}MB'.format(peak / 1e6) if peak is not None else 'n/a'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Benchmark concurrent project tree fetching against the fake Flywheel client.
+
+Usage:
+    python -m benchmarks.bench_project_tree --sessions 50 --acquisitions 15 --latency 0.01
+"""
+import argparse
+import json
+import time
+
+from flywheel_bids.supporting_files.project_tree import get_project_tree
+
+from tests.fake_client import FakeFlywheel, make_project
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark project tree fetching')
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--acquisitions', type=int, default=15)
+    parser.add_argument('--latency', type=float, default=0.01, help='Seconds per simulated request')
+    parser.add_argument('--workers', type=int, action='append', help='Worker counts to compare')
+    args = parser.parse_args()
+
+    project = make_project(args.sessions, args.acquisitions)
+    baseline = None
+    for workers in (args.workers or [1, 4, 16]):
+        fw = FakeFlywheel(project, latency=args.latency)
+        start = time.time()
+        tree = get_project_tree(fw, 'project', workers=workers)
+        elapsed = time.time() - start
+
+        result = json.dumps(tree.to_json(), sort_keys=True)
+        if baseline is None:
+            baseline = result
+        elif result != baseline:
+            raise RuntimeError('Tree fetched with {} workers differs!'.format(workers))
+
+        print('workers={:<4d} calls={:<6d} time={:.3f}s'.format(workers, sum(fw.calls.values()), elapsed))
+
+
+if __name__ == '__main__':
+    main()
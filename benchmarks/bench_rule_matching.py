@@ -0,0 +1,79 @@
+"""
+Benchmark template rule matching, interpreting where clauses vs compiled rules.
+
+Usage:
+    python -m benchmarks.bench_rule_matching --contexts 20000
+"""
+import argparse
+import time
+
+from flywheel_bids.supporting_files import templates
+
+
+def make_contexts(n):
+    """Build file contexts that exercise a mix of bids-v1 rules"""
+    kinds = [
+        ('nifti', ['Anatomy', 'T1'], 'T1w'),
+        ('nifti', ['Functional'], 'task-rest_bold'),
+        ('nifti', ['Diffusion'], 'dwi'),
+        ('dicom', ['Anatomy', 'T2'], 'T2w'),
+        ('bval', ['Diffusion'], 'dwi'),
+        ('nifti', ['Fieldmap'], 'fmap_phasediff'),
+    ]
+    contexts = []
+    for i in range(n):
+        file_type, measurement, label = kinds[i % len(kinds)]
+        contexts.append({
+            'container_type': 'file',
+            'parent_container_type': 'acquisition',
+            'project': {'label': 'bench', 'info': {}},
+            'session': {'label': 'ses{}'.format(i), 'info': {}},
+            'acquisition': {'label': label, 'info': {}},
+            'file': {'name': 'file{}.nii.gz'.format(i), 'type': file_type, 'info': {},
+                     'classification': {'Measurement': measurement, 'Intent': []},
+                     'measurements': measurement}
+        })
+    return contexts
+
+
+def legacy_test(rule, context):
+    """The interpretive where clause evaluation, before rules were compiled"""
+    return templates.match_conditions(rule.conditions, context)
+
+
+def legacy_match(template, context):
+    for rule in template.rules:
+        if legacy_test(rule, context):
+            return rule
+    return None
+
+
+def compiled_match(template, context):
+    for rule in template.get_candidate_rules(context):
+        if rule.test(context):
+            return rule
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark template rule matching')
+    parser.add_argument('--contexts', type=int, default=20000)
+    args = parser.parse_args()
+
+    template = templates.DEFAULT_TEMPLATES['bids-v1']
+    contexts = make_contexts(args.contexts)
+
+    results = {}
+    for name, match in (('legacy', legacy_match), ('compiled', compiled_match)):
+        start = time.time()
+        results[name] = [match(template, context) for context in contexts]
+        elapsed = time.time() - start
+        print('{:<10s} time={:.3f}s per_context={:.1f}us'.format(name, elapsed,
+            1e6 * elapsed / len(contexts)))
+
+    if [r and r.id for r in results['legacy']] != [r and r.id for r in results['compiled']]:
+        raise RuntimeError('Compiled rules matched differently!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark compiled string templates against the substitution loop they replaced.
+
+Formats every string template of bids-v1.json (auto_update values and
+resolver formats) for the file contexts of a curated project.
+
+Usage:
+    python -m benchmarks.bench_string_template --sessions 20 --acquisitions 10 --repeat 5
+"""
+import argparse
+import json
+import os
+import re
+import time
+
+import six
+
+from flywheel_bids import curate_bids
+from flywheel_bids.supporting_files import templates, utils
+from flywheel_bids.supporting_files.project_tree import get_project_tree
+
+from tests.fake_client import FakeFlywheel, make_project
+
+
+def legacy_process_string_template(template, context):
+    """process_string_template, before templates were compiled"""
+    tokens = re.compile('[^\\[][A-Za-z0-9\\.><}{-]+|\\[[/A-Za-z0-9><}{_\\.-]+\\]')
+    values = re.compile('[{<][A-Za-z0-9\\.-]+[>}]')
+
+    for token in tokens.findall(template):
+        if values.search(token):
+            replace_tokens = values.findall(token)
+            for replace_token in replace_tokens:
+                path = replace_token[1:-1]
+                keys = path.split(".")
+                result = context
+                for key in keys:
+                    if key in result:
+                        result = result[key]
+                    else:
+                        result = None
+                        break
+                if result:
+                    if replace_token[0] == '<':
+                        if re.match('(sub|ses)-[a-zA-Z0-9]+', result):
+                            label, result = result.split('-')
+                        else:
+                            result = ''.join(x for x in result.replace('_', ' ').replace('-', ' ') if x.isalnum())
+                    template = template.replace(replace_token, str(result))
+                elif token[0] == '[':
+                    template = template.replace(token, '')
+
+    return re.sub('\\[|\\]', '', template)
+
+
+def get_string_templates(path=None):
+    """Collect the string templates of a template file"""
+    if path is None:
+        path = os.path.join(os.path.dirname(templates.__file__), '..', 'templates', 'bids-v1.json')
+    with open(path) as f:
+        data = json.load(f)
+
+    results = set()
+    def collect(obj):
+        if isinstance(obj, dict):
+            auto_update = obj.get('auto_update')
+            if isinstance(auto_update, dict):
+                auto_update = auto_update.get('$value')
+            if isinstance(auto_update, six.string_types) and auto_update:
+                results.add(auto_update)
+            for value in obj.values():
+                collect(value)
+        elif isinstance(obj, list):
+            for value in obj:
+                collect(value)
+    collect(data)
+
+    for resolver in data.get('resolvers', []):
+        if resolver.get('format'):
+            results.add(resolver['format'])
+    return sorted(results)
+
+
+def get_file_contexts(n_sessions, n_acquisitions):
+    """Curate a fake project, returning the contexts of its files"""
+    project = get_project_tree(FakeFlywheel(make_project(n_sessions, n_acquisitions)), 'project')
+    curate_bids.curate_bids_tree(None, project, update=False)
+    return [context for context in project.context_iter() if context['container_type'] == 'file']
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark string template processing')
+    parser.add_argument('--sessions', type=int, default=20)
+    parser.add_argument('--acquisitions', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    string_templates = get_string_templates()
+    contexts = get_file_contexts(args.sessions, args.acquisitions)
+    count = len(string_templates) * len(contexts) * args.repeat
+
+    results = {}
+    for name, process in (('legacy', legacy_process_string_template), ('compiled', utils.process_string_template)):
+        start = time.time()
+        for _ in range(args.repeat):
+            results[name] = [process(template, context) for context in contexts for template in string_templates]
+        elapsed = time.time() - start
+        print('{:<10s} time={:.3f}s per_template={:.2f}us'.format(name, elapsed, 1e6 * elapsed / count))
+
+    if results['legacy'] != results['compiled']:
+        raise RuntimeError('Compiled templates formatted differently!')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Repeatable benchmarks of curation, export and upload at several project scales.
+
+Every benchmark runs against a synthetic project served by the fake Flywheel
+client, and reports the best wall and CPU time of --repeat runs, along with
+the number of API calls that a run makes. Results are compared with the
+saved baselines of the running python version: a benchmark regresses if it
+makes more API calls, or if its CPU time grows by more than --tolerance.
+
+Usage:
+    python -m benchmarks.bench_suite --scale small --scale medium
+    python -m benchmarks.bench_suite --benchmark curate --scale large --latency 0.005
+    python -m benchmarks.bench_suite --save-baseline
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from flywheel_bids import curate_bids, export_bids, upload_bids
+from flywheel_bids.supporting_files import profiling
+
+from tests.fake_client import FakeFlywheel
+from tests.synthetic import make_synthetic_project
+
+# The (sessions, acquisitions) of each project scale
+SCALES = collections.OrderedDict([
+    ('small', (4, 8)),
+    ('medium', (20, 12)),
+    ('large', (100, 16)),
+])
+
+# CPU time is measured in clock ticks, smaller changes are noise
+MIN_CPU_REGRESSION = 0.05
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+
+# The label of the uploaded project, which is also the name of its directory
+UPLOAD_PROJECT_LABEL = 'synthetic'
+
+def setup_curate(project, workdir, latency=0.0, workers=1):
+    """Curate the project"""
+    fw = FakeFlywheel(project, latency=latency)
+    def run():
+        curate_bids.curate_bids_dir(fw, 'project', workers=workers)
+    return fw, run
+
+def setup_export(project, workdir, latency=0.0, workers=1):
+    """Export the curated project"""
+    fw = FakeFlywheel(project, latency=latency)
+    curate_bids.curate_bids_dir(fw, 'project')
+    outdir = os.path.join(workdir, UPLOAD_PROJECT_LABEL)
+    os.makedirs(outdir)
+    def run():
+        export_bids.download_bids_dir(fw, 'project', 'project', outdir, workers=workers)
+    return fw, run
+
+def setup_upload(project, workdir, latency=0.0, workers=1):
+    """Upload the export of the curated project to a new project"""
+    export_fw, export = setup_export(project, workdir)
+    export()
+    fw = FakeFlywheel({'id': 'existing', 'label': 'existing', 'group': 'group', 'info': {}, 'files': []},
+            latency=latency)
+    bids_dir = os.path.join(workdir, UPLOAD_PROJECT_LABEL)
+    def run():
+        upload_bids.upload_bids(fw, bids_dir, 'group', project_label=UPLOAD_PROJECT_LABEL, validate=False,
+                assume_yes=True, workers=workers)
+    return fw, run
+
+BENCHMARKS = collections.OrderedDict([
+    ('curate', setup_curate),
+    ('export', setup_export),
+    ('upload', setup_upload),
+])
+
+class quiet(object):
+    """Silence the progress output of the tools while benchmarking"""
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        logging.disable(logging.CRITICAL)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        logging.disable(logging.NOTSET)
+        return False
+
+def run_benchmark(name, scale, repeat=3, latency=0.0, workers=1):
+    """
+    Run a benchmark repeat times, each time on a fresh fake client.
+
+    Args:
+        name (str): The benchmark, a key of BENCHMARKS
+        scale (str): The project scale, a key of SCALES
+        repeat (int): The number of runs
+        latency (float): The simulated latency of each API call, in seconds
+        workers (int): The number of concurrent requests the tools make
+
+    Returns:
+        dict: The best 'wall_time' and 'cpu_time' of the runs, and the 'api_calls' of a run
+    """
+    n_sessions, n_acquisitions = SCALES[scale]
+    project = make_synthetic_project(n_sessions, n_acquisitions)
+
+    result = None
+    for _ in range(repeat):
+        workdir = tempfile.mkdtemp(prefix='bids-bench-')
+        try:
+            with quiet():
+                fw, run = BENCHMARKS[name](project, workdir, latency=latency, workers=workers)
+                fw.calls.clear()
+                start, start_cpu = time.time(), profiling.get_cpu_time()
+                run()
+                wall_time, cpu_time = time.time() - start, profiling.get_cpu_time() - start_cpu
+        finally:
+            shutil.rmtree(workdir)
+
+        api_calls = sum(fw.calls.values())
+        if result is None:
+            result = {'wall_time': wall_time, 'cpu_time': cpu_time, 'api_calls': api_calls}
+        else:
+            result['wall_time'] = min(result['wall_time'], wall_time)
+            result['cpu_time'] = min(result['cpu_time'], cpu_time)
+            result['api_calls'] = max(result['api_calls'], api_calls)
+    return result
+
+def get_python_version():
+    return '{}.{}'.format(*sys.version_info[:2])
+
+def load_baselines(path=BASELINE_PATH):
+    """Load the saved baselines, by python version and benchmark/scale"""
+    if not os.path.isfile(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_baselines(baselines, path=BASELINE_PATH):
+    with open(path, 'w') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+
+def compare_to_baseline(result, baseline, tolerance=0.5):
+    """
+    Compare the result of a benchmark with its baseline.
+
+    API call counts are deterministic, so any increase is a regression. CPU
+    time varies between runs and machines, so it regresses only when it grows
+    by more than tolerance (and by more than MIN_CPU_REGRESSION seconds).
+
+    Args:
+        result (dict): The result of run_benchmark
+        baseline (dict): The saved result, or None
+        tolerance (float): The allowed relative growth of CPU time
+
+    Returns:
+        list: The descriptions of the regressions, empty if there are none
+    """
+    if not baseline:
+        return []
+    regressions = []
+    if result['api_calls'] > baseline['api_calls']:
+        regressions.append('api_calls {} > {}'.format(result['api_calls'], baseline['api_calls']))
+    cpu_growth = result['cpu_time'] - baseline['cpu_time']
+    if cpu_growth > baseline['cpu_time'] * tolerance and cpu_growth > MIN_CPU_REGRESSION:
+        regressions.append('cpu_time {:.3f}s > {:.3f}s (+{:.0%})'.format(result['cpu_time'],
+            baseline['cpu_time'], result['cpu_time'] / baseline['cpu_time'] - 1))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark curation, export and upload')
+    parser.add_argument('--benchmark', action='append', choices=list(BENCHMARKS),
+            help='Benchmarks to run, default is all of them')
+    parser.add_argument('--scale', action='append', choices=list(SCALES),
+            help='Project scales to run at, default is small and medium')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds per simulated request')
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--tolerance', type=float, default=0.5, help='Allowed relative growth of CPU time')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='The baselines file')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baselines')
+    args = parser.parse_args()
+
+    # Timings with simulated latency or concurrency are not comparable to the baselines
+    compare = not args.latency and args.workers == 1
+    baselines = load_baselines(args.baseline)
+    version_baselines = baselines.setdefault(get_python_version(), {})
+
+    regressed = False
+    for name in args.benchmark or list(BENCHMARKS):
+        for scale in args.scale or ['small', 'medium']:
+            key = '{}/{}'.format(name, scale)
+            result = run_benchmark(name, scale, repeat=args.repeat, latency=args.latency, workers=args.workers)
+            regressions = compare_to_baseline(result, version_baselines.get(key), args.tolerance) if compare else []
+            print('{:<16s} wall={:.3f}s cpu={:.3f}s calls={:<6d} {}'.format(key, result['wall_time'],
+                result['cpu_time'], result['api_calls'], 'REGRESSED: ' + ', '.join(regressions) if regressions else ''))
+            regressed = regressed or bool(regressions)
+            if args.save_baseline and compare:
+                version_baselines[key] = dict(result, wall_time=round(result['wall_time'], 4),
+                        cpu_time=round(result['cpu_time'], 4))
+
+    if args.save_baseline:
+        if compare:
+            save_baselines(baselines, args.baseline)
+        else:
+            print('Not saving baselines measured with latency or workers')
+    if regressed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
 import argparse
+import hashlib
 import logging
 import json
+import multiprocessing
 import os
 import tempfile
 import sys
@@ -8,11 +10,19 @@ import re
 
 import flywheel
 
-from .supporting_files import bidsify_flywheel, utils, templates
-from .supporting_files.project_tree import get_project_tree
+from .supporting_files import bidsify_flywheel, cassette, profiling, resolver, utils, templates, write_back
+from .supporting_files.errors import BIDSCurationError
+from .supporting_files import project_tree
+from .supporting_files.project_tree import TreeNode, get_project_tree
 
 PROJECT_TEMPLATE_FILE_NAME_REGEX = re.compile('^([a-z0-9]+\-)*project-template\.json$')
 
+# The key of the curation fingerprint in a session's namespace info
+FINGERPRINT_KEY = 'fingerprint'
+# Node fields, at any depth outside of info, that change without curation inputs
+# changing (e.g. when curation writes info back)
+FINGERPRINT_IGNORED_FIELDS = ('modified', 'info_exists')
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('curate-bids')
 
@@ -83,45 +93,14 @@ def update_meta_info(fw, context):
     """ Update file information
 
     """
-    # Modify file
-    if context['container_type'] == 'file':
-        # Modify acquisition file
-        if context['parent_container_type'] == 'acquisition':
-            fw.set_acquisition_file_info(
-                    context['acquisition']['id'],
-                    context['file']['name'],
-                    context['file']['info']
-                    )
-        # Modify project file
-        elif context['parent_container_type'] == 'project':
-            fw.set_project_file_info(
-                    context['project']['id'],
-                    context['file']['name'],
-                    context['file']['info']
-                    )
-        # Modify session file
-        elif context['parent_container_type'] == 'session':
-            fw.set_session_file_info(
-                    context['session']['id'],
-                    context['file']['name'],
-                    context['file']['info']
-                    )
-        else:
-            logger.info('Cannot determine file parent container type: ' + context['parent_container_type'])
-    # Modify project
-    elif context['container_type'] == 'project':
-        fw.replace_project_info(context['project']['id'], context['project']['info'])
-    # Modify session
-    elif context['container_type'] == 'session':
-        fw.replace_session_info(context['session']['id'], context['session']['info'])
-    # Modify acquisition
-    elif context['container_type'] == 'acquisition':
-        fw.replace_acquisition_info(context['acquisition']['id'], context['acquisition']['info'])
-    # Cannot determine container type
-    else:
-        logger.info('Cannot determine container type: ' + context['container_type'])
-
-def curate_bids_dir(fw, project_id, session_id=None, reset=False, template_file=None, session_only=False):
+    target = write_back.get_update_target(context)
+    if target:
+        container_type, container_id, file_name = target
+        info = context[context['container_type']]['info']
+        write_back.write_info(fw, container_type, container_id, file_name, info)
+
+def curate_bids_dir(fw, project_id, session_id=None, reset=False, template_file=None, session_only=False, workers=1,
+        cache_dir=None, processes=1, stream=False, stream_window=2, incremental=False):
     """
 
     fw: Flywheel client
@@ -130,12 +109,107 @@ def curate_bids_dir(fw, project_id, session_id=None, reset=False, template_file=
     reset: Whether or not to reset bids info before curation
     template_file: The template file to use
     session_only: If true, then only curate the provided session
+    workers: The number of concurrent requests to make to Flywheel
+    cache_dir: Optional directory to keep project snapshots and compiled templates in, to only fetch what changed
+    processes: The number of processes to curate sessions in
+    stream: If true, then fetch, curate and update one session at a time
+    stream_window: The number of sessions to fetch ahead while streaming
+    incremental: If true, then skip sessions that have not changed since they were last curated
+
+    """
+    if stream:
+        curate_bids_stream(fw, project_id, session_id=session_id, reset=reset, template_file=template_file,
+                session_only=session_only, workers=workers, window=stream_window, incremental=incremental,
+                cache_dir=cache_dir)
+        return
+
+    with profiling.phase('tree_load'):
+        project = get_project_tree(fw, project_id, session_id=session_id, session_only=session_only,
+                workers=workers, cache_dir=cache_dir)
+    curate_bids_tree(fw, project, reset, template_file, True, workers=workers, processes=processes,
+            incremental=incremental, cache_dir=cache_dir)
+
+def curate_bids_stream(fw, project_id, session_id=None, reset=False, template_file=None, session_only=False,
+        workers=1, window=2, incremental=False, cache_dir=None):
+    """
+    Curate a project one session at a time, so that memory use does not grow with the project.
+
+    The project is curated and updated first. Then each session is fetched,
+    curated, resolved and updated before it is released, while the next
+    window sessions are fetched in the background. The result is the same as
+    curating the whole project tree, which is done instead if the template has
+    resolvers that are not resolved within a session.
+
+    Args:
+        fw: Flywheel client
+        project_id (str): The project id of project to curate
+        session_id (str): The optional session id to curate
+        reset (bool): Whether or not to reset bids info before curation
+        template_file (str): The template file to use
+        session_only (bool): If true, then only curate the provided session
+        workers (int): The number of concurrent requests to make when updating
+        window (int): The number of sessions to fetch ahead
+        incremental (bool): If true, then skip sessions that have not changed since they were last curated
+        cache_dir (str): The optional directory to cache compiled templates in
+    """
+    if session_only and not session_id:
+        logger.error('Session only was specified, but no session id was given!')
+        sys.exit(1)
+    elif not session_only:
+        session_id = None
+
+    with profiling.phase('tree_load'):
+        project = project_tree.get_project_node(fw, project_id)
+    template, template_file = get_template(fw, project, template_file, cache_dir)
+
+    if not is_session_sharded(template):
+        logger.info('Template has resolvers that are not resolved for sessions, curating the whole project')
+        with profiling.phase('tree_load'):
+            project = get_project_tree(fw, project_id, session_id=session_id, session_only=session_only,
+                    workers=workers)
+        curate_bids_tree(fw, project, reset, template_file, True, workers=workers, incremental=incremental,
+                cache_dir=cache_dir)
+        return
+
+    template_key = get_template_key(template) if incremental and not reset else None
+
+    queue = write_back.WriteBackQueue(fw, workers=workers)
+    curate_contexts(project.context_iter(), template, reset)
+    resolve_contexts(project.context_iter(), template)
+    for context in project.context_iter():
+        queue.add(context)
+    failed = queue.flush()['failed']
 
+    skipped = 0
+    for session in project_tree.iter_session_nodes(fw, project_id, session_id=session_id, window=window):
+        if template_key and is_session_unchanged(project, session, template_key, template.namespace):
+            skipped += 1
+            continue
+        curate_session(project.data, session, template, reset)
+        if incremental:
+            store_session_fingerprint(project, session, get_template_key(template), template.namespace)
+        for context in get_session_contexts(project.data, session):
+            queue.add(context)
+        failed += queue.flush()['failed']
+
+    if skipped:
+        logger.info('Skipped {} sessions that have not changed since they were last curated'.format(skipped))
+    if failed:
+        raise BIDSCurationError('Failed to update {} containers/files'.format(failed))
+
+def get_template(fw, project, template_file=None, cache_dir=None):
     """
-    project = get_project_tree(fw, project_id, session_id=session_id, session_only=session_only)
-    curate_bids_tree(fw, project, reset, template_file, True)
+    Load the template to curate project with.
 
-def curate_bids_tree(fw, project, reset=False, template_file=None, update=True):
+    Args:
+        fw: Flywheel client
+        project (TreeNode): The project node
+        template_file (str): The template file to use, if not the project template
+        cache_dir (str): The optional directory to cache compiled templates in, under 'templates'
+
+    Returns:
+        tuple: The Template, and the file it was loaded from (None for the default template)
+    """
     # Get project
     project_files = project.get('files', [])
 
@@ -156,7 +230,19 @@ def curate_bids_tree(fw, project, reset=False, template_file=None, update=True):
                 break
 
     if template_file:
-        template = templates.loadTemplate(template_file)
+        template = templates.loadTemplate(template_file, cache_dir=get_template_cache_dir(cache_dir))
+
+    return template, template_file
+
+def get_template_cache_dir(cache_dir):
+    """Get the directory to cache compiled templates in, under cache_dir"""
+    if not cache_dir:
+        return None
+    return os.path.join(cache_dir, 'templates')
+
+def curate_bids_tree(fw, project, reset=False, template_file=None, update=True, workers=1, processes=1,
+        incremental=False, cache_dir=None):
+    template, template_file = get_template(fw, project, template_file, cache_dir)
 
     ##
     # Curation is now a 3-pass process
@@ -165,55 +251,392 @@ def curate_bids_tree(fw, project, reset=False, template_file=None, update=True):
     # 3. Send updates to server
     ##
 
-    # 1. Do initial template matching and updating
-    for context in project.context_iter():
-        ctype = context['container_type']
-        parent_ctype = context['parent_container_type']
+    # Only curate the sessions that changed since they were last curated
+    curated = project
+    if incremental and not reset:
+        curated = get_changed_tree(project, template)
+
+    sessions = [child for child in curated.children if child.type == 'session']
+    if processes > 1 and len(sessions) > 1 and not is_session_sharded(template):
+        logger.info('Template has resolvers that are not resolved for sessions, curating in a single process')
+        processes = 1
+
+    if processes > 1 and len(sessions) > 1:
+        # Curate project-level nodes here, and each session in a worker process
+        project_level = TreeNode('project', project.data)
+        project_level.children = [child for child in curated.children if child.type != 'session']
+        curate_contexts(project_level.context_iter(), template, reset)
+
+        logger.info('Curating {} sessions in {} processes'.format(len(sessions), processes))
+        with profiling.phase('match'):
+            pool = multiprocessing.Pool(processes, _init_session_worker,
+                    (template_file, project.data, reset, get_template_cache_dir(cache_dir)))
+            try:
+                results = pool.imap(_curate_session_worker, (to_worker_json(session) for session in sessions))
+                for session, result in zip(sessions, results):
+                    update_tree(session, result)
+            finally:
+                pool.terminate()
+                pool.join()
+
+        resolve_contexts(project_level.context_iter(), template)
+    else:
+        # 1. Do initial template matching and updating
+        curate_contexts(curated.context_iter(), template, reset)
 
-        if reset:
-            clear_meta_info(context[ctype], template)
+        # 2. Perform any path resolutions
+        resolve_contexts(curated.context_iter(), template)
 
-        elif context[ctype].get('info',{}).get('BIDS') == 'NA':
-            continue
+    if incremental:
+        template_key = get_template_key(template)
+        for session in sessions:
+            store_session_fingerprint(project, session, template_key, template.namespace)
 
-        if ctype == 'project':
-            bidsify_flywheel.process_matching_templates(context, template)
-            # Validate meta information
-            # TODO: Improve the validator to understand what is valid for dataset_description file...
-            # validate_meta_info(context['project'])
+    # 3. Send updates to server
+    if update:
+        queue = write_back.WriteBackQueue(fw, workers=workers)
+        for context in curated.context_iter():
+            queue.add(context)
+
+        summary = queue.flush()
+        if summary['failed']:
+            raise BIDSCurationError('Failed to update {} containers/files'.format(summary['failed']))
 
-        elif ctype == 'session':
-            bidsify_flywheel.process_matching_templates(context, template)
+def curate_contexts(contexts, template, reset=False):
+    """
+    Do initial template matching and updating of contexts, in traversal order.
 
-            # Add run_counter
-            context['run_counters'] = utils.RunCounterMap()
+    Args:
+        contexts (iterable): The contexts to curate, as produced by context_iter
+        template (Template): The template
+        reset (bool): Whether or not to reset bids info before curation
+    """
+    with profiling.phase('match'):
+        for context in contexts:
+            ctype = context['container_type']
+            parent_ctype = context['parent_container_type']
 
-        elif ctype == 'acquisition':
-            bidsify_flywheel.process_matching_templates(context, template)
+            if reset:
+                clear_meta_info(context[ctype], template)
 
-        elif ctype == 'file':
-            if parent_ctype == 'project' and PROJECT_TEMPLATE_FILE_NAME_REGEX.search(context['file']['name']):
-                # Don't BIDSIFY project template
+            elif context[ctype].get('info',{}).get('BIDS') == 'NA':
                 continue
 
-            # Process matching
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template)
-            # Validate meta information
-            validate_meta_info(context['file'], template)
+            if ctype == 'project':
+                bidsify_flywheel.process_matching_templates(context, template)
+                # Validate meta information
+                # TODO: Improve the validator to understand what is valid for dataset_description file...
+                # validate_meta_info(context['project'])
 
-    # 2. Perform any path resolutions
-    session = None
-    for context in project.context_iter():
-        # Resolution
-        bidsify_flywheel.process_resolvers(context, template)
+            elif ctype == 'session':
+                bidsify_flywheel.process_matching_templates(context, template)
 
-    # 3. Send updates to server
-    if update:
-        for context in project.context_iter():
-            ctype = context['container_type']
-            node = context[ctype]
-            if node.is_dirty():
-                update_meta_info(fw, context)
+                # Add run_counter
+                context['run_counters'] = utils.RunCounterMap()
+
+            elif ctype == 'acquisition':
+                bidsify_flywheel.process_matching_templates(context, template)
+
+            elif ctype == 'file':
+                if parent_ctype == 'project' and PROJECT_TEMPLATE_FILE_NAME_REGEX.search(context['file']['name']):
+                    # Don't BIDSIFY project template
+                    continue
+
+                # Process matching
+                context['file'] = bidsify_flywheel.process_matching_templates(context, template)
+                # Validate meta information
+                with profiling.phase('validate'):
+                    validate_meta_info(context['file'], template)
+
+def resolve_contexts(contexts, template):
+    """
+    Perform path resolutions for contexts, once every context has been curated.
+
+    Args:
+        contexts (iterable): The contexts to resolve, as produced by context_iter
+        template (Template): The template
+    """
+    # Index each session once, rather than scanning it for every resolved file
+    index_cache = resolver.IndexCache()
+    with profiling.phase('resolve'):
+        for context in contexts:
+            # Resolution
+            bidsify_flywheel.process_resolvers(context, template, index_cache)
+
+def is_session_sharded(template):
+    """
+    Check if sessions can be curated independently of each other with template.
+
+    Run counters are kept per session, so this is the case when every resolver
+    of the template only resolves within a session.
+
+    Args:
+        template (Template): The template
+
+    Returns:
+        bool: True if sessions can be curated in separate processes
+    """
+    for resolvers in template.resolver_map.values():
+        for res in resolvers:
+            if res.resolve_for != 'session':
+                return False
+    return True
+
+def get_session_contexts(project_data, session):
+    """
+    Iterate the contexts of a session, on top of the context of its project.
+
+    Args:
+        project_data (dict): The project node data
+        session (TreeNode): The session node
+
+    Returns:
+        iterator: The contexts of the session and its descendants
+    """
+    project = TreeNode('project', project_data)
+    project.children.append(session)
+
+    # The project context is only the parent layer of the session's contexts
+    contexts = project.context_iter()
+    next(contexts)
+    return contexts
+
+def curate_session(project_data, session, template, reset=False):
+    """
+    Curate and resolve a single session, with the project already curated.
+
+    Args:
+        project_data (dict): The project node data
+        session (TreeNode): The session node
+        template (Template): The template
+        reset (bool): Whether or not to reset bids info before curation
+    """
+    curate_contexts(get_session_contexts(project_data, session), template, reset)
+    resolve_contexts(get_session_contexts(project_data, session), template)
+
+def to_worker_json(node):
+    """
+    Convert a tree to the form that is sent to and from session worker processes.
+
+    Like to_json, but the files of a container are only sent as its file
+    nodes, not also in its 'files' list, which from_worker_json and
+    update_tree link to the file nodes again.
+
+    Args:
+        node (TreeNode): The tree to convert
+
+    Returns:
+        dict: The tree in worker form
+    """
+    data = node.data
+    has_files = 'files' in data
+    if has_files:
+        data = dict(data)
+        del data['files']
+    return {
+        'type': node.type,
+        'data': data,
+        'has_files': has_files,
+        'children': [to_worker_json(child) for child in node.children]
+    }
+
+def from_worker_json(data):
+    """
+    Restore a tree converted by to_worker_json.
+
+    Returns:
+        TreeNode: The restored tree
+    """
+    node = TreeNode(data['type'], data['data'])
+    node.children = [from_worker_json(child) for child in data['children']]
+    if data['has_files']:
+        link_file_nodes(node)
+    return node
+
+def link_file_nodes(node):
+    """Set the 'files' list of a container to the data of its file nodes, as add_file_nodes shares them"""
+    node.data['files'] = [child.data for child in node.children if child.type == 'file']
+
+def update_tree(node, result):
+    """
+    Copy the data of a curated tree, as produced by to_worker_json, onto node.
+
+    The nodes themselves are kept, so that they are still dirty compared to
+    the info that they were fetched with.
+
+    Args:
+        node (TreeNode): The node to update
+        result (dict): The curated node, in to_worker_json form
+    """
+    node.data = result['data']
+    for child, child_result in zip(node.children, result['children']):
+        update_tree(child, child_result)
+    if result['has_files']:
+        link_file_nodes(node)
+
+# The version of the code that curates sessions, computed on first use
+_curation_code_version = None
+
+def get_template_key(template):
+    """
+    Get the key that identifies the content of a template, and the code that curates with it.
+
+    Args:
+        template (Template): The template
+
+    Returns:
+        str: The key, or None if the template was not loaded from a file
+    """
+    global _curation_code_version
+    content_hash = getattr(template, 'content_hash', None)
+    if not content_hash:
+        return None
+    if _curation_code_version is None:
+        _curation_code_version = templates.get_source_version((sys.modules[__name__], bidsify_flywheel))
+    return hashlib.sha1((templates.get_template_cache_key(content_hash) + _curation_code_version).encode('utf-8')).hexdigest()
+
+def get_namespace_info(node, namespace):
+    info = node.get('info')
+    if isinstance(info, dict):
+        return info.get(namespace)
+    return None
+
+def get_session_fingerprint(project, session, template_key, namespace):
+    """
+    Compute the curation fingerprint of a session.
+
+    The fingerprint hashes the template with every field of the project node,
+    the session and all of its descendants, that could be read while curating
+    the session. Fields that change on every update (see FINGERPRINT_IGNORED_FIELDS),
+    the files of containers (which are hashed as child nodes) and the stored
+    fingerprint itself are left out.
+
+    Args:
+        project (TreeNode): The project node
+        session (TreeNode): The session node, with its acquisitions and files
+        template_key (str): The key of the template, see get_template_key
+        namespace (str): The template namespace
+
+    Returns:
+        str: The hex digest of the fingerprint
+    """
+    digest = hashlib.sha1(template_key.encode('utf-8'))
+    nodes = [project, session]
+    while nodes:
+        node = nodes.pop()
+        data = get_fingerprint_data(dict((key, value) for key, value in node.data.items() if key != 'files'))
+        ns_info = get_namespace_info(node, namespace)
+        if isinstance(ns_info, dict) and FINGERPRINT_KEY in ns_info:
+            ns_info = dict(ns_info)
+            del ns_info[FINGERPRINT_KEY]
+            data['info'] = dict(data['info'], **{namespace: ns_info})
+        digest.update(json.dumps([node.type, data], sort_keys=True, separators=(',', ':'), default=repr).encode('utf-8'))
+        if node is not project:
+            nodes.extend(reversed(node.children))
+    return digest.hexdigest()
+
+def get_fingerprint_data(value):
+    """
+    Get a copy of node data without the fields that are left out of fingerprints.
+
+    Args:
+        value: The node data, or a value in it
+
+    Returns:
+        The value, without FINGERPRINT_IGNORED_FIELDS outside of info
+    """
+    if isinstance(value, dict):
+        return dict((key, val if key == 'info' else get_fingerprint_data(val)) for key, val in value.items()
+                if key not in FINGERPRINT_IGNORED_FIELDS)
+    if isinstance(value, list):
+        return [get_fingerprint_data(val) for val in value]
+    return value
+
+def is_session_unchanged(project, session, template_key, namespace):
+    """
+    Check if a session is unchanged since it was last curated with the template.
+
+    Args:
+        project (TreeNode): The project node
+        session (TreeNode): The session node, with its acquisitions and files
+        template_key (str): The key of the template, see get_template_key
+        namespace (str): The template namespace
+
+    Returns:
+        bool: True if the session's stored fingerprint matches its current fingerprint
+    """
+    ns_info = get_namespace_info(session, namespace)
+    if not isinstance(ns_info, dict) or FINGERPRINT_KEY not in ns_info:
+        return False
+    return ns_info[FINGERPRINT_KEY] == get_session_fingerprint(project, session, template_key, namespace)
+
+def store_session_fingerprint(project, session, template_key, namespace):
+    """
+    Store the curation fingerprint of a curated session in its namespace info.
+
+    Sessions that did not match a template have nowhere to store it, and are
+    curated again on every run.
+
+    Args:
+        project (TreeNode): The project node
+        session (TreeNode): The curated session node
+        template_key (str): The key of the template, see get_template_key
+        namespace (str): The template namespace
+    """
+    ns_info = get_namespace_info(session, namespace)
+    if template_key and isinstance(ns_info, dict):
+        ns_info[FINGERPRINT_KEY] = get_session_fingerprint(project, session, template_key, namespace)
+
+def get_changed_tree(project, template):
+    """
+    Get the part of a project tree that changed since it was last curated with template.
+
+    Project-level nodes are always included. Sessions are included if their
+    fingerprint does not match, or if any session changed and the template
+    resolves across sessions.
+
+    Args:
+        project (TreeNode): The project node
+        template (Template): The template
+
+    Returns:
+        TreeNode: A project node with only the nodes to curate as children
+    """
+    template_key = get_template_key(template)
+    if not template_key:
+        logger.info('Template was not loaded from a file, curating every session')
+        return project
+
+    sessions = [child for child in project.children if child.type == 'session']
+    changed = [session for session in sessions
+            if not is_session_unchanged(project, session, template_key, template.namespace)]
+    if changed and not is_session_sharded(template):
+        changed = sessions
+    changed_ids = set(id(session) for session in changed)
+
+    logger.info('Skipping {} sessions that have not changed since they were last curated'.format(
+        len(sessions) - len(changed)))
+    curated = TreeNode('project', project.data)
+    curated.children = [child for child in project.children if child.type != 'session' or id(child) in changed_ids]
+    return curated
+
+# State of session worker processes, set by _init_session_worker
+_session_worker = {}
+
+def _init_session_worker(template_file, project_data, reset, template_cache_dir=None):
+    if template_file:
+        template = templates.loadTemplate(template_file, cache_dir=template_cache_dir)
+    else:
+        template = templates.DEFAULT_TEMPLATE
+    _session_worker.update(template=template, project_data=project_data, reset=reset)
+
+def _curate_session_worker(session_json):
+    """
+    Curate a single session in a worker process, returning it in to_worker_json form.
+    """
+    session = from_worker_json(session_json)
+    curate_session(_session_worker['project_data'], session, _session_worker['template'], _session_worker['reset'])
+    return to_worker_json(session)
 
 def main_with_args(api_key, session_id, reset, session_only):
 
@@ -234,7 +657,7 @@ def main():
     ### Read in arguments
     parser = argparse.ArgumentParser(description='BIDS Curation')
     parser.add_argument('--api-key', dest='api_key', action='store',
-            required=True, help='API key')
+            required=False, default=None, help='API key')
     parser.add_argument('-p', dest='project_label', action='store',
             required=False, default=None, help='Project Label on Flywheel instance')
     parser.add_argument('--session', dest='session_id', action='store',
@@ -245,22 +668,53 @@ def main():
             default=False, help='Only curate the session identified by --session')
     parser.add_argument('--template-file', dest='template_file', action='store',
             default=None, help='Template file to use')
+    parser.add_argument('--workers', dest='workers', action='store', type=int,
+            default=1, help='Number of concurrent requests to make to Flywheel')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store',
+            default=None, help='Directory to keep project snapshots and compiled templates in, to only fetch what changed since the last run')
+    parser.add_argument('--processes', dest='processes', action='store', type=int,
+            default=1, help='Number of processes to curate sessions in')
+    parser.add_argument('--stream', dest='stream', action='store_true',
+            default=False, help='Fetch, curate and update one session at a time, to limit memory use')
+    parser.add_argument('--stream-window', dest='stream_window', action='store', type=int,
+            default=2, help='Number of sessions to fetch ahead when streaming')
+    parser.add_argument('--incremental', dest='incremental', action='store_true',
+            default=False, help='Skip sessions that have not changed since they were last curated')
+    parser.add_argument('--profile', dest='profile', action='store',
+            default=None, help='Write the time spent in each phase, and API call statistics, to this JSON file')
+    parser.add_argument('--record', dest='record', action='store',
+            default=None, help='Record every Flywheel API call of the run to this cassette file')
+    parser.add_argument('--replay', dest='replay', action='store',
+            default=None, help='Serve the Flywheel API calls from this recorded cassette, instead of a Flywheel instance')
+    parser.add_argument('--replay-latency-scale', dest='replay_latency_scale', action='store', type=float,
+            default=1.0, help='Factor to scale the recorded latency of replayed calls by')
     args = parser.parse_args()
+    if not args.api_key and not args.replay:
+        parser.error('--api-key is required, unless replaying a cassette')
 
     ### Prep
-    # Check API key - raises Error if key is invalid
-    fw = flywheel.Flywheel(args.api_key)
-    # Get project id from label
-    if args.project_label:
-        project_id = utils.validate_project_label(fw, args.project_label)
-    elif args.session_id:
-        project_id = utils.get_project_id_from_session_id(fw, args.session_id)
+    if args.replay:
+        fw = cassette.ReplayClient(args.replay, latency_scale=args.replay_latency_scale)
     else:
-        print('Either project label or session id is required!')
-        sys.exit(1)
-
-    ### Curate BIDS project
-    curate_bids_dir(fw, project_id, args.session_id, reset=args.reset, template_file=args.template_file, session_only=args.session_only)
+        # Check API key - raises Error if key is invalid
+        fw = flywheel.Flywheel(args.api_key)
+
+    with cassette.record(args.record, fw) as fw:
+        # Get project id from label
+        if args.project_label:
+            project_id = utils.validate_project_label(fw, args.project_label)
+        elif args.session_id:
+            project_id = utils.get_project_id_from_session_id(fw, args.session_id)
+        else:
+            print('Either project label or session id is required!')
+            sys.exit(1)
+
+        ### Curate BIDS project
+        with profiling.profile(args.profile, fw) as fw:
+            curate_bids_dir(fw, project_id, args.session_id, reset=args.reset, template_file=args.template_file,
+                    session_only=args.session_only, workers=args.workers, cache_dir=args.cache_dir,
+                    processes=args.processes, stream=args.stream, stream_window=args.stream_window,
+                    incremental=args.incremental)
 
 if __name__ == '__main__':
     main()
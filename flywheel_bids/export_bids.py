@@ -1,15 +1,22 @@
 import argparse
+import collections
 import dateutil.parser
 import logging
 import json
 import os
 import re
+import shutil
 import sys
+import threading
+import time
 import zipfile
 
 import flywheel
+import six
 
-from .supporting_files import utils
+from concurrent.futures import ThreadPoolExecutor
+
+from .supporting_files import cassette, profiling, project_tree, utils
 from .supporting_files.errors import BIDSExportError
 
 logging.basicConfig(level=logging.INFO)
@@ -17,6 +24,9 @@ logger = logging.getLogger('bids-exporter')
 
 EPOCH = dateutil.parser.parse('1970-01-01 00:00:0Z')
 
+# The number of bytes to copy at a time when extracting zip members
+ZIP_CHUNK_SIZE = 1024 * 1024
+
 def validate_dirname(dirname):
     """
     Check the following criteria to ensure 'dirname' is valid
@@ -78,6 +88,9 @@ def is_file_excluded_options(namespace, src_data, replace):
             if not replace:
                 return True
             # Check if the file already exists and whether it is up to date
+            size = f.get('size')
+            if size is not None and size != os.path.getsize(fpath):
+                return False
             time_since_epoch = timestamp_to_int(f.get('modified'))
             if time_since_epoch == int(os.path.getmtime(fpath)):
                 return True
@@ -86,6 +99,9 @@ def is_file_excluded_options(namespace, src_data, replace):
     return is_file_excluded
 
 def timestamp_to_int(timestamp):
+    # Timestamps of project tree nodes are serialized
+    if isinstance(timestamp, six.string_types):
+        timestamp = dateutil.parser.parse(timestamp)
     return int((timestamp-EPOCH).total_seconds())
 
 def is_container_excluded(container, namespace):
@@ -168,94 +184,458 @@ def create_json(meta_info, path, namespace):
         json.dump(meta_info, outfile,
                 sort_keys=True, indent=4)
 
-def download_bids_files(fw, filepath_downloads, dry_run):
-    """
-    filepath_downloads: {container_type: {filepath: {'args': (tuple of args for sdk download function), 'modified': file modified attr}}}
-    """
-    # Download all project files
-    logger.info('Downloading project files')
-    for f in filepath_downloads['project']:
-        args = filepath_downloads['project'][f]['args']
-        modified = filepath_downloads['project'][f]['modified']
-        logger.info('Downloading project file: {0}'.format(args[1]))
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[2]))
-            continue
-        fw.download_file_from_project(*args)
-        # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
-        modified_time = float(timestamp_to_int(modified))
-        os.utime(f,(modified_time, modified_time))
-
-        # If zipfile is attached to project, unzip...
-        path = args[2]
-        zip_pattern = re.compile('[a-zA-Z0-9]+(.zip)')
-        zip_dirname = path[:-4]
-        if zip_pattern.search(path):
-            zip_ref = zipfile.ZipFile(path, 'r')
-            zip_ref.extractall(zip_dirname)
-            zip_ref.close()
-            # Remove the zipfile
-            os.remove(path)
-
-    # Download all session files
-    logger.info('Downloading session files')
-    for f in filepath_downloads['session']:
-        args = filepath_downloads['session'][f]['args']
-        modified = filepath_downloads['session'][f]['modified']
-        logger.info('Downloading session file: {0}'.format(args[1]))
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[2]))
-            continue
-        fw.download_file_from_session(*args)
-        # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
-        modified_time = float(timestamp_to_int(modified))
-        os.utime(f,(modified_time, modified_time))
+def get_temp_path(path):
+    """
+    Get the path to download a file to, before it is moved into place.
+    """
+    dirname, basename = os.path.split(path)
+    return os.path.join(dirname, '.{}.part'.format(basename))
 
+def download_file(fw, container_type, args, modified, size=None, retries=3):
+    """
+    Download a single file to a temporary name, then move it into place.
 
-    # Download all acquisition files
-    logger.info('Downloading acquisition files')
-    for f in filepath_downloads['acquisition']:
-        args = filepath_downloads['acquisition'][f]['args']
-        modified = filepath_downloads['acquisition'][f]['modified']
-        # Download the file
-        logger.info('Downloading acquisition file: {0}'.format(args[1]))
+    The mtime of the file is set to the 'modified' timestamp before it is
+    renamed, so an interrupted download never leaves a partial file at path.
 
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[2]))
-            continue
+    Zip files of the project are extracted to a directory named after them.
+    If the client can download single zip members, they are downloaded
+    directly (see download_zip_members), without the archive itself.
 
-        fw.download_file_from_acquisition(*args)
+    fw: Flywheel client
+    container_type: The type of the parent container (project, session or acquisition)
+    args: (container_id, file_name, path)
+    modified: The file modified timestamp
+    size: The expected file size in bytes, if known
+    retries: The number of times to retry a failed download
+    """
+    container_id, name, path = args
+    # If zipfile is attached to project, unzip...
+    is_project_zip = container_type == 'project' and re.search('[a-zA-Z0-9]+(.zip)', path)
+    if is_project_zip and hasattr(fw, 'get_project_file_zip_info'):
+        logger.info('Downloading {0} file members: {1}'.format(container_type, name))
+        download_zip_members(fw, container_type, container_id, name, path[:-4], retries=retries)
+        return
+
+    logger.info('Downloading {0} file: {1}'.format(container_type, name))
+    download = getattr(fw, 'download_file_from_{}'.format(container_type))
+    temp_path = get_temp_path(path)
+    try:
+        utils.call_with_retries(download, (container_id, name, temp_path), retries=retries)
+        if size is not None and os.path.getsize(temp_path) != size:
+            raise BIDSExportError('Expected {} bytes, got {}'.format(size, os.path.getsize(temp_path)))
         # Set the mtime of the downloaded file to the 'modified' timestamp in seconds
         modified_time = float(timestamp_to_int(modified))
-        os.utime(f,(modified_time, modified_time))
+        os.utime(temp_path, (modified_time, modified_time))
+        replace_file(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    if is_project_zip:
+        extract_zip(path, path[:-4])
+        # Remove the zipfile
+        os.remove(path)
+
+def download_zip_members(fw, container_type, container_id, name, dest_dir, retries=3):
+    """
+    Extract a zip file of a container by downloading each of its members, skipping members that have not changed.
+
+    The members are listed with get_<container>_file_zip_info and downloaded
+    one at a time with download_<container>_file_zip_member, straight to the
+    temporary file of the member, so the archive itself is never stored. See
+    extract_member for how members are written.
+
+    fw: Flywheel client
+    container_type: The type of the parent container (project, session or acquisition)
+    container_id: The id of the parent container
+    name: The name of the zip file
+    dest_dir: The directory to extract to
+    retries: The number of times to retry each failed request
+    """
+    get_zip_info = getattr(fw, 'get_{}_file_zip_info'.format(container_type))
+    download_member = getattr(fw, 'download_{}_file_zip_member'.format(container_type))
+    zip_info = utils.call_with_retries(get_zip_info, (container_id, name), retries=retries)
+    for member in zip_info['members']:
+        def write(temp_path, member=member):
+            utils.call_with_retries(download_member, (container_id, name, member['path'], temp_path),
+                    retries=retries)
+            if os.path.getsize(temp_path) != member['size']:
+                raise BIDSExportError('Expected {} bytes, got {}'.format(member['size'], os.path.getsize(temp_path)))
+
+        extract_member(dest_dir, member['path'], member['size'], float(timestamp_to_int(member['timestamp'])), write)
+
+def extract_zip(zip_path, dest_dir, chunk_size=ZIP_CHUNK_SIZE):
+    """
+    Extract a downloaded zip file, skipping members that have not changed.
+
+    The whole archive is on disk before extraction starts, so peak disk use is
+    still about twice the size of the archive. See extract_member for how
+    members are written.
+
+    zip_path: The path of the zip file
+    dest_dir: The directory to extract to
+    chunk_size: The number of bytes to copy at a time
+    """
+    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
+        for member in zip_ref.infolist():
+            def write(temp_path, member=member):
+                with zip_ref.open(member) as src, open(temp_path, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, chunk_size)
+
+            # Zip entries store local time
+            modified_time = time.mktime(member.date_time + (0, 0, -1))
+            extract_member(dest_dir, member.filename, member.file_size, modified_time, write)
+
+def extract_member(dest_dir, member_name, size, modified_time, write):
+    """
+    Extract a single zip member, unless it has not changed.
+
+    The member is written to a temporary file and renamed into place, so an
+    interrupted extraction never leaves a partial member. It gets the mtime
+    of its zip entry, and members that already exist with the same size and
+    mtime are skipped. Member paths that would leave dest_dir are skipped.
+
+    dest_dir: The directory to extract to
+    member_name: The path of the member in the zip file
+    size: The size of the member in bytes
+    modified_time: The mtime of the member, in seconds since the epoch
+    write: Writes the content of the member to the path it is called with
+    """
+    path = get_member_path(dest_dir, member_name)
+    if not path:
+        logger.warning('Skipping zip member {0}'.format(member_name))
+        return
+
+    if member_name.endswith('/'):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return
+
+    if (os.path.isfile(path) and os.path.getsize(path) == size
+            and int(os.path.getmtime(path)) == int(modified_time)):
+        return
+
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+
+    temp_path = get_temp_path(path)
+    try:
+        write(temp_path)
+        os.utime(temp_path, (modified_time, modified_time))
+        replace_file(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def get_member_path(dest_dir, member_name):
+    """
+    Get the path to extract a zip member to, or None if it would leave dest_dir.
+    """
+    parts = [part for part in member_name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or os.path.splitdrive(parts[0])[0]:
+        return None
+    return os.path.join(dest_dir, *parts)
+
+def replace_file(src, dst):
+    """
+    Atomically move src to dst, replacing dst if it exists.
+    """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)
+    else:
+        os.rename(src, dst)
+
+def get_export_header(container_type, container_id, src_data=False, replace=False,
+        subjects=None, sessions=None, folders=None):
+    """
+    Describe an export, so that a manifest is only resumed by the same export.
+
+    Returns:
+        dict: The container and the options that the plan depends on
+    """
+    return {
+        'type': 'header',
+        'container_type': container_type,
+        'container_id': container_id,
+        'source_data': bool(src_data),
+        'replace': bool(replace),
+        'subjects': sorted(subjects or []),
+        'sessions': sorted(sessions or []),
+        'folders': sorted(folders or [])
+    }
+
+class ExportManifest(object):
+    """
+    A journal of the planned downloads and sidecars of an export, kept in the BIDS dir.
+
+    The manifest is a JSON lines file: a header describing the export (see
+    get_export_header) and the plan are written first, with one pending
+    entry per file, and an entry is appended each time a file is completed.
+    Later entries for the same file override earlier ones. Sidecars are
+    recorded by the container and file that their info comes from, which is
+    fetched again when they are resumed.
+
+    bids_dir: The directory being exported to
+    """
+    FILENAME = '.bids_export_manifest.jsonl'
+
+    def __init__(self, bids_dir):
+        self.bids_dir = bids_dir
+        self.path = os.path.join(bids_dir, self.FILENAME)
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def write_plan(self, filepath_downloads, header=None):
+        """
+        Replace the manifest with the given plan, all entries pending.
+
+        header: The description of the export, see get_export_header
+        """
+        with open(self.path, 'w') as fp:
+            if header is not None:
+                self._write(fp, header)
+            for container_type in ('project', 'session', 'acquisition'):
+                for path, download in filepath_downloads[container_type].items():
+                    container_id, name, _ = download['args']
+                    modified = download['modified']
+                    self._write(fp, {
+                        'type': 'download',
+                        'path': os.path.relpath(path, self.bids_dir),
+                        'container_type': container_type,
+                        'container_id': container_id,
+                        'name': name,
+                        'size': download.get('size'),
+                        'modified': modified.isoformat() if hasattr(modified, 'isoformat') else modified,
+                        'status': 'pending'
+                    })
+            for path, sidecar in filepath_downloads['sidecars'].items():
+                _, _, namespace = sidecar['args']
+                container_type, container_id, name, info_key = sidecar['source']
+                self._write(fp, {
+                    'type': 'sidecar',
+                    'path': os.path.relpath(path, self.bids_dir),
+                    'container_type': container_type,
+                    'container_id': container_id,
+                    'name': name,
+                    'info_key': info_key,
+                    'namespace': namespace,
+                    'status': 'pending'
+                })
+
+    def load_header(self):
+        """
+        Get the description of the export that the manifest was written by.
+
+        Returns:
+            dict: The header, or None if the manifest has none
+        """
+        with open(self.path, 'r') as fp:
+            line = fp.readline()
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            return None
+        if entry.get('type') != 'header':
+            return None
+        return entry
+
+    def mark_done(self, entry_type, path):
+        """
+        Record that the download or sidecar of path is complete.
+        """
+        entry = {'type': entry_type, 'path': os.path.relpath(path, self.bids_dir), 'status': 'done'}
+        with self._lock:
+            with open(self.path, 'a') as fp:
+                self._write(fp, entry)
+
+    def load_pending(self, fw):
+        """
+        Rebuild filepath_downloads from the manifest, with only the entries that are not done.
+
+        The info of pending sidecars is fetched again, once per container.
+        """
+        entries = collections.OrderedDict()
+        with open(self.path, 'r') as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # The last line may be incomplete if the export was killed
+                    continue
+                if entry['type'] == 'header':
+                    continue
+                key = (entry['type'], entry['path'])
+                if entry['status'] == 'pending':
+                    entries[key] = entry
+                elif key in entries:
+                    entries[key]['status'] = entry['status']
+
+        filepath_downloads = {
+            'project':{},
+            'session':{},
+            'acquisition':{},
+            'sidecars':{}
+        }
+        containers = {}
+        for entry in entries.values():
+            if entry['status'] == 'done':
+                continue
+            path = os.path.join(self.bids_dir, entry['path'])
+            if entry['type'] == 'download':
+                modified = entry['modified']
+                if modified is not None:
+                    modified = dateutil.parser.parse(modified)
+                filepath_downloads[entry['container_type']][path] = {
+                    'args': (entry['container_id'], entry['name'], path),
+                    'modified': modified,
+                    'size': entry['size']
+                }
+                continue
+
+            source = (entry['container_type'], entry['container_id'], entry['name'], entry['info_key'])
+            container_key = source[:2]
+            if container_key not in containers:
+                get_container = getattr(fw, 'get_{}'.format(entry['container_type']))
+                containers[container_key] = project_tree.to_dict(fw, get_container(entry['container_id']))
+            meta_info = get_sidecar_info(containers[container_key], entry['name'], entry['info_key'])
+            if meta_info is None:
+                logger.warning('Not creating sidecar {}, its file no longer exists'.format(path))
+                continue
+            filepath_downloads['sidecars'][path] = {'args': (meta_info, path, entry['namespace']), 'source': source}
+        return filepath_downloads
+
+    def _write(self, fp, entry):
+        fp.write(json.dumps(entry, sort_keys=True))
+        fp.write('\n')
+        fp.flush()
+
+def get_sidecar_info(container, file_name=None, info_key=None):
+    """
+    Get the info that a sidecar is created from.
+
+    container: The container, as a dict
+    file_name: The name of the file whose info to get, or None for the container's own info
+    info_key: The key of info to get, or None for the whole info
+
+    Returns: The info, or None if the file does not exist
+    """
+    if file_name is not None:
+        for f in container.get('files') or []:
+            if f['name'] == file_name:
+                container = f
+                break
+        else:
+            return None
+    info = container.get('info') or {}
+    if info_key is not None:
+        info = info.get(info_key, {})
+    return info
+
+def download_bids_files(fw, filepath_downloads, dry_run, workers=1, retries=3, manifest=None):
+    """
+    filepath_downloads: {container_type: {filepath: {'args': (tuple of args for sdk download function), 'modified': file modified attr, 'size': file size}}}
+    workers: The number of files to download concurrently
+    retries: The number of times to retry each failed download
+    manifest: The ExportManifest to record completed files in
+    """
+    # Collect the downloads of all containers. If a path is mapped from
+    #   several container types, the last one wins, as it would serially.
+    downloads = collections.OrderedDict()
+    for container_type in ('project', 'session', 'acquisition'):
+        logger.info('Downloading {} files'.format(container_type))
+        for f in filepath_downloads[container_type]:
+            args = filepath_downloads[container_type][f]['args']
+            modified = filepath_downloads[container_type][f]['modified']
+            # For dry run, don't actually download
+            if dry_run:
+                logger.info('Downloading {0} file: {1}'.format(container_type, args[1]))
+                logger.info('  to {0}'.format(args[2]))
+                continue
+            downloads.pop(f, None)
+            downloads[f] = (fw, container_type, args, modified,
+                    filepath_downloads[container_type][f].get('size'), retries)
+
+    def run_download(download):
+        try:
+            download_file(*download)
+            if manifest is not None:
+                manifest.mark_done('download', download[2][2])
+            return True
+        except Exception as exc:
+            logger.error('Could not download {0} file {1}: {2}'.format(download[1], download[2][1], exc))
+            return False
+
+    with profiling.phase('download'):
+        if workers > 1 and len(downloads) > 1:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(run_download, downloads.values()))
+        else:
+            results = [run_download(download) for download in downloads.values()]
+
+    failed = results.count(False)
+    if failed:
+        raise BIDSExportError('Could not download {} files'.format(failed))
 
     # Creating all JSON sidecar files
     logger.info('Creating sidecar files')
-    for f in filepath_downloads['sidecars']:
-        args = filepath_downloads['sidecars'][f]['args']
-        # Download the file
-        logger.info('Creating sidecar file: {0}'.format(args[1]))
+    with profiling.phase('sidecars'):
+        for f in filepath_downloads['sidecars']:
+            args = filepath_downloads['sidecars'][f]['args']
+            # Download the file
+            logger.info('Creating sidecar file: {0}'.format(args[1]))
 
-        # For dry run, don't actually download
-        if dry_run:
-            logger.info('  to {0}'.format(args[1]))
-            continue
+            # For dry run, don't actually download
+            if dry_run:
+                logger.info('  to {0}'.format(args[1]))
+                continue
 
-        create_json(*args)
+            create_json(*args)
+            if manifest is not None:
+                manifest.mark_done('sidecar', f)
 
 def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
-        dry_run=False, replace=False, subjects=[], sessions=[], folders=[]):
+        dry_run=False, replace=False, subjects=[], sessions=[], folders=[], workers=1,
+        manifest=None, cache_dir=None):
     """
 
     fw: Flywheel client
     project_id: Label of the project to download
     outdir: path to directory to download files to, string
     src_data: Option to include sourcedata when downloading
+    workers: The number of files to download concurrently
+    manifest: The ExportManifest to record the planned and completed files in
+    cache_dir: Optional directory to keep project snapshots in
 
     """
+    with profiling.phase('plan'):
+        filepath_downloads = plan_bids_downloads(fw, container_id, container_type, outdir,
+                src_data=src_data, replace=replace, subjects=subjects, sessions=sessions, folders=folders,
+                workers=workers, cache_dir=cache_dir)
+
+    if manifest is not None and not dry_run:
+        manifest.write_plan(filepath_downloads, get_export_header(container_type, container_id,
+                src_data=src_data, replace=replace, subjects=subjects, sessions=sessions, folders=folders))
+
+    download_bids_files(fw, filepath_downloads, dry_run, workers=workers, manifest=manifest)
+
+def plan_bids_downloads(fw, container_id, container_type, outdir, src_data=False,
+        replace=False, subjects=[], sessions=[], folders=[], workers=1, cache_dir=None):
+    """
+    Map the files of a container to the paths they are downloaded to.
+
+    The hierarchy is loaded with project_tree.get_project_tree, the same
+    loader that curation uses, so containers are fetched once (concurrently
+    with workers > 1) and can be refreshed from the snapshot in cache_dir.
+    The plan is built from the loaded nodes; sessions and acquisitions whose
+    listing already includes their files are not fetched at all.
+
+    Returns: {container_type: {filepath: {'args': (container_id, file name, filepath), 'modified': file modified attr, 'size': file size}}}
+        with the sidecars to create under 'sidecars', as {filepath: {'args': (meta info, filepath, namespace),
+        'source': (container_type, container_id, file name or None, info key or None)}}
+    """
 
     # Define namespace
     namespace = 'BIDS'
@@ -268,121 +648,110 @@ def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
         'acquisition':{},
         'sidecars':{}
     }
-    valid = True
+    # Errors found while mapping files
+    errors = []
+
+    def add_download(parent_type, parent, f):
+        # Define path - ensure that the folder exists...
+        path = define_path(outdir, f, namespace)
+        # If path is not defined (an empty string) move onto next file
+        if not path:
+            return False
+
+        # Don't exclude any files that specify exclusion
+        if is_file_excluded(f, path):
+            return False
+
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        warn_if_bids_invalid(f, namespace)
+
+        downloads = filepath_downloads[parent_type]
+        if path in downloads:
+            errors.append('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], downloads[path]['args'][1]))
+            logger.error(errors[-1])
+
+        downloads[path] = {'args': (parent['id'], f['name'], path), 'modified': f.get('modified'),
+            'size': f.get('size')}
+        return True
+
+    def is_session_included(session):
+        # Skip session if we're filtering to the list of sessions
+        if sessions and session.get('label') not in sessions:
+            return False
+
+        # Skip session if BIDS.Ignore is True
+        if is_container_excluded(session, namespace):
+            return False
+
+        # Skip subject if we're filtering subjects
+        if subjects:
+            subj_code = session.get('subject', {}).get('code')
+            if subj_code not in subjects:
+                return False
+        return True
 
     if container_type == 'project':
-        # Get project
-        project = fw.get_project(container_id)
+        # Get project, without the sessions that are filtered out
+        with profiling.phase('tree_load'):
+            project = project_tree.get_project_tree(fw, container_id, workers=workers, cache_dir=cache_dir,
+                    session_filter=is_session_included)
 
         # Check that project is curated
         if not project['info'].get(namespace):
-            raise BIDSExportError('Project {} has not been curated for {}'.format(project.label, namespace))
+            raise BIDSExportError('Project {} has not been curated for {}'.format(project['label'], namespace))
 
         logger.info('Processing project files')
         # Iterate over any project files
-        for f in project.get('files', []):
-
-            # Define path - ensure that the folder exists...
-            path = define_path(outdir, f, namespace)
-            # If path is not defined (an empty string) move onto next file
-            if not path:
-                continue
-
-            # Don't exclude any files that specify exclusion
-            if is_file_excluded(f, path):
-                continue
-
-            if not os.path.exists(os.path.dirname(path)):
-                os.makedirs(os.path.dirname(path))
-
-            warn_if_bids_invalid(f, namespace)
-
-
-            # For dry run, don't actually download
-            if path in filepath_downloads['project']:
-                logger.error('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], filepath_downloads['project'][path]['args'][1]))
-                valid = False
-
-            filepath_downloads['project'][path] = {'args': (project['_id'], f['name'], path), 'modified': f.get('modified')}
+        for f in project.children:
+            if f.type == 'file':
+                add_download('project', project, f)
 
         ## Create dataset_description.json filepath_download
         path = os.path.join(outdir, 'dataset_description.json')
-        filepath_downloads['sidecars'][path] = {'args': (project['info'][namespace], path, namespace)}
-        # Get project sessions
-        project_sessions = fw.get_project_sessions(container_id)
+        filepath_downloads['sidecars'][path] = {'args': (project['info'][namespace], path, namespace),
+            'source': ('project', project['id'], None, namespace)}
+        project_sessions = [child for child in project.children if child.type == 'session']
     elif container_type == 'session':
-        project_sessions = [fw.get_session(container_id)]
+        with profiling.phase('tree_load'):
+            session = fw.get_session(container_id)
+            if is_session_included(session):
+                project_sessions = [project_tree.get_session_tree(fw, session, workers=workers)]
+            else:
+                project_sessions = []
     else:
         project_sessions = []
 
     if project_sessions:
         logger.info('Processing session files')
         all_acqs = []
-        for proj_ses in project_sessions:
-            # Skip session if we're filtering to the list of sessions
-            if sessions and proj_ses.get('label') not in sessions:
+        for session in project_sessions:
+            # The fetched session may differ from its listing
+            if not is_session_included(session):
                 continue
 
-            # Skip session if BIDS.Ignore is True
-            if is_container_excluded(proj_ses, namespace):
-                continue
-
-            # Skip subject if we're filtering subjects
-            if subjects:
-                subj_code = proj_ses.get('subject', {}).get('code')
-                if subj_code not in subjects:
-                    continue
-
-            # Get true session if files aren't already retrieved, in order to access file info
-            if proj_ses.get('files'):
-                session = proj_ses
-            else:
-                session = fw.get_session(proj_ses['_id'])
-            # Check if session contains files
             # Iterate over any session files
-            for f in session.get('files', []):
-
-                # Define path - ensure that the folder exists...
-                path = define_path(outdir, f, namespace)
-                # If path is not defined (an empty string) move onto next file
-                if not path:
-                    continue
-
-                # Don't exclude any files that specify exclusion
-                if is_file_excluded(f, path):
-                    continue
-
-                if not os.path.exists(os.path.dirname(path)):
-                    os.makedirs(os.path.dirname(path))
+            for child in session.children:
+                if child.type == 'file':
+                    add_download('session', session, child)
+                else:
+                    all_acqs.append(child)
 
-                warn_if_bids_invalid(f, namespace)
-
-
-                if path in filepath_downloads['session']:
-                    logger.error('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], filepath_downloads['session'][path]['args'][1]))
-                    valid = False
-
-                filepath_downloads['session'][path] = {'args': (session['_id'], f['name'], path), 'modified': f.get('modified')}
-
-            logger.info('Processing acquisition files')
-            # Get acquisitions
-            session_acqs = fw.get_session_acquisitions(proj_ses['_id'])
-            all_acqs += session_acqs
+        logger.info('Processing acquisition files')
     elif container_type == 'acquisition':
-        all_acqs = [fw.get_acquisition(container_id)]
+        all_acqs = [project_tree.get_acquisition_node(fw, container_id)]
     else:
         all_acqs = []
 
     if all_acqs:
-        for ses_acq in all_acqs:
+        for acq in all_acqs:
             # Skip if BIDS.Ignore is True
-            if is_container_excluded(ses_acq, namespace):
+            if is_container_excluded(acq, namespace):
                 continue
-            # Get true acquisition if files aren't already retrieved, in order to access file info
 
-            acq = fw.get_acquisition(ses_acq['_id'])
             # Iterate over acquistion files
-            for f in acq.get('files', []):
+            for f in acq.children:
 
                 # Skip any folders not in the skip-list (if there is a skip list)
                 if folders:
@@ -390,37 +759,21 @@ def download_bids_dir(fw, container_id, container_type, outdir, src_data=False,
                     if folder not in folders:
                         continue
 
-                # Define path - ensure that the folder exists...
-                path = define_path(outdir, f, namespace)
-                # If path is not defined (an empty string) move onto next file
-                if not path:
-                    continue
-
-                # Don't exclude any files that specify exclusion
-                if is_file_excluded(f, path):
+                if not add_download('acquisition', acq, f):
                     continue
 
-                if not os.path.exists(os.path.dirname(path)):
-                    os.makedirs(os.path.dirname(path))
-
-                warn_if_bids_invalid(f, namespace)
-
-                if path in filepath_downloads['acquisition']:
-                    logger.error('Multiple files with path {0}:\n\t{1} and\n\t{2}'.format(path, f['name'], filepath_downloads['acquisition'][path]['args'][1]))
-                    valid = False
-
-                filepath_downloads['acquisition'][path] = {'args': (acq['_id'], f['name'], path), 'modified': f.get('modified')}
-
                 # Create the sidecar JSON filepath_download
-                filepath_downloads['sidecars'][path] = {'args': (f['info'], path, namespace)}
+                path = define_path(outdir, f, namespace)
+                filepath_downloads['sidecars'][path] = {'args': (f['info'], path, namespace),
+                    'source': ('acquisition', acq['id'], f['name'], None)}
     else:
-        logger.error('{} is not a valid containertype'.format(container_type))
-        valid = False
+        errors.append('{} is not a valid containertype'.format(container_type))
+        logger.error(errors[-1])
 
-    if not valid:
+    if errors:
         raise BIDSExportError('Error mapping files from Flywheel to BIDS')
 
-    download_bids_files(fw, filepath_downloads, dry_run)
+    return filepath_downloads
 
 def determine_container(fw, project_label, container_type, container_id):
     """
@@ -444,7 +797,8 @@ def determine_container(fw, project_label, container_type, container_id):
     return ctype, cid
 
 def export_bids(fw, bids_dir, project_label, subjects=None, sessions=None, folders=None, replace=False,
-        dry_run=False, container_type=None, container_id=None, source_data=False, validate=True):
+        dry_run=False, container_type=None, container_id=None, source_data=False, validate=True, workers=1,
+        resume=False, cache_dir=None):
 
     ### Prep
     # Check directory name - ensure it exists
@@ -453,15 +807,32 @@ def export_bids(fw, bids_dir, project_label, subjects=None, sessions=None, folde
     # Check that container args are valid
     ctype, cid = determine_container(fw, project_label, container_type, container_id)
 
-    ### Download BIDS project
-    download_bids_dir(fw, cid, ctype, bids_dir,
-            src_data=source_data, dry_run=dry_run, replace=replace,
+    manifest = ExportManifest(bids_dir)
+    header = get_export_header(ctype, cid, src_data=source_data, replace=replace,
             subjects=subjects, sessions=sessions, folders=folders)
+    if resume and manifest.exists() and manifest.load_header() == header:
+        ### Continue the unfinished downloads of the previous export
+        logger.info('Resuming export from {}'.format(manifest.path))
+        filepath_downloads = manifest.load_pending(fw)
+        download_bids_files(fw, filepath_downloads, dry_run, workers=workers, manifest=manifest)
+    else:
+        if resume and manifest.exists():
+            logger.warning('The export manifest in {} is for a different container or options, '
+                    'exporting everything'.format(bids_dir))
+        elif resume:
+            logger.info('No export manifest found in {}, exporting everything'.format(bids_dir))
+
+        ### Download BIDS project
+        download_bids_dir(fw, cid, ctype, bids_dir,
+                src_data=source_data, dry_run=dry_run, replace=replace,
+                subjects=subjects, sessions=sessions, folders=folders, workers=workers,
+                manifest=manifest, cache_dir=cache_dir)
 
     # Validate the downloaded directory
     #   Go one more step into the hierarchy to pass to the validator...
     if validate and not dry_run:
-        utils.validate_bids(bids_dir)
+        with profiling.phase('validate'):
+            utils.validate_bids(bids_dir)
 
 def main():
     ### Read in arguments
@@ -470,7 +841,7 @@ def main():
             required=True, help='Name of directory in which to download BIDS hierarchy. \
                     NOTE: Directory must be empty.')
     parser.add_argument('--api-key', dest='api_key', action='store',
-            required=True, help='API key')
+            required=False, default=None, help='API key')
     parser.add_argument('--source-data', dest='source_data', action='store_true',
             default=False, required=False, help='Include source data in BIDS export')
     parser.add_argument('--dry-run', dest='dry_run', action='store_true',
@@ -486,14 +857,35 @@ def main():
             help='Download single container (acquisition|session|project) in BIDS format. Must provide --container-id.')
     parser.add_argument('--container-id', dest='container_id', action='store', required=False, default=None,
             help='Download single container in BIDS format. Must provide --container-type.')
+    parser.add_argument('--workers', dest='workers', action='store', type=int, required=False, default=1,
+            help='Number of files to download concurrently')
+    parser.add_argument('--resume', dest='resume', action='store_true', default=False, required=False,
+            help='Continue the unfinished downloads of a previous export with the same options, without planning again')
+    parser.add_argument('--cache-dir', dest='cache_dir', action='store', required=False, default=None,
+            help='Directory to keep project snapshots in, to only fetch what changed since the last run')
+    parser.add_argument('--profile', dest='profile', action='store', required=False, default=None,
+            help='Write the time spent in each phase, and API call statistics, to this JSON file')
+    parser.add_argument('--record', dest='record', action='store', required=False, default=None,
+            help='Record every Flywheel API call of the run to this cassette file')
+    parser.add_argument('--replay', dest='replay', action='store', required=False, default=None,
+            help='Serve the Flywheel API calls from this recorded cassette, instead of a Flywheel instance')
+    parser.add_argument('--replay-latency-scale', dest='replay_latency_scale', action='store', type=float,
+            required=False, default=1.0, help='Factor to scale the recorded latency of replayed calls by')
     args = parser.parse_args()
+    if not args.api_key and not args.replay:
+        parser.error('--api-key is required, unless replaying a cassette')
 
-    # Check API key - raises Error if key is invalid
-    fw = flywheel.Flywheel(args.api_key)
+    if args.replay:
+        fw = cassette.ReplayClient(args.replay, latency_scale=args.replay_latency_scale)
+    else:
+        # Check API key - raises Error if key is invalid
+        fw = flywheel.Flywheel(args.api_key)
 
     try:
-        export_bids(fw, args.bids_dir, args.project_label, subjects=args.subjects, sessions=args.sessions, folders=args.folders, replace=args.replace,
-                dry_run=args.dry_run, container_type=args.container_type, container_id=args.container_id, source_data=args.source_data)
+        with cassette.record(args.record, fw) as fw, profiling.profile(args.profile, fw) as fw:
+            export_bids(fw, args.bids_dir, args.project_label, subjects=args.subjects, sessions=args.sessions, folders=args.folders, replace=args.replace,
+                    dry_run=args.dry_run, container_type=args.container_type, container_id=args.container_id, source_data=args.source_data,
+                    workers=args.workers, resume=args.resume, cache_dir=args.cache_dir)
     except utils.BIDSException as bids_exception:
         logger.error(bids_exception)
         sys.exit(bids_exception.status_code)
@@ -1,3 +1,4 @@
+import collections
 import json
 import pprint
 import re
@@ -23,15 +24,153 @@ def determine_enum(theproperty, key, classification):
     if not enum_value:
         # If key is modality, iterate over classifications dict
         if key == 'Modality':
-            for data_type in classifications.classifications.keys():
-                # Loops through the enum values in the propdef, allows for prioritization
-                for enum_value in theproperty.get('enum', []):
-                    enum_req = classifications.classifications[data_type].get(enum_value)
-                    if enum_req and utils.dict_match(enum_req, classification):
-                        return enum_value
+            enum = theproperty.get('enum', [])
+            try:
+                match = get_modality_index(enum).find(classification)
+            except TypeError:
+                # Unhashable enum values or classification features can't be looked up
+                return scan_classifications(enum, classification, enum_value)
+            if match is not None:
+                return match
+            # Without a match, the last enum value that was tried is returned
+            if enum and classifications.classifications:
+                return enum[-1]
 
     return enum_value
 
+def scan_classifications(enum, classification, enum_value=''):
+    """
+    Find the first enum value whose classification matches, by trying each in turn.
+
+    Args:
+        enum (list): The enum values, in order of priority within each data type
+        classification (dict): The classification to match
+        enum_value: The value to return if there are no enum values to try
+
+    Returns:
+        The matching enum value, otherwise the last enum value tried
+    """
+    for data_type in classifications.classifications.keys():
+        # Loops through the enum values in the propdef, allows for prioritization
+        for enum_value in enum:
+            enum_req = classifications.classifications[data_type].get(enum_value)
+            if enum_req and utils.dict_match(enum_req, classification):
+                return enum_value
+
+    return enum_value
+
+# The ModalityIndex of each list of enum values
+_modality_indexes = {}
+
+def get_modality_index(enum):
+    """
+    Get the ModalityIndex of a list of enum values, building it on first use.
+
+    Raises:
+        TypeError: If the enum values are not hashable
+    """
+    key = tuple(enum)
+    index = _modality_indexes.get(key)
+    if index is None:
+        index = ModalityIndex(enum)
+        _modality_indexes[key] = index
+    return index
+
+class ModalityIndex(object):
+    """
+    Inverted index of the classifications of a list of enum values, for determine_enum.
+
+    Candidate enum values are numbered in the order that scan_classifications
+    tries them (by data type, then by enum value), and indexed by each of the
+    classification features that they require. A feature is a (key, value)
+    pair, or a (key,) tuple for the presence of a key. A classification matches
+    the first candidate whose features it has all of, and the result is
+    remembered for every classification with the same features.
+
+    The index reflects classifications.classifications at the time it is built.
+
+    Args:
+        enum (list): The enum values, in order of priority within each data type
+
+    Attributes:
+        candidates: The (enum value, number of required features) of each candidate
+        postings: The positions of the candidates requiring each feature
+    """
+    # The maximum number of classifications to remember
+    MEMO_SIZE = 1024
+
+    def __init__(self, enum):
+        self.candidates = []
+        self.postings = {}
+        self._memo = {}
+        for data_type in classifications.classifications.keys():
+            for enum_value in enum:
+                enum_req = classifications.classifications[data_type].get(enum_value)
+                if not enum_req:
+                    continue
+                features = get_required_features(enum_req)
+                for feature in features:
+                    self.postings.setdefault(feature, []).append(len(self.candidates))
+                self.candidates.append((enum_value, len(features)))
+
+    def find(self, classification):
+        """
+        Find the first enum value that classification matches.
+
+        Args:
+            classification (dict): The classification to match
+
+        Returns:
+            The matching enum value, or None if there is no match
+
+        Raises:
+            TypeError: If the classification can't be looked up, e.g. it has unhashable values
+        """
+        features = get_classification_features(classification)
+        if features in self._memo:
+            return self._memo[features]
+
+        counts = collections.Counter()
+        for feature in features:
+            for position in self.postings.get(feature, ()):
+                counts[position] += 1
+        matches = [position for position, count in counts.items() if count == self.candidates[position][1]]
+        result = self.candidates[min(matches)][0] if matches else None
+
+        if len(self._memo) >= self.MEMO_SIZE:
+            self._memo.clear()
+        self._memo[features] = result
+        return result
+
+def get_required_features(enum_req):
+    """
+    Get the features that a classification needs to match enum_req, like utils.dict_match.
+    """
+    features = set()
+    for key, val in enum_req.items():
+        features.add((key,))
+        for item in (val if isinstance(val, list) else [val]):
+            features.add((key, item))
+    return features
+
+def get_classification_features(classification):
+    """
+    Get the features of a classification. Keys with empty values are not present.
+
+    Raises:
+        TypeError: If the classification isn't a dict, or has unhashable values
+    """
+    if not isinstance(classification, dict):
+        raise TypeError('Classification is not a dict')
+    features = set()
+    for key, val in classification.items():
+        if not val:
+            continue
+        features.add((key,))
+        for item in (val if isinstance(val, list) else [val]):
+            features.add((key, item))
+    return frozenset(features)
+
 # add_properties(properties, obj, measurements)
 # Populates obj with properties defined in a namespace template
 # Adds each key in the properties list and sets the value to the value specified in 'default' attribute
@@ -77,12 +216,121 @@ def update_properties(properties, context, obj):
                         value = utils.process_string_template(auto_update['$value'], context)
                     else:
                         value = utils.dict_lookup(context, auto_update['$value'])
-                    obj[key] = utils.format_value(auto_update['$format'], value)
+                    obj[key] = utils.format_value(auto_update.get('_format', auto_update['$format']), value)
                 else:
                     obj[key] = utils.process_string_template(auto_update, context)
     return(obj)
 
 
+class PropertyPlan(object):
+    """
+    The properties of a template definition, compiled for add_properties and update_properties.
+
+    Args:
+        properties (dict): The properties of the template definition
+
+    Attributes:
+        defaults: The initial value of every property, in order. Properties
+            without a constant initial value are set after the defaults.
+        objects: The object properties without a default, which get a new dict each time
+        enums: The (key, property) pairs of properties whose value depends on the classification
+        auto_updates: The (key, string template, lookup path, format) of every auto_update property
+    """
+    def __init__(self, properties):
+        self.defaults = {}
+        self.objects = []
+        self.enums = []
+        self.auto_updates = []
+
+        for key in properties:
+            prop = properties[key]
+            proptype = prop["type"]
+            if proptype == "string":
+                if "enum" in prop:
+                    if key == 'Modality' and not prop.get('default', ''):
+                        self.defaults[key] = None
+                        self.enums.append((key, prop))
+                    else:
+                        self.defaults[key] = determine_enum(prop, key, None)
+                elif "default" in prop:
+                    self.defaults[key] = prop["default"]
+                else:
+                    self.defaults[key] = "default"
+
+                if "auto_update" in prop:
+                    self.auto_updates.append(self._compile_auto_update(key, prop["auto_update"]))
+            elif proptype == "object":
+                if 'default' in prop:
+                    self.defaults[key] = prop['default']
+                else:
+                    self.defaults[key] = None
+                    self.objects.append(key)
+            elif 'default' in prop:
+                self.defaults[key] = prop['default']
+
+    @staticmethod
+    def _compile_auto_update(key, auto_update):
+        if not isinstance(auto_update, dict):
+            return key, utils.compile_string_template(auto_update), None, None
+        value_format = auto_update.get('_format', auto_update.get('$format'))
+        if auto_update.get('$process'):
+            return key, utils.compile_string_template(auto_update['$value']), None, value_format
+        return key, None, auto_update['$value'].split('.'), value_format
+
+    def add_properties(self, obj, classification):
+        """
+        Populate obj with the initial value of every property, like add_properties.
+
+        Args:
+            obj (dict): The object to populate
+            classification (dict): The classification of the container
+
+        Returns:
+            dict: obj
+        """
+        obj.update(self.defaults)
+        for key in self.objects:
+            obj[key] = {}
+        for key, prop in self.enums:
+            obj[key] = determine_enum(prop, key, classification)
+        return obj
+
+    def update_properties(self, context, obj):
+        """
+        Update the auto_update properties of obj from context, like update_properties.
+
+        Args:
+            context (dict): The context of the container
+            obj (dict): The object to update
+
+        Returns:
+            dict: obj
+        """
+        for key, string_template, parts, value_format in self.auto_updates:
+            if parts is not None:
+                value = utils.dict_lookup_parts(context, parts)
+            else:
+                value = string_template.format(context)
+            if value_format is not None:
+                value = utils.format_value(value_format, value)
+            obj[key] = value
+        return obj
+
+def get_property_plan(templateDef):
+    """
+    Get the PropertyPlan of a template definition, compiling it on first use.
+
+    Args:
+        templateDef (dict): The template definition
+
+    Returns:
+        PropertyPlan: The compiled properties
+    """
+    if '_plan' not in templateDef:
+        templateDef['_plan'] = PropertyPlan(templateDef['properties'])
+    return templateDef['_plan']
+
+
 # process_matching_templates(context, template)
 # Accepts a context object that represents a Flywheel container and related parent containers
 # and looks for matching templates in namespace.
@@ -106,10 +354,8 @@ def process_matching_templates(context, template=templates.DEFAULT_TEMPLATE, upl
     if initial:
         # Do initial rule matching
         match = False
-        rules = template.rules
         # If matching on upload, test against upload_rules as well
-        if upload:
-            rules = rules + template.upload_rules
+        rules = template.get_candidate_rules(context, upload)
         for rule in rules:
             if rule.test(context):
                 print('matches template={0}'.format(rule.template))
@@ -123,7 +369,8 @@ def process_matching_templates(context, template=templates.DEFAULT_TEMPLATE, upl
 
                 obj = container['info'].get(namespace, {})
                 obj['template'] = rule.template
-                container['info'][namespace] = add_properties(templateDef['properties'], obj, container.get('classification'))
+                container['info'][namespace] = get_property_plan(templateDef).add_properties(obj,
+                        container.get('classification'))
                 if container_type in ['session', 'acquisition', 'file']:
                     obj['ignore'] = False
                 rule.initializeProperties(obj, context)
@@ -139,12 +386,12 @@ def process_matching_templates(context, template=templates.DEFAULT_TEMPLATE, upl
         if not templateDef:
             templateDef = template.definitions.get(container['info'][template.namespace]['template'])
         if templateDef:
-            data = update_properties(templateDef["properties"], context, {})
+            data = get_property_plan(templateDef).update_properties(context, {})
             container['info'][namespace].update(data)
 
     return container
 
-def process_resolvers(context, template=templates.DEFAULT_TEMPLATE):
+def process_resolvers(context, template=templates.DEFAULT_TEMPLATE, index_cache=None):
     """
     Perform second stage path resolution based on template rules
 
@@ -152,6 +399,7 @@ def process_resolvers(context, template=templates.DEFAULT_TEMPLATE):
         session (TreeNode): The session node to search within
         context (dict): The context to perform path resolution on
         template (Template): The template
+        index_cache (IndexCache): Optional cache of session indexes, shared across contexts
     """
     namespace = template.namespace
 
@@ -168,7 +416,7 @@ def process_resolvers(context, template=templates.DEFAULT_TEMPLATE):
 
     # Apply each resolver
     for resolver in resolvers:
-        resolver.resolve(context)
+        resolver.resolve(context, index_cache)
 
 
 def ensure_info_exists(context, template=templates.DEFAULT_TEMPLATE):
@@ -0,0 +1,342 @@
+"""
+Record and replay the Flywheel API calls of a run.
+
+While recording, every call made through the wrapped client is captured with
+its arguments, response (or error) and latency, and the cassette is written as
+gzipped JSON when the run ends. Downloaded files are stored in the cassette
+up to MAX_RECORDED_FILE_SIZE bytes, larger files only by their size.
+
+A ReplayClient serves a cassette in place of the Flywheel client, sleeping
+for the recorded latency of each call (optionally scaled), so a slow run on a
+real project can be reproduced and profiled offline.
+"""
+import base64
+import collections
+import copy
+import datetime
+import gzip
+import json
+import logging
+import numbers
+import os
+import threading
+import time
+
+import six
+from dateutil import parser as date_parser
+
+logger = logging.getLogger('bids-cassette')
+
+CASSETTE_VERSION = 1
+
+# Downloaded files larger than this are replayed as zero-filled files of the same size
+MAX_RECORDED_FILE_SIZE = 1024 * 1024
+
+# The chunk size used to write zero-filled files
+ZERO_CHUNK_SIZE = 64 * 1024
+
+class CassetteMissError(Exception):
+    """Raised when a replayed call was not recorded in the cassette"""
+    # Like a client error, so that the call is not retried
+    status = 404
+
+class ReplayApiException(Exception):
+    """A recorded error, replayed like flywheel.ApiException"""
+    def __init__(self, status=None, reason=None, message=None):
+        super(ReplayApiException, self).__init__(message or '({}) {}'.format(status, reason))
+        self.status = status
+        self.reason = reason
+
+class ReplayContainer(dict):
+    """
+    A replayed SDK model object.
+
+    Supports item access by '_id', attribute access and to_dict, like the
+    SDK models.
+    """
+    def __getitem__(self, key):
+        if key == '_id' and not dict.__contains__(self, key):
+            key = 'id'
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key == '_id' and not dict.__contains__(self, key):
+            key = 'id'
+        return dict.get(self, key, default)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def to_dict(self):
+        return copy.deepcopy(dict(self))
+
+class ReplayApiClient(object):
+    """Implements the serialization helper of the SDK api_client"""
+    def sanitize_for_serialization(self, obj):
+        if isinstance(obj, (datetime.datetime, datetime.date)):
+            return obj.isoformat()
+        if isinstance(obj, dict):
+            return dict((key, self.sanitize_for_serialization(val)) for key, val in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.sanitize_for_serialization(val) for val in obj)
+        return obj
+
+def encode(value):
+    """
+    Encode a call argument or response as JSON-compatible data.
+
+    SDK models are stored as their to_dict() and datetimes as ISO strings,
+    both tagged so that decode can restore them.
+    """
+    if isinstance(value, datetime.datetime):
+        return {'$datetime': value.isoformat()}
+    if hasattr(value, 'to_dict'):
+        return {'$model': encode(value.to_dict())}
+    if isinstance(value, dict):
+        return dict((str(key), encode(val)) for key, val in value.items())
+    if isinstance(value, (list, tuple)):
+        return [encode(val) for val in value]
+    if value is None or isinstance(value, (numbers.Number,) + six.string_types):
+        return value
+    return six.text_type(value)
+
+def decode(value):
+    """Restore data encoded by encode, with SDK models as ReplayContainers"""
+    if isinstance(value, dict):
+        if len(value) == 1 and '$datetime' in value:
+            return date_parser.parse(value['$datetime'])
+        if len(value) == 1 and '$model' in value:
+            return ReplayContainer(decode(value['$model']))
+        return dict((key, decode(val)) for key, val in value.items())
+    if isinstance(value, list):
+        return [decode(val) for val in value]
+    return value
+
+def get_call_args(name, args, kwargs):
+    """
+    Get the arguments that identify a call, encoded.
+
+    Local paths differ between runs, so the destination of downloads is
+    left out, and uploaded files are identified by their name.
+
+    Returns:
+        tuple: The encoded positional and keyword arguments
+    """
+    args = list(args)
+    kwargs = dict(kwargs)
+    dest_index = get_dest_index(name)
+    if dest_index is not None:
+        if len(args) > dest_index:
+            del args[dest_index:]
+        kwargs.pop('dest_file', None)
+    elif name.startswith('upload_file_to_'):
+        if len(args) > 1:
+            args[1] = os.path.basename(args[1])
+        if 'file' in kwargs:
+            kwargs['file'] = os.path.basename(kwargs['file'])
+    return encode(args), encode(kwargs)
+
+def get_call_key(name, args, kwargs):
+    """Get the key that a call with the encoded args is matched on"""
+    return json.dumps([name, args, kwargs], sort_keys=True)
+
+def get_dest_index(name):
+    """Get the position of the destination file argument of a download method, or None for other methods"""
+    if name.startswith('download_file_from_'):
+        return 2
+    if name.startswith('download_') and name.endswith('_file_zip_member'):
+        return 3
+    return None
+
+def get_dest_file(name, args, kwargs):
+    dest_index = get_dest_index(name)
+    return kwargs.get('dest_file', args[dest_index] if len(args) > dest_index else None)
+
+class RecordingClient(object):
+    """
+    Wraps a Flywheel client, recording every method call.
+
+    Args:
+        fw: Flywheel client
+        max_file_size (int): The largest downloaded file to store the content of
+
+    Attributes:
+        interactions (list): The recorded calls, in the order they completed
+    """
+    def __init__(self, fw, max_file_size=MAX_RECORDED_FILE_SIZE):
+        self._fw = fw
+        self._max_file_size = max_file_size
+        self._lock = threading.Lock()
+        self.interactions = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._fw, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            call_args, call_kwargs = get_call_args(name, args, kwargs)
+            interaction = {'method': name, 'args': call_args, 'kwargs': call_kwargs}
+            start = time.time()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as exc:
+                interaction['latency'] = time.time() - start
+                interaction['error'] = {'status': getattr(exc, 'status', None),
+                        'reason': encode(getattr(exc, 'reason', None)), 'message': six.text_type(exc)}
+                self._record(interaction)
+                raise
+            interaction['latency'] = time.time() - start
+            interaction['response'] = encode(result)
+            if get_dest_index(name) is not None:
+                interaction['file'] = self._get_file(get_dest_file(name, args, kwargs))
+            self._record(interaction)
+            return result
+
+        # Cache the wrapper, so later calls skip __getattr__
+        setattr(self, name, call)
+        return call
+
+    def _get_file(self, path):
+        size = os.path.getsize(path)
+        if size > self._max_file_size:
+            return {'size': size}
+        with open(path, 'rb') as f:
+            return {'size': size, 'content': base64.b64encode(f.read()).decode('ascii')}
+
+    def _record(self, interaction):
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def save(self, path):
+        """
+        Write the recorded calls to a cassette.
+
+        Args:
+            path (str): The path of the cassette
+        """
+        with self._lock:
+            cassette = {'version': CASSETTE_VERSION, 'interactions': list(self.interactions)}
+        with gzip.open(path, 'wb') as f:
+            f.write(json.dumps(cassette).encode('utf-8'))
+        logger.info('Recorded {} calls to {}'.format(len(cassette['interactions']), path))
+
+def load_cassette(path):
+    """
+    Load the calls recorded in a cassette.
+
+    Args:
+        path (str): The path of the cassette
+
+    Returns:
+        list: The recorded interactions
+    """
+    with gzip.open(path, 'rb') as f:
+        cassette = json.loads(f.read().decode('utf-8'))
+    if cassette.get('version') != CASSETTE_VERSION:
+        raise ValueError('Unsupported cassette version: {}'.format(cassette.get('version')))
+    return cassette['interactions']
+
+class ReplayClient(object):
+    """
+    Serves the calls recorded in a cassette, in place of the Flywheel client.
+
+    Calls are matched on their method and arguments. Repeated calls are served
+    the recorded responses in order, and the last one once they run out.
+
+    Args:
+        path (str): The path of the cassette
+        latency_scale (float): The factor to scale the recorded latency by, 0 to not sleep
+
+    Attributes:
+        calls (Counter): The number of calls made, by method name
+    """
+    def __init__(self, path, latency_scale=1.0):
+        self.api_client = ReplayApiClient()
+        self.latency_scale = latency_scale
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+        self._interactions = collections.defaultdict(collections.deque)
+        for interaction in load_cassette(path):
+            key = get_call_key(interaction['method'], interaction['args'], interaction['kwargs'])
+            self._interactions[key].append(interaction)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def call(*args, **kwargs):
+            return self._replay(name, args, kwargs)
+
+        setattr(self, name, call)
+        return call
+
+    def _next_interaction(self, name, args, kwargs):
+        key = get_call_key(name, *get_call_args(name, args, kwargs))
+        with self._lock:
+            self.calls[name] += 1
+            recorded = self._interactions.get(key)
+            if not recorded:
+                raise CassetteMissError('No recorded call to {} matches {}'.format(name, key))
+            if len(recorded) > 1:
+                return recorded.popleft()
+            return recorded[0]
+
+    def _replay(self, name, args, kwargs):
+        interaction = self._next_interaction(name, args, kwargs)
+        latency = interaction['latency'] * self.latency_scale
+        if latency > 0:
+            time.sleep(latency)
+
+        if 'error' in interaction:
+            raise ReplayApiException(**interaction['error'])
+        if 'file' in interaction:
+            write_file(get_dest_file(name, args, kwargs), interaction['file'])
+        return decode(interaction['response'])
+
+def write_file(path, recorded):
+    """Write a recorded download, or zeros of its size if the content was not stored"""
+    with open(path, 'wb') as f:
+        if 'content' in recorded:
+            f.write(base64.b64decode(recorded['content']))
+            return
+        remaining = recorded['size']
+        while remaining > 0:
+            chunk = min(remaining, ZERO_CHUNK_SIZE)
+            f.write(b'\0' * chunk)
+            remaining -= chunk
+
+class record(object):
+    """
+    Record the calls of a run, writing the cassette to path when it ends.
+
+    Usage:
+        with cassette.record(args.record, fw) as fw:
+            ...
+
+    Args:
+        path (str): The path of the cassette, or None to not record the run
+        fw: Flywheel client
+
+    Returns:
+        A context manager that produces the client to make calls with,
+        which is fw wrapped by a RecordingClient if the run is recorded
+    """
+    def __init__(self, path, fw):
+        self.path = path
+        self.fw = fw
+        self.client = None
+
+    def __enter__(self):
+        if not self.path:
+            return self.fw
+        self.client = RecordingClient(self.fw)
+        return self.client
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.client is not None:
+            self.client.save(self.path)
+        return False
@@ -0,0 +1,315 @@
+"""
+Opt-in profiling of the BIDS tools.
+
+Phases are marked in the code with profiling.phase(name). Unless a run is
+profiled with profile(), phase returns a shared no-op context, so marking
+phases costs next to nothing.
+
+While profiling, the wall and CPU time of each phase is recorded, as well as
+the number, latency and transferred bytes of every call made through the
+wrapped Flywheel client. The report is written as JSON when the run ends.
+"""
+import collections
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from .cassette import get_dest_file, get_dest_index
+
+logger = logging.getLogger('bids-profiler')
+
+# The upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# The profiler of the current run, if it is being profiled
+_profiler = None
+
+def get_cpu_time():
+    """Get the CPU time used by this process and its finished child processes, in seconds"""
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+def get_peak_rss():
+    """
+    Get the peak resident set size of this process and of its largest child process.
+
+    Returns:
+        tuple: The peak RSS of this process and of its children in bytes,
+            or None if it cannot be determined
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in bytes on macOS, and in kilobytes elsewhere
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+class NullPhase(object):
+    """The phase returned when the run is not profiled"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+NULL_PHASE = NullPhase()
+
+def phase(name):
+    """
+    Mark a phase of the run.
+
+    Usage:
+        with profiling.phase('match'):
+            ...
+
+    Args:
+        name (str): The name of the phase
+
+    Returns:
+        A context manager that records the time spent in the phase, if the run is profiled
+    """
+    if _profiler is None:
+        return NULL_PHASE
+    return Phase(_profiler, name)
+
+class Phase(object):
+    """
+    Records the wall and CPU time of a phase with its profiler.
+
+    Phases may be nested, in which case the time of the inner phase is also
+    counted in the outer phase.
+
+    Args:
+        profiler (Profiler): The profiler to record the phase with
+        name (str): The name of the phase
+    """
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.start = self.start_cpu = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self.start_cpu = get_cpu_time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.record_phase(self.name, time.time() - self.start, get_cpu_time() - self.start_cpu)
+        return False
+
+class Profiler(object):
+    """
+    Collects the phase timings and API call telemetry of a run.
+
+    Attributes:
+        phases (OrderedDict): The 'count', 'wall_time' and 'cpu_time' of each phase, in first-seen order
+        calls (dict): The telemetry of each client method, by name
+    """
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.calls = {}
+        self.start = time.time()
+        self.start_cpu = get_cpu_time()
+        self._lock = threading.Lock()
+
+    def record_phase(self, name, wall_time, cpu_time):
+        with self._lock:
+            stats = self.phases.get(name)
+            if stats is None:
+                stats = self.phases[name] = {'count': 0, 'wall_time': 0.0, 'cpu_time': 0.0}
+            stats['count'] += 1
+            stats['wall_time'] += wall_time
+            stats['cpu_time'] += cpu_time
+
+    def record_call(self, name, elapsed, failed=False, bytes_sent=0, bytes_received=0):
+        """
+        Record a single call to the client.
+
+        Args:
+            name (str): The client method that was called
+            elapsed (float): The latency of the call, in seconds
+            failed (bool): Whether the call raised an exception
+            bytes_sent (int): The number of bytes uploaded
+            bytes_received (int): The number of bytes downloaded
+        """
+        bucket = len(LATENCY_BUCKETS)
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if elapsed <= bound:
+                bucket = i
+                break
+
+        with self._lock:
+            stats = self.calls.get(name)
+            if stats is None:
+                stats = self.calls[name] = {'count': 0, 'errors': 0, 'total_time': 0.0, 'max_time': 0.0,
+                        'bytes_sent': 0, 'bytes_received': 0, 'histogram': [0] * (len(LATENCY_BUCKETS) + 1)}
+            stats['count'] += 1
+            stats['errors'] += int(failed)
+            stats['total_time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['bytes_sent'] += bytes_sent
+            stats['bytes_received'] += bytes_received
+            stats['histogram'][bucket] += 1
+
+    def wrap_client(self, fw):
+        """
+        Wrap a Flywheel client, so that calls made through it are recorded.
+
+        Args:
+            fw: Flywheel client
+
+        Returns:
+            ProfiledClient: The wrapped client
+        """
+        return ProfiledClient(fw, self)
+
+    def get_report(self):
+        """
+        Get the report of the run so far.
+
+        Returns:
+            dict: The run's wall and CPU time, peak RSS, phases and API calls
+        """
+        peak_rss, peak_rss_children = get_peak_rss()
+        with self._lock:
+            phases = collections.OrderedDict((name, dict(stats)) for name, stats in self.phases.items())
+            calls = collections.OrderedDict()
+            for name in sorted(self.calls):
+                stats = dict(self.calls[name])
+                histogram = collections.OrderedDict()
+                for bound, count in zip(LATENCY_BUCKETS + ('inf',), stats.pop('histogram')):
+                    histogram['le_{}'.format(bound)] = count
+                stats['latency_histogram'] = histogram
+                calls[name] = stats
+
+        return collections.OrderedDict([
+            ('wall_time', time.time() - self.start),
+            ('cpu_time', get_cpu_time() - self.start_cpu),
+            ('peak_rss', peak_rss),
+            ('peak_rss_children', peak_rss_children),
+            ('api_calls', sum(stats['count'] for stats in calls.values())),
+            ('bytes_sent', sum(stats['bytes_sent'] for stats in calls.values())),
+            ('bytes_received', sum(stats['bytes_received'] for stats in calls.values())),
+            ('phases', phases),
+            ('calls', calls)
+        ])
+
+    def write_report(self, path):
+        """
+        Write the report of the run to a JSON file.
+
+        Args:
+            path (str): The path of the report
+        """
+        with open(path, 'w') as f:
+            json.dump(self.get_report(), f, indent=2)
+        logger.info('Wrote profile to {}'.format(path))
+
+class ProfiledClient(object):
+    """
+    Wraps a Flywheel client, recording every method call with a profiler.
+
+    Uploaded and downloaded file sizes are counted as the bytes sent and
+    received, along with the JSON size of request bodies.
+
+    Args:
+        fw: Flywheel client
+        profiler (Profiler): The profiler to record calls with
+    """
+    def __init__(self, fw, profiler):
+        self._fw = fw
+        self._profiler = profiler
+
+    def __getattr__(self, name):
+        attr = getattr(self._fw, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        profiler = self._profiler
+        def call(*args, **kwargs):
+            start = time.time()
+            failed = True
+            try:
+                result = attr(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                elapsed = time.time() - start
+                bytes_sent, bytes_received = get_transferred_bytes(name, args, kwargs, failed)
+                profiler.record_call(name, elapsed, failed, bytes_sent, bytes_received)
+
+        # Cache the wrapper, so later calls skip __getattr__
+        setattr(self, name, call)
+        return call
+
+def get_transferred_bytes(name, args, kwargs, failed=False):
+    """
+    Estimate the bytes transferred by a client call.
+
+    Args:
+        name (str): The client method that was called
+        args (tuple): The positional arguments of the call
+        kwargs (dict): The keyword arguments of the call
+        failed (bool): Whether the call failed
+
+    Returns:
+        tuple: The number of bytes sent and received
+    """
+    bytes_sent = bytes_received = 0
+    if get_dest_index(name) is not None:
+        dest_file = get_dest_file(name, args, kwargs)
+        if not failed and dest_file and os.path.isfile(dest_file):
+            bytes_received = os.path.getsize(dest_file)
+    elif name.startswith('upload_file_to_'):
+        path = kwargs.get('file', args[1] if len(args) > 1 else None)
+        if path and os.path.isfile(path):
+            bytes_sent = os.path.getsize(path)
+
+    for value in list(args) + list(kwargs.values()):
+        if isinstance(value, (dict, list)):
+            bytes_sent += len(json.dumps(value, default=str))
+    return bytes_sent, bytes_received
+
+class profile(object):
+    """
+    Profile a run, writing the report to path when it ends.
+
+    Usage:
+        with profiling.profile(args.profile, fw) as fw:
+            ...
+
+    Args:
+        path (str): The path of the report, or None to not profile the run
+        fw: Flywheel client
+
+    Returns:
+        A context manager that produces the client to make calls with,
+        which is fw wrapped by the profiler if the run is profiled
+    """
+    def __init__(self, path, fw):
+        self.path = path
+        self.fw = fw
+        self.profiler = None
+
+    def __enter__(self):
+        global _profiler
+        if not self.path:
+            return self.fw
+        self.profiler = _profiler = Profiler()
+        return self.profiler.wrap_client(self.fw)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _profiler
+        if self.profiler is not None:
+            _profiler = None
+            self.profiler.write_report(self.path)
+        return False
@@ -1,8 +1,13 @@
 import collections
 import logging
-import copy
+import gzip
+import hashlib
+import json
+import os
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
+
 if __name__ == '__main__':
     import utils
 else:
@@ -10,6 +15,9 @@ else:
 
 logger = logging.getLogger('curate-bids')
 
+# Bump when the snapshot format changes, to invalidate existing snapshots
+SNAPSHOT_VERSION = 1
+
 class TreeNode(collections.MutableMapping):
     """
     Represents a single node (Project, Session, Acquisition or File) in
@@ -23,16 +31,16 @@ class TreeNode(collections.MutableMapping):
         type: The type of node
         data: The node data
         children: The children belonging to this node
-        original_info: The original value of the 'info' property
+        info_fingerprints: The fingerprints of the original 'info' property
     """
     def __init__(self, node_type, data):
         self.type = node_type
         self.data = data
         self.children = []
-   
-        # save a copy of original info object so we know when
-        # we need to do an update
-        self.original_info = copy.deepcopy(self.data.get('info'))
+
+        # save fingerprints of the original info object so we know when
+        # we need to do an update, without keeping a copy of it
+        self.info_fingerprints = get_info_fingerprints(self.data.get('info'))
 
     def is_dirty(self):
         """
@@ -41,8 +49,17 @@ class TreeNode(collections.MutableMapping):
         Returns:
             bool: True if info has been modified, False if it is unchanged
         """
-        info = self.data.get('info')
-        return info != self.original_info
+        return get_info_fingerprints(self.data.get('info')) != self.info_fingerprints
+
+    def get_info_changes(self):
+        """
+        Get the top-level keys of 'info' that have been modified.
+
+        Returns:
+            tuple: The set of keys that were added or changed, and the set of
+                keys that were removed
+        """
+        return compare_info_fingerprints(self.info_fingerprints, get_info_fingerprints(self.data.get('info')))
 
     def to_json(self):
         return {
@@ -51,46 +68,52 @@ class TreeNode(collections.MutableMapping):
             'children': [ x.to_json() for x in self.children ]
         }
 
-    @staticmethod
+    @classmethod
     def from_json(cls, data):
-        node = TreeNode(data['type'], data['data'])
+        node = cls(data['type'], data['data'])
         for child in data.get('children', []):
-            node.children.append(TreeNode.from_json(child))
+            node.children.append(cls.from_json(child))
         return node
 
     def context_iter(self, context=None):
         """
         Iterate the tree depth-first, producing a context for each node.
 
+        Each context is a Context layer holding the values of its node, on top
+        of the context of its parent node. Parent layers are shared, not copied,
+        and are not modified once they have been yielded.
+
         Args:
             context (dict): The parent context object
 
         Yields:
-            dict: The context object for this node
+            Context: The context object for this node
         """
-        if not context:
-            context = {'parent_container_type': None}
+        parent = Context(dict(context)) if context else None
+        parent_type = context.get('parent_container_type') if context else None
 
         # Depth-first walk down tree
-        context['container_type'] = self.type
-        context[self.type] = self
-        
-        # Bring subject to top-level of context
-        if self.type == 'session':
-            context['subject'] = self.data['subject']
-
-        # Additionally bring ext up if file
-        if self.type == 'file':
-            context['ext'] = utils.get_extension(self.data['name'])
-
-        # Yield the current context before processing children
-        yield context
-
-        context['parent_container_type'] = self.type
-        for child in self.children:
-            context_copy = context.copy()
-            for ctx in child.context_iter(context_copy):
-                yield ctx
+        stack = [(self, parent, parent_type)]
+        while stack:
+            node, parent, parent_type = stack.pop()
+            values = {
+                'container_type': node.type,
+                'parent_container_type': parent_type,
+                node.type: node
+            }
+            # Bring subject to top-level of context
+            if node.type == 'session':
+                values['subject'] = node.data['subject']
+            # Additionally bring ext up if file
+            if node.type == 'file':
+                values['ext'] = utils.get_extension(node.data['name'])
+
+            # Yield the current context before processing children
+            context = Context(values, parent)
+            yield context
+
+            for child in reversed(node.children):
+                stack.append((child, context, node.type))
 
     def __len__(self):
         return len(self.data)
@@ -113,6 +136,113 @@ class TreeNode(collections.MutableMapping):
     def __repr__(self):
         return repr(self.data)
 
+def get_info_fingerprints(info):
+    """
+    Compute a stable fingerprint of each top-level value of an info object.
+
+    Values are hashed in their canonical JSON form (sorted keys, no
+    whitespace), so equal values always have equal fingerprints.
+
+    Args:
+        info (dict): The info object
+
+    Returns:
+        dict: The SHA-1 digest and the size of the canonical JSON of each
+            top-level value, by key. A non-dict info is fingerprinted as a
+            whole, under the key None.
+    """
+    if not isinstance(info, dict):
+        return {None: _fingerprint(info)}
+    return dict((key, _fingerprint(value)) for key, value in info.items())
+
+def _fingerprint(value):
+    canonical = json.dumps(value, sort_keys=True, separators=(',', ':'), default=repr).encode('utf-8')
+    return hashlib.sha1(canonical).digest(), len(canonical)
+
+def compare_info_fingerprints(original, current):
+    """
+    Compare the fingerprints of two versions of an info object.
+
+    Args:
+        original (dict): The fingerprints of the original info, see get_info_fingerprints
+        current (dict): The fingerprints of the current info
+
+    Returns:
+        tuple: The set of keys that were added or changed, and the set of
+            keys that were removed
+    """
+    changed = set(key for key, value in current.items() if original.get(key) != value)
+    deleted = set(original) - set(current)
+    return changed, deleted
+
+class Context(collections.MutableMapping):
+    """
+    A layer of a traversal context, with lookups falling through to its parent.
+
+    Values set on a context only affect that context and the contexts of the
+    node's children, like setting a value on a copy of the parent context.
+
+    Args:
+        values (dict): The values of this layer
+        parent (Context): The parent layer, if any
+    """
+    __slots__ = ('values', 'parent')
+
+    def __init__(self, values, parent=None):
+        self.values = values
+        self.parent = parent
+
+    def __getitem__(self, key):
+        context = self
+        while context is not None:
+            values = context.values
+            if key in values:
+                return values[key]
+            context = context.parent
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        context = self
+        while context is not None:
+            if key in context.values:
+                return True
+            context = context.parent
+        return False
+
+    def get(self, key, default=None):
+        context = self
+        while context is not None:
+            values = context.values
+            if key in values:
+                return values[key]
+            context = context.parent
+        return default
+
+    def __setitem__(self, key, value):
+        self.values[key] = value
+
+    def __delitem__(self, key):
+        del self.values[key]
+
+    def __iter__(self):
+        seen = set()
+        context = self
+        while context is not None:
+            for key in context.values:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+            context = context.parent
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def copy(self):
+        return Context(dict(self.values), self.parent)
+
+    def __repr__(self):
+        return 'Context({})'.format(dict(self))
+
 def add_file_nodes(parent):
     """
     Add file nodes as children to parent.
@@ -123,57 +253,321 @@ def add_file_nodes(parent):
     for f in parent.get('files', []):
         parent.children.append(TreeNode('file', f))
 
-def get_project_tree(fw, project_id, session_id=None, session_only=False):
+def get_project_tree(fw, project_id, session_id=None, session_only=False, workers=1, cache_dir=None,
+        session_filter=None):
     """
     Construct a project tree from the given project_id.
 
+    Sessions and acquisitions are fetched concurrently when workers is
+    greater than 1. The resulting tree is identical to the serial fetch.
+
+    If cache_dir is given, the tree is refreshed from the last snapshot of the
+    project: only sessions and acquisitions whose modified timestamp changed
+    are fetched again. The refreshed tree is saved as the new snapshot, unless
+    session_filter left out any sessions.
+
     Args:
         fw: Flywheel client
         project_id (str): project id of project to curate
         session_id (str): Optional session_id if session_only
         session_only (bool): Set to true to only get session identified by session_id
+        workers (int): The number of concurrent requests to make while fetching
+        cache_dir (str): Optional directory to keep project snapshots in
+        session_filter (function): Optional predicate on the sessions as listed by the project,
+            sessions that it rejects are not fetched
 
     Returns:
         TreeNode: The project (root) tree node
     """
     if session_only and session_id:
         logger.info('Running in single session mode! (session_id={})'.format(session_id))
+        # Snapshots always contain the whole project
+        cache_dir = None
     elif session_only:
         logger.error('Session only was specified, but no session id was given!')
         sys.exit(1)
     else:
         session_id = None
 
+    snapshot = None
+    if cache_dir:
+        snapshot_path = get_snapshot_path(cache_dir, project_id)
+        snapshot = load_snapshot(snapshot_path, project_id)
+        if snapshot:
+            logger.info('Refreshing project from snapshot {}'.format(snapshot_path))
+
     # Get project
     logger.info('Getting project...')
+    project_node = get_project_node(fw, project_id)
+
+    # Get project sessions
+    project_sessions = get_project_sessions(fw, project_id, session_id)
+    # Snapshots always contain the whole project
+    is_whole_project = True
+    if session_filter is not None:
+        listed = len(project_sessions)
+        project_sessions = [proj_ses for proj_ses in project_sessions if session_filter(proj_ses)]
+        is_whole_project = len(project_sessions) == listed
+
+    if workers > 1:
+        logger.info('Fetching {} sessions with {} workers'.format(len(project_sessions), workers))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            add_session_nodes(fw, project_node, project_sessions, executor.map, snapshot=snapshot)
+    else:
+        add_session_nodes(fw, project_node, project_sessions, snapshot=snapshot)
+
+    if cache_dir and is_whole_project:
+        save_snapshot(project_node, snapshot_path)
+
+    return project_node
+
+def get_project_node(fw, project_id):
+    """
+    Fetch a project with its files, without its sessions.
+
+    Args:
+        fw: Flywheel client
+        project_id (str): The project id
+
+    Returns:
+        TreeNode: The project node
+    """
     project_data = to_dict(fw, fw.get_project(project_id))
     project_node = TreeNode('project', project_data)
     add_file_nodes(project_node)
+    return project_node
 
-    # Get project sessions
-    project_sessions = fw.get_project_sessions(project_id)
-    for proj_ses in project_sessions:
+def get_project_sessions(fw, project_id, session_id=None):
+    """
+    List the sessions of a project.
+
+    Args:
+        fw: Flywheel client
+        project_id (str): The project id
+        session_id (str): Optional id of the only session to list
+
+    Returns:
+        list: The sessions, as listed by the project
+    """
+    project_sessions = []
+    for proj_ses in fw.get_project_sessions(project_id):
         if session_id and session_id != proj_ses['_id']:
             continue
+        project_sessions.append(proj_ses)
+    return project_sessions
+
+def iter_session_nodes(fw, project_id, session_id=None, window=1):
+    """
+    Fetch the sessions of a project one at a time, in project order.
+
+    Up to window sessions (with their acquisitions) are fetched ahead in
+    background threads while the caller processes the current one, so only
+    window + 1 sessions are held in memory at once.
 
-        session_data = to_dict(fw, fw.get_session(proj_ses['_id']))
-        session_node = TreeNode('session', session_data)
-        add_file_nodes(session_node)
+    Args:
+        fw: Flywheel client
+        project_id (str): The project id
+        session_id (str): Optional id of the only session to fetch
+        window (int): The number of sessions to fetch ahead
+
+    Yields:
+        TreeNode: Each session node, with its acquisitions and files
+    """
+    def fetch_session(proj_ses):
+        session_node, acquisitions = get_session_node(fw, proj_ses)
+        for acq in acquisitions:
+            if not isinstance(acq, TreeNode):
+                acq = get_acquisition_node(fw, acq)
+            session_node.children.append(acq)
+        return session_node
+
+    project_sessions = get_project_sessions(fw, project_id, session_id)
+    if window < 1:
+        for proj_ses in project_sessions:
+            yield fetch_session(proj_ses)
+        return
+
+    with ThreadPoolExecutor(max_workers=window) as executor:
+        pending = collections.deque()
+        for proj_ses in project_sessions:
+            pending.append(executor.submit(fetch_session, proj_ses))
+            if len(pending) > window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+def add_session_nodes(fw, project_node, project_sessions, map_fn=map, snapshot=None):
+    """
+    Fetch sessions and their acquisitions, adding them as children to project_node.
+
+    Sessions are fetched first, then every acquisition of every session, so that
+    a bounded map_fn never waits on work that it has yet to schedule.
+
+    Args:
+        fw: Flywheel client
+        project_node (TreeNode): The project node
+        project_sessions (list): The sessions to fetch, as listed by the project
+        map_fn (function): The map implementation used to make requests
+        snapshot (TreeNode): Optional previous project tree to reuse unchanged nodes from
+    """
+    cached_sessions = {}
+    if snapshot is not None:
+        cached_sessions = dict((node['id'], node) for node in snapshot.children)
 
+    def fetch_session(proj_ses):
+        return get_session_node(fw, proj_ses, cached_sessions.get(proj_ses['_id']))
+    sessions = list(map_fn(fetch_session, project_sessions))
+
+    acquisition_ids = []
+    for session_node, acquisitions in sessions:
+        acquisition_ids.extend(acq for acq in acquisitions if not isinstance(acq, TreeNode))
+    acquisition_nodes = iter(map_fn(lambda aid: get_acquisition_node(fw, aid), acquisition_ids))
+
+    for session_node, acquisitions in sessions:
         project_node.children.append(session_node)
+        for acq in acquisitions:
+            if not isinstance(acq, TreeNode):
+                acq = next(acquisition_nodes)
+            session_node.children.append(acq)
 
-        # Get acquisitions within session
-        session_acqs = fw.get_session_acquisitions(proj_ses['_id'])
+def get_session_node(fw, proj_ses, cached=None):
+    """
+    Fetch a single session, without its acquisitions.
 
-        for ses_acq in sorted(session_acqs, key=AcquisitionSortKey):
-            # Get true acquisition, in order to access file info
-            acquisition_data = to_dict(fw, fw.get_acquisition(ses_acq['_id']))
-            acquisition_node = TreeNode('acquisition', acquisition_data)
-            add_file_nodes(acquisition_node)
+    If a cached session node is given, the session and any of its acquisitions
+    that have not been modified since are reused rather than fetched. So are
+    containers whose listing already includes their files (see is_listing_complete).
 
-            session_node.children.append(acquisition_node)
+    Args:
+        fw: Flywheel client
+        proj_ses: The session, as listed by the project
+        cached (TreeNode): Optional session node from a previous snapshot
 
-    return project_node
+    Returns:
+        tuple: The session TreeNode and the sorted list of its acquisitions,
+            either reused TreeNodes or the ids of acquisitions to fetch
+    """
+    session_id = proj_ses['_id']
+    if is_unmodified(fw, proj_ses, cached):
+        session_data = cached.data
+    elif is_listing_complete(proj_ses):
+        session_data = to_dict(fw, proj_ses)
+    else:
+        session_data = to_dict(fw, fw.get_session(session_id))
+    session_node = TreeNode('session', session_data)
+    add_file_nodes(session_node)
+
+    cached_acqs = {}
+    if cached is not None:
+        cached_acqs = dict((node['id'], node) for node in cached.children)
+
+    # Get acquisitions within session
+    acquisitions = []
+    for ses_acq in sorted(fw.get_session_acquisitions(session_id), key=AcquisitionSortKey):
+        cached_acq = cached_acqs.get(ses_acq['_id'])
+        if is_unmodified(fw, ses_acq, cached_acq):
+            acquisitions.append(cached_acq)
+        elif is_listing_complete(ses_acq):
+            acquisitions.append(get_listed_acquisition_node(fw, ses_acq))
+        else:
+            acquisitions.append(ses_acq['_id'])
+
+    return session_node, acquisitions
+
+def get_session_tree(fw, session, workers=1):
+    """
+    Build the tree of a single session that was already fetched, with its acquisitions.
+
+    Args:
+        fw: Flywheel client
+        session: The session, as returned by fw.get_session
+        workers (int): The number of concurrent requests to make while fetching acquisitions
+
+    Returns:
+        TreeNode: The session node
+    """
+    session_node = TreeNode('session', to_dict(fw, session))
+    add_file_nodes(session_node)
+
+    def get_node(ses_acq):
+        if is_listing_complete(ses_acq):
+            return get_listed_acquisition_node(fw, ses_acq)
+        return get_acquisition_node(fw, ses_acq['_id'])
+
+    session_acquisitions = sorted(fw.get_session_acquisitions(session_node['id']), key=AcquisitionSortKey)
+    if workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            session_node.children.extend(executor.map(get_node, session_acquisitions))
+    else:
+        session_node.children.extend(get_node(ses_acq) for ses_acq in session_acquisitions)
+    return session_node
+
+def is_listing_complete(listed):
+    """
+    Check whether a listed container includes everything that fetching it would return.
+
+    Listings that include the container's info, and its files with their
+    info, are used as is rather than fetching the container again.
+
+    Args:
+        listed: The container as returned by a listing call
+
+    Returns:
+        bool: True if the listing includes the info of the container and its files
+    """
+    files = listed.get('files')
+    if listed.get('info') is None or files is None:
+        return False
+    return all(f.get('info') is not None for f in files)
+
+def is_unmodified(fw, listed, cached):
+    """
+    Check whether a cached node is still current.
+
+    Args:
+        fw: Flywheel client
+        listed: The container as returned by a listing call
+        cached (TreeNode): The cached node, or None
+
+    Returns:
+        bool: True if the cached node has the same modified timestamp
+    """
+    if cached is None:
+        return False
+    modified = fw.api_client.sanitize_for_serialization(listed.get('modified'))
+    return modified is not None and modified == cached.get('modified')
+
+def get_acquisition_node(fw, acquisition_id):
+    """
+    Fetch a single acquisition with its files.
+
+    Args:
+        fw: Flywheel client
+        acquisition_id (str): The acquisition id
+
+    Returns:
+        TreeNode: The acquisition node
+    """
+    # Get true acquisition, in order to access file info
+    acquisition_data = to_dict(fw, fw.get_acquisition(acquisition_id))
+    acquisition_node = TreeNode('acquisition', acquisition_data)
+    add_file_nodes(acquisition_node)
+    return acquisition_node
+
+def get_listed_acquisition_node(fw, ses_acq):
+    """
+    Build the node of an acquisition from its complete listing, see is_listing_complete.
+
+    Args:
+        fw: Flywheel client
+        ses_acq: The acquisition, as listed by its session
+
+    Returns:
+        TreeNode: The acquisition node
+    """
+    acquisition_node = TreeNode('acquisition', to_dict(fw, ses_acq))
+    add_file_nodes(acquisition_node)
+    return acquisition_node
 
 class AcquisitionSortKey(object):
     def __init__(self, acq, **args):
@@ -200,16 +594,69 @@ class AcquisitionSortKey(object):
 def to_dict(fw, obj):
     return fw.api_client.sanitize_for_serialization(obj.to_dict())
 
+def get_snapshot_path(cache_dir, project_id):
+    return os.path.join(cache_dir, 'project-{}.json.gz'.format(project_id))
+
+def save_snapshot(project_node, path):
+    """
+    Save a project tree snapshot, replacing any previous snapshot atomically.
+
+    Args:
+        project_node (TreeNode): The project (root) tree node
+        path (str): The snapshot file path
+    """
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'project_id': project_node['id'],
+        'tree': project_node.to_json()
+    }
+    tmp_path = path + '.tmp'
+    with gzip.open(tmp_path, 'wb') as f:
+        f.write(json.dumps(snapshot).encode('utf-8'))
+    os.rename(tmp_path, path)
+
+def load_snapshot(path, project_id):
+    """
+    Load a project tree snapshot.
+
+    Args:
+        path (str): The snapshot file path
+        project_id (str): The expected project id
+
+    Returns:
+        TreeNode: The project tree, or None if there is no usable snapshot
+    """
+    if not os.path.isfile(path):
+        return None
+
+    try:
+        with gzip.open(path, 'rb') as f:
+            snapshot = json.loads(f.read().decode('utf-8'))
+    except (IOError, ValueError) as exc:
+        logger.warning('Ignoring unreadable snapshot {}: {}'.format(path, exc))
+        return None
+
+    if snapshot.get('version') != SNAPSHOT_VERSION or snapshot.get('project_id') != project_id:
+        logger.info('Ignoring outdated snapshot {}'.format(path))
+        return None
+
+    return TreeNode.from_json(snapshot['tree'])
+
 if __name__ == '__main__':
     import argparse
     import flywheel
-    import json
 
     parser = argparse.ArgumentParser(description='Dump project tree to json')
     parser.add_argument('--api-key', dest='api_key', action='store',
             required=True, help='API key')
     parser.add_argument('-p', dest='project_label', action='store',
             required=False, default=None, help='Project Label on Flywheel instance')
+    parser.add_argument('--workers', dest='workers', action='store', type=int,
+            default=1, help='Number of concurrent requests to make while fetching')
     parser.add_argument('output_file', help='The output file destination')
 
     args = parser.parse_args()
@@ -217,7 +664,7 @@ if __name__ == '__main__':
     fw = flywheel.Flywheel(args.api_key)
     project_id = utils.validate_project_label(fw, args.project_label)
 
-    project_tree = get_project_tree(fw, project_id)
+    project_tree = get_project_tree(fw, project_id, workers=args.workers)
 
     with open(args.output_file, 'w') as f:
         json.dump(project_tree.to_json(), f, indent=2)
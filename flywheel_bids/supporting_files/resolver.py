@@ -66,12 +66,13 @@ class Resolver:
         if self.format and self.value:
             print('WARNING: Because "format" is specified, "value" will be ignored for resolver: {}'.format(self.id))
 
-    def resolve(self, context):
+    def resolve(self, context, index_cache=None):
         """
         Resolve update_field for context by matching and formatting children of session.
 
         Args:
             context (dict): The context to update
+            index_cache (IndexCache): Optional cache of context indexes to match with
         """
         results = []
 
@@ -93,19 +94,160 @@ class Resolver:
                 fields[key] = v
             filters.append(Filter(fields))
 
+        if index_cache is not None:
+            index = index_cache.get(parent)
+        else:
+            index = ContextIndex(parent)
+
         # Iterate through the contexts in the session, collecting matches
-        for ctx in parent.context_iter():
-            for filt in filters:
-                if filt.test(ctx):
-                    if self.format:
-                        results.append(utils.process_string_template(self.format, ctx))
-                    elif self.value:
-                        value = utils.dict_lookup(ctx, self.value, None)
-                        if value:
-                            if results and results != value:
-                                print('WARNING: multiple different matches when resolving results, will take last match!')
-                            results = value
+        for ctx, filt in index.find(filters):
+            if self.format:
+                results.append(utils.process_string_template(self.format, ctx))
+            elif self.value:
+                value = utils.dict_lookup(ctx, self.value, None)
+                if value:
+                    if results and results != value:
+                        print('WARNING: multiple different matches when resolving results, will take last match!')
+                    results = value
         
         # Finally update the field specified
         utils.dict_set(context, self.update_field, results)
+        if index_cache is not None:
+            index_cache.field_updated(self.update_field, context)
     
+
+
+class ContextIndex(object):
+    """
+    Index of the contexts under a node, for answering resolver filters by lookup.
+
+    Contexts are kept in traversal order when the index is built. Field
+    values are indexed on first use, and candidates found by lookup are always
+    confirmed with Filter.test, so matches are identical to a full scan.
+
+    Args:
+        node (TreeNode): The node (e.g. session) whose contexts to index
+
+    Attributes:
+        contexts: The contexts under node, in context_iter order
+    """
+    def __init__(self, node):
+        self.contexts = list(node.context_iter())
+        self.fields = {}
+
+    def find(self, filters):
+        """
+        Find the contexts matching any of filters.
+
+        Args:
+            filters (list(Filter)): The filters to match
+
+        Returns:
+            list: (context, filter) pairs in traversal order, and in filter
+                order for contexts that match more than one filter
+        """
+        matches = [self._candidates(filt) for filt in filters]
+        results = []
+        for i in sorted(set().union(*matches)):
+            ctx = self.contexts[i]
+            for filt, candidates in zip(filters, matches):
+                if i in candidates and filt.test(ctx):
+                    results.append((ctx, filt))
+        return results
+
+    def invalidate(self, field=None):
+        """
+        Drop the index of field (or of every field), after values have changed.
+        """
+        if field is None:
+            self.fields = {}
+        else:
+            self.fields.pop(field, None)
+
+    def _candidates(self, filt):
+        candidates = None
+        for prop, filter_value in filt.fields.items():
+            positions = self._lookup(prop, filter_value)
+            if positions is None:
+                continue
+            candidates = positions if candidates is None else candidates & positions
+            if not candidates:
+                break
+        if candidates is None:
+            return set(range(len(self.contexts)))
+        return candidates
+
+    def _lookup(self, prop, filter_value):
+        """
+        Get the positions of contexts whose prop may equal (one of) filter_value.
+
+        Returns None if the values cannot be looked up.
+        """
+        values = filter_value if isinstance(filter_value, list) else [filter_value]
+        field_index = self._get_field_index(prop)
+        positions = set(field_index['unhashable'])
+        for value in values:
+            try:
+                positions.update(field_index['values'].get(value, ()))
+            except TypeError:
+                return None
+        return positions
+
+    def _get_field_index(self, prop):
+        field_index = self.fields.get(prop)
+        if field_index is None:
+            field_index = {'values': {}, 'unhashable': []}
+            for i, ctx in enumerate(self.contexts):
+                value = utils.dict_lookup(ctx, prop)
+                try:
+                    field_index['values'].setdefault(value, []).append(i)
+                except TypeError:
+                    field_index['unhashable'].append(i)
+            self.fields[prop] = field_index
+        return field_index
+
+
+class IndexCache(object):
+    """
+    Builds a ContextIndex once per node, for resolving many contexts in one pass.
+
+    Only the index of the last node of each type is kept. Contexts are
+    resolved in traversal order, so once the next session is indexed, the
+    previous session's index is no longer needed and is dropped.
+
+    Attributes:
+        indexes (dict): The (node, ContextIndex) of the current node, by node type
+    """
+    def __init__(self):
+        self.indexes = {}
+
+    def get(self, node):
+        """
+        Get the index of node, building it on first use.
+
+        Args:
+            node (TreeNode): The node to index
+
+        Returns:
+            ContextIndex: The index of node
+        """
+        entry = self.indexes.get(node.type)
+        if entry is None or entry[0] is not node:
+            entry = (node, ContextIndex(node))
+            self.indexes[node.type] = entry
+        return entry[1]
+
+    def field_updated(self, field, context=None):
+        """
+        Invalidate indexed fields that field may have changed.
+
+        Args:
+            field (str): The path of the updated field
+            context (dict): The updated context, only the indexes of its ancestors are invalidated
+        """
+        for node, index in self.indexes.values():
+            if context is not None and context.get(node.type) is not node:
+                continue
+            for prop in list(index.fields):
+                if prop.startswith(field) or field.startswith(prop):
+                    index.invalidate(prop)
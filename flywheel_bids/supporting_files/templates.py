@@ -1,13 +1,29 @@
 import os, os.path, json, re
-import jsonschema
+import collections
+import copy
+import hashlib
+import logging
+import stat
+import sys
+import threading
+
 import six
+from six.moves import cPickle as pickle
 
 from . import utils
 from . import resolver
 
 DEFAULT_TEMPLATE_NAME = 'bids-v1'
 BIDS_TEMPLATE_NAME = 'bids-v1'
-DEFAULT_TEMPLATES = {}
+
+logger = logging.getLogger('bids-templates')
+
+# The directory to cache compiled templates in, templates are not cached by default.
+# Cached templates are pickles, so directories that other users can write to are not used.
+TEMPLATE_CACHE_DIR = os.environ.get('BIDS_TEMPLATE_CACHE_DIR') or None
+
+# The number of compiled templates to keep in the cache, the least recently used are removed
+MAX_CACHED_TEMPLATES = 32
 
 class Template:
     """
@@ -24,6 +40,7 @@ class Template:
         rules (list): The list of if rules for applying templates.
         extends (string): The optional name of the template to extend.
         exclude_rules (list): The optional list of rules to exclude from a parent template.
+        content_hash (str): The hash of the template file, if it was loaded from a file.
     """
     def __init__(self, data, templates=None):
         if data:
@@ -40,11 +57,14 @@ class Template:
         else:
             raise Exception("data is required")
 
-        if templates:
+        if self.extends and templates:
             self.do_extend(templates)
 
+        # jsonschema is slow to import, and cached templates don't need it
+        import jsonschema
         resolver = jsonschema.RefResolver.from_schema({'definitions': self.definitions})
         self.resolve_refs(resolver, self.definitions)
+        self.compile_formats()
         self.compile_resolvers()
         self.compile_rules()
         self.compile_custom_initializers()
@@ -97,6 +117,39 @@ class Template:
             if not isinstance(upload_rule, Rule):
                 self.upload_rules[i] = Rule(upload_rule)
 
+        # Candidate rules by (container_type, parent_container_type, upload)
+        self.rule_index = {}
+
+    def get_candidate_rules(self, context, upload=False):
+        """
+        Get the rules that could match the given context, in order.
+
+        Rules that require a different container_type or parent_container_type
+        than the context has are excluded, without evaluating them.
+
+        Args:
+            context (dict): The context to match
+            upload (bool): Whether or not to include upload_rules
+
+        Returns:
+            list(Rule): The candidate rules, in matching order
+        """
+        key = (context.get('container_type'), context.get('parent_container_type'), upload)
+        rules = self.rule_index.get(key)
+        if rules is None:
+            rules = self.rules + self.upload_rules if upload else self.rules
+            rules = [rule for rule in rules if rule.may_match(key[0], key[1])]
+            self.rule_index[key] = rules
+        return rules
+
+    def compile_formats(self):
+        """
+        Compile every "$format" parameter list of definitions and initializers into a ValueFormat
+        """
+        initializers = [rule.initialize if isinstance(rule, Rule) else rule.get('initialize')
+                        for rule in self.rules + self.upload_rules]
+        compile_value_formats([self.definitions, initializers, self.custom_initializers])
+
     def compile_resolvers(self):
         """
         Walk through the definitions
@@ -123,6 +176,8 @@ class Template:
             if not rule:
                 continue
             del init['rule']
+            if 'where' in init:
+                init['_where'] = WhereClause(init['where'])
             if rule not in self.initializer_map:
                 self.initializer_map[rule] = []
             self.initializer_map[rule].append(init)
@@ -138,8 +193,8 @@ class Template:
         """
         if rule_id in self.initializer_map:
             for init in self.initializer_map[rule_id]:
-                if 'where' in init:
-                    if not test_where_clause(init['where'], context):
+                if '_where' in init:
+                    if not init['_where'].test(context):
                         continue
 
                 apply_initializers(init['initialize'], info, context)
@@ -156,6 +211,7 @@ class Template:
             list(string): A list of validation errors if invalid, otherwise an empty list.
         """
         if '_validator' not in templateDef:
+            import jsonschema
             templateDef['_validator'] = jsonschema.Draft4Validator(templateDef)
 
         return list(sorted(templateDef['_validator'].iter_errors(info), key=str))
@@ -203,6 +259,7 @@ class Rule:
         self.conditions = data.get('where')
         if not self.conditions:
             raise Exception('"where" field is required!')
+        self.where = WhereClause(self.conditions)
 
     def test(self, context):
         """
@@ -214,7 +271,25 @@ class Rule:
         Returns:
             bool: True if the rule matches the given context.
         """
-        return test_where_clause(self.conditions, context)
+        return self.where.test(context)
+
+    def may_match(self, container_type, parent_container_type):
+        """
+        Check if this rule could match a context with the given container types.
+
+        Args:
+            container_type (str): The container_type of the context
+            parent_container_type (str): The parent_container_type of the context
+
+        Returns:
+            bool: False if the rule requires different container types.
+        """
+        for field, actual in (('container_type', container_type),
+                              ('parent_container_type', parent_container_type)):
+            expected = self.where.get_constant(field)
+            if expected is not None and actual != expected:
+                return False
+        return True
 
     def initializeProperties(self, info, context):
         """
@@ -269,7 +344,8 @@ def apply_initializers(initializers, info, context):
                             resolvedValue = value
 
                         if '$format' in valueSpec and resolvedValue:
-                            resolvedValue = utils.format_value(valueSpec['$format'], resolvedValue)
+                            resolvedValue = utils.format_value(valueSpec.get('_format', valueSpec['$format']),
+                                    resolvedValue)
 
                         if resolvedValue:
                             break
@@ -280,6 +356,22 @@ def apply_initializers(initializers, info, context):
             info[propName] = resolvedValue
 
 
+def compile_value_formats(obj):
+    """
+    Add the compiled ValueFormat of every "$format" parameter list in obj as "_format".
+
+    Args:
+        obj (object): The template object to walk
+    """
+    if isinstance(obj, dict):
+        if isinstance(obj.get('$format'), list) and '_format' not in obj:
+            obj['_format'] = utils.ValueFormat(obj['$format'])
+        for value in obj.values():
+            compile_value_formats(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            compile_value_formats(value)
+
 def handle_switch_initializer(switchDef, context):
     value = utils.dict_lookup(context, switchDef['$on'])
     if isinstance(value, list):
@@ -323,37 +415,70 @@ def test_where_clause(conditions, context):
     Returns:
         bool: True if the rule matches the given context.
     """
+    return WhereClause(conditions).test(context)
+
+def get_sub_clauses(clauses):
+    """
+    Get the where clauses of an "$or"/"$and" clause.
+
+    Clauses are given either as a list of where clauses (all fields of which
+    must match), or as a list of [field, match] pairs.
+
+    Args:
+        clauses (list): The clause list
+
+    Returns:
+        list(dict): The where clauses, in order
+    """
+    result = []
+    for clause in clauses:
+        if isinstance(clause, dict):
+            result.append(clause)
+        else:
+            field, match = clause
+            result.append({field: match})
+    return result
+
+def match_conditions(conditions, context):
+    """
+    Interpret a where clause against a context, without compiling it.
 
+    Args:
+        conditions (dict): The where clause
+        context (dict): The context
+
+    Returns:
+        bool: True if every field matches.
+    """
     for field, match in conditions.items():
         value = utils.dict_lookup(context, field)
-        if not processValueMatch(value, match, field):
+        if not processValueMatch(value, match, field, context):
             return False
-
     return True
 
-def processValueMatch(value, match, condition=None):
+def processValueMatch(value, match, condition=None, context=None):
     """
     Helper function that recursively performs value matching.
     Args:
         value: The value to match
         match: The matching rule
+        condition: The field name, or "$or"/"$and" for clauses at top-level
+        context (dict): The context, required to evaluate "$or"/"$and" clauses
     Returns:
         bool: The result of matching the value against the match spec.
     """
     if condition:
         # Handle $or clauses at top-level
         if condition == "$or":
-            for field, deeper_match in match:
-                value = utils.dict_lookup(context, field)
-                if processValueMatch(value, deeper_match):
+            for clause in get_sub_clauses(match):
+                if match_conditions(clause, context):
                     return True
             return False
 
         # Otherwise AND clauses
         if condition == "$and":
-            for field, deeper_match in match:
-                value = utils.dict_lookup(context, field)
-                if not processValueMatch(value, deeper_match):
+            for clause in get_sub_clauses(match):
+                if not match_conditions(clause, context):
                     return False
             return True
 
@@ -402,12 +527,223 @@ def processValueMatch(value, match, condition=None):
         return value == match
 
 
-def loadTemplates(templates_dir=None):
+class WhereClause(object):
+    """
+    A where clause, compiled into field matchers with pre-split paths.
+
+    Args:
+        conditions (dict): The mapping of context paths to match specifications
+
+    Attributes:
+        conditions (dict): The original conditions
+        matchers (list): The compiled field matchers, all of which must match,
+            ordered by cost
+        cost (int): The estimated cost of testing the whole clause
+    """
+    def __init__(self, conditions):
+        self.conditions = conditions
+        matchers = []
+        for field, match in conditions.items():
+            if field == '$or':
+                matchers.append(OrClause(match))
+            elif field == '$and':
+                matchers.append(AndClause(match))
+            else:
+                matchers.append(FieldMatcher(field, match))
+        # Run the cheapest tests first, so that most contexts are rejected early
+        self.matchers = sorted(matchers, key=lambda matcher: matcher.cost)
+        self.cost = sum(matcher.cost for matcher in self.matchers)
+
+    def get_constant(self, field):
+        """
+        Get the literal string that field must equal for this clause to match.
+
+        Args:
+            field (str): The context path
+
+        Returns:
+            str: The required value, or None if field is not matched literally
+        """
+        match = self.conditions.get(field)
+        if isinstance(match, six.string_types):
+            return match
+        return None
+
+    def test(self, context):
+        """
+        Test if the given context matches this clause.
+
+        Args:
+            context (dict): The context, which includes the hierarchy and current container
+
+        Returns:
+            bool: True if every field matches.
+        """
+        for matcher in self.matchers:
+            if not matcher.test(context):
+                return False
+        return True
+
+class FieldMatcher(object):
+    """
+    Matches the value at a context path against a compiled match specification.
+
+    Args:
+        field (str): The dotted context path
+        match: The match specification
+    """
+    def __init__(self, field, match):
+        self.field = field
+        self.parts = field.split('.')
+        self.value_match = compile_value_match(match)
+        self.cost = len(self.parts) + self.value_match.cost
+
+    def test(self, context):
+        return self.value_match.test(utils.dict_lookup_parts(context, self.parts))
+
+class OrClause(object):
+    """
+    Matches if any of the given where clauses matches, cheapest first.
+
+    Args:
+        clauses (list): The where clauses, or [field, match] pairs
+    """
+    def __init__(self, clauses):
+        self.clauses = sorted([WhereClause(clause) for clause in get_sub_clauses(clauses)],
+                key=lambda clause: clause.cost)
+        self.cost = sum(clause.cost for clause in self.clauses)
+
+    def test(self, context):
+        for clause in self.clauses:
+            if clause.test(context):
+                return True
+        return False
+
+class AndClause(OrClause):
+    """
+    Matches if all of the given where clauses match, cheapest first.
+
+    Args:
+        clauses (list): The where clauses, or [field, match] pairs
+    """
+    def test(self, context):
+        for clause in self.clauses:
+            if not clause.test(context):
+                return False
+        return True
+
+def compile_value_match(match):
+    """
+    Compile a match specification, equivalent to processValueMatch.
+
+    Args:
+        match: The matching rule
+
+    Returns:
+        An object whose test(value) method performs the match
+    """
+    if isinstance(match, dict):
+        if '$in' in match:
+            return InMatch(match['$in'])
+        elif '$not' in match:
+            return NotMatch(match['$not'])
+        elif '$regex' in match:
+            return RegexMatch(match['$regex'])
+        return NeverMatch()
+    return EqualsMatch(match)
+
+# Relative costs of value matchers, used to order tests
+class EqualsMatch(object):
+    cost = 1
+
+    def __init__(self, expected):
+        self.expected = expected
+
+    def test(self, value):
+        if isinstance(value, list):
+            for item in value:
+                if item == self.expected:
+                    return True
+            return False
+
+        return value == self.expected
+
+class InMatch(object):
+    cost = 2
+
+    def __init__(self, items):
+        self.items = items
+        # Use a set for membership tests, unless items are not hashable
+        self.item_set = None
+        if isinstance(items, (list, tuple)):
+            try:
+                self.item_set = frozenset(items)
+            except TypeError:
+                pass
+
+    def contains(self, value):
+        if self.item_set is not None:
+            try:
+                return value in self.item_set
+            except TypeError:
+                pass
+        return value in self.items
+
+    def test(self, value):
+        # Check if value is in list
+        if isinstance(value, list):
+            for item in value:
+                if self.contains(item):
+                    return True
+            return False
+        elif isinstance(value, six.string_types):
+            for item in self.items:
+                if item in value:
+                    return True
+            return False
+
+        return self.contains(value)
+
+class NotMatch(object):
+    def __init__(self, match):
+        self.match = compile_value_match(match)
+        self.cost = self.match.cost
+
+    def test(self, value):
+        # Negate result of nested match
+        return not self.match.test(value)
+
+class RegexMatch(object):
+    cost = 5
+
+    def __init__(self, pattern):
+        self.regex = re.compile(pattern)
+
+    def test(self, value):
+        if isinstance(value, list):
+            for item in value:
+                if self.regex.search(item) is not None:
+                    return True
+
+            return False
+        if value is None:
+            return False
+        return self.regex.search(value) is not None
+
+class NeverMatch(object):
+    cost = 0
+
+    def test(self, value):
+        return None
+
+
+def loadTemplates(templates_dir=None, templates=None):
     """
     Load all templates in the given (or default) directory
 
     Args:
         templates_dir (string): The optional directory to load templates from.
+        templates (dict): The mapping of template names to templates that may be extended.
     """
     results = {}
 
@@ -420,31 +756,316 @@ def loadTemplates(templates_dir=None):
         path = os.path.join(templates_dir, fname)
         name, ext = os.path.splitext(fname)
         if ext == '.json' and os.path.isfile(path):
-            results[name] = loadTemplate(path)
+            results[name] = loadTemplate(path, templates)
 
     return results
 
-def loadTemplate(path, templates=None):
+def loadTemplate(path, templates=None, cache_dir=None):
     """
     Load the template at path
 
+    If a cache_dir is given, compiled templates are cached in it, keyed by the
+    content of the template file (and of this code), so that a template is
+    only compiled the first time that it is loaded.
+
     Args:
         path (str): The path to the template to load
         templates (dict): The mapping of template names to template defintions.
+        cache_dir (str): The directory to cache compiled templates in, default is TEMPLATE_CACHE_DIR.
+            It is created if needed, and not used if other users can write to it.
     Returns:
         Template: The template that was loaded (otherwise throws)
     """
-    with open(path, 'r') as f:
-        data = json.load(f)
-
-    data = utils.normalize_strings(data)
+    with open(path, 'rb') as f:
+        content = f.read()
 
     if templates is None:
         templates = DEFAULT_TEMPLATES
+    if cache_dir is None:
+        cache_dir = TEMPLATE_CACHE_DIR
+
+    content_hash = hashlib.sha1(content).hexdigest()
+    cache_path = None
+    if cache_dir and ensure_private_dir(cache_dir):
+        cache_path = os.path.join(cache_dir, get_template_cache_key(content_hash) + '.pickle')
+        template = load_cached_template(cache_path, templates)
+        if template is not None:
+            return template
+
+    data = json.loads(content.decode('utf-8'))
+
+    data = utils.normalize_strings(data)
+
+    template = Template(data, templates)
+    template.content_hash = content_hash
+    if cache_path:
+        save_cached_template(cache_path, template, templates)
+        prune_template_cache(cache_dir)
+    return template
+
+def is_private(path):
+    """
+    Check that a file or directory is owned by the current user, and that no one else can write to it.
+
+    Ownership can't be checked on Windows, where this only checks that path exists.
+    """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    if not hasattr(os, 'getuid'):
+        return True
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def ensure_private_dir(path):
+    """
+    Create a directory that only the current user can access, if it doesn't exist.
+
+    Returns:
+        bool: True if the directory is private, otherwise False (and a warning is logged)
+    """
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path, 0o700)
+        except OSError:
+            # The cache is optional, e.g. the parent directory may be read-only
+            if not os.path.isdir(path):
+                return False
+    if not is_private(path):
+        logger.warning('Not caching templates in {}, it is not owned by the current user '
+                'or can be written to by others'.format(path))
+        return False
+    return True
+
+# The version of the code that compiles templates, computed on first use
+_code_version = None
 
-    return Template(data, templates)
+def get_code_version():
+    """
+    Get the version of the code that compiles templates.
+
+    Returns:
+        str: The code version, see get_source_version
+    """
+    global _code_version
+    if _code_version is None:
+        _code_version = get_source_version((sys.modules[__name__], utils, resolver))
+    return _code_version
+
+def get_source_version(modules):
+    """
+    Get the version of the source code of modules.
 
-DEFAULT_TEMPLATES = loadTemplates()
-DEFAULT_TEMPLATE = DEFAULT_TEMPLATES.get(DEFAULT_TEMPLATE_NAME)
-BIDS_TEMPLATE = DEFAULT_TEMPLATES.get(BIDS_TEMPLATE_NAME)
+    This is the hash of the python version and the sources of the modules. If
+    the sources can't be read (e.g. only .pyc files are installed), the
+    version of the installed package is used instead.
 
+    Args:
+        modules (list): The modules
+
+    Returns:
+        str: The hex digest of the version
+    """
+    try:
+        sources = []
+        for module in modules:
+            with open(os.path.splitext(module.__file__)[0] + '.py', 'rb') as f:
+                sources.append(f.read())
+    except (AttributeError, IOError, OSError):
+        sources = [get_package_version().encode('utf-8')]
+    code_hash = hashlib.sha1('{}.{}'.format(*sys.version_info[:2]).encode('utf-8'))
+    for source in sources:
+        code_hash.update(source)
+    return code_hash.hexdigest()
+
+def get_package_version():
+    """Get the installed version of flywheel-bids, or 'unknown' if it isn't installed"""
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('flywheel-bids').version
+    except Exception:
+        return 'unknown'
+
+def get_template_cache_key(content_hash):
+    """
+    Get the key of a compiled template in the cache.
+
+    Args:
+        content_hash (str): The hash of the content of the template file, see Template.content_hash
+
+    Returns:
+        str: The hash of the content, the code that compiles it and the python version
+    """
+    return hashlib.sha1((get_code_version() + content_hash).encode('utf-8')).hexdigest()
+
+def get_parent_cache_key(extends, templates):
+    """
+    Get the cache key of the template that a template extends.
+
+    Returns:
+        str: The cache key of the parent, or None if it does not extend a template
+    """
+    if not extends or not templates or extends not in templates:
+        return None
+    content_hash = getattr(templates[extends], 'content_hash', None)
+    if not content_hash:
+        return ''
+    return get_template_cache_key(content_hash)
+
+def load_cached_template(path, templates):
+    """
+    Load a compiled template from the cache.
+
+    Args:
+        path (str): The path of the cached template
+        templates (dict): The mapping of template names to templates that may be extended
+
+    Returns:
+        Template: The cached template, or None if it is not cached or is out of date
+    """
+    # Only unpickle entries that no one else could have written
+    if not is_private(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            entry = pickle.load(f)
+        template = entry['template']
+        if get_parent_cache_key(template.extends, templates) != entry['parent_key']:
+            return None
+        # Mark the entry as recently used
+        os.utime(path, None)
+        return template
+    except Exception:
+        # Missing or unreadable entries are compiled again
+        return None
+
+def save_cached_template(path, template, templates):
+    """
+    Save a compiled template to the cache, replacing any previous entry atomically.
+
+    Templates that extend a template that is not cached themselves are not saved.
+
+    Args:
+        path (str): The path of the cached template
+        template (Template): The compiled template
+        templates (dict): The mapping of template names to templates that it may extend
+    """
+    parent_key = get_parent_cache_key(template.extends, templates)
+    if parent_key == '':
+        return
+
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            pickle.dump({'template': template, 'parent_key': parent_key}, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except (IOError, OSError, pickle.PicklingError):
+        # The cache is optional, e.g. the cache directory may be read-only
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def prune_template_cache(cache_dir, max_entries=None):
+    """
+    Remove the least recently used templates from the cache, keeping max_entries of them.
+
+    Args:
+        cache_dir (str): The template cache directory
+        max_entries (int): The number of templates to keep, default is MAX_CACHED_TEMPLATES
+    """
+    if max_entries is None:
+        max_entries = MAX_CACHED_TEMPLATES
+    try:
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if name.endswith('.pickle'):
+                entries.append((os.path.getmtime(path), path))
+        entries.sort(reverse=True)
+        for _, path in entries[max_entries:]:
+            os.remove(path)
+    except OSError:
+        # Entries may be removed concurrently by another process
+        pass
+
+class LazyTemplates(collections.Mapping):
+    """
+    A mapping of templates that are loaded on first access.
+
+    Args:
+        loader (function): Returns the dict of templates
+    """
+    def __init__(self, loader):
+        self._loader = loader
+        self._templates = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the templates, if they haven't been loaded yet.
+
+        Returns:
+            dict: The templates by name
+        """
+        if self._templates is None:
+            with self._lock:
+                if self._templates is None:
+                    self._templates = self._loader()
+        return self._templates
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+    def __repr__(self):
+        if self._templates is None:
+            return '<LazyTemplates (not loaded)>'
+        return repr(self._templates)
+
+class LazyTemplate(Template):
+    """
+    A default template, that is loaded on first use.
+
+    It is a Template, whose attributes are filled in from the loaded default
+    template the first time that one of them is read. Copies are copies of the
+    default template itself.
+
+    Args:
+        name (str): The name of the default template
+    """
+    def __init__(self, name):
+        self._name = name
+
+    def _get_template(self):
+        return DEFAULT_TEMPLATES[self._name]
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set yet
+        if name.startswith('__') or name == '_name':
+            raise AttributeError(name)
+        for key, value in self._get_template().__dict__.items():
+            self.__dict__.setdefault(key, value)
+        if name not in self.__dict__:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def __copy__(self):
+        return copy.copy(self._get_template())
+
+    def __deepcopy__(self, memo):
+        return copy.deepcopy(self._get_template(), memo)
+
+    def __repr__(self):
+        return '<LazyTemplate {}>'.format(self._name)
+
+def _load_default_templates():
+    # Default templates can't extend each other
+    return loadTemplates(templates={})
+
+DEFAULT_TEMPLATES = LazyTemplates(_load_default_templates)
+DEFAULT_TEMPLATE = LazyTemplate(DEFAULT_TEMPLATE_NAME)
+BIDS_TEMPLATE = LazyTemplate(BIDS_TEMPLATE_NAME)
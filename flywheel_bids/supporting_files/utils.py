@@ -4,7 +4,8 @@ import re
 import six
 import sys
 import subprocess
-import jsonschema
+import threading
+import time
 import collections
 from builtins import input
 
@@ -74,7 +75,10 @@ def get_extension(fname):
 
 def dict_lookup(obj, value, default=None):
     # For now, we don't support escaping of dots
-    parts = value.split('.')
+    return dict_lookup_parts(obj, value.split('.'), default)
+
+def dict_lookup_parts(obj, parts, default=None):
+    """Lookup a value in obj, given a path that is already split into parts"""
     curr = obj
     for part in parts:
         if isinstance(curr, (dict, collections.Mapping)) and part in curr:
@@ -139,54 +143,178 @@ def normalize_strings(obj):
 # example template string:
 #       'sub-<subject.code>_ses-<session.label>_acq-<acquisition.label>_{file.info.BIDS.Modality}.nii.gz'
 
+STRING_TEMPLATE_TOKENS = re.compile(r'[^\[][A-Za-z0-9\.><}{-]+|\[[/A-Za-z0-9><}{_\.-]+\]')
+STRING_TEMPLATE_VALUES = re.compile(r'[{<][A-Za-z0-9\.-]+[>}]')
+BIDS_LABEL = re.compile(r'(sub|ses)-[a-zA-Z0-9]+')
+
+# The maximum number of compiled string templates to keep
+STRING_TEMPLATE_CACHE_SIZE = 1024
+_string_templates = {}
+
 def process_string_template(template, context):
-    tokens = re.compile('[^\[][A-Za-z0-9\.><}{-]+|\[[/A-Za-z0-9><}{_\.-]+\]')
-    values = re.compile('[{<][A-Za-z0-9\.-]+[>}]')
-
-    for token in tokens.findall(template):
-        if values.search(token):
-            replace_tokens = values.findall(token)
-            for replace_token in replace_tokens:
-                # Remove the {} or <> surrounding the replace_token
-                path = replace_token[1:-1]
-                # Get keys, if replace token has a . in it
-                keys = path.split(".")
-                result = context
-                for key in keys:
-                    if key in result:
-                        result = result[key]
-                    else:
-                        result = None
-                        break
+    return compile_string_template(template).format(context)
+
+def compile_string_template(template):
+    """
+    Get the compiled StringTemplate of a string template, compiling it on first use.
+
+    Args:
+        template (str): The string template
+
+    Returns:
+        StringTemplate: The compiled template
+    """
+    compiled = _string_templates.get(template)
+    if compiled is None:
+        if len(_string_templates) >= STRING_TEMPLATE_CACHE_SIZE:
+            _string_templates.clear()
+        compiled = StringTemplate(template)
+        _string_templates[template] = compiled
+    return compiled
+
+class StringTemplate(object):
+    """
+    A string template, compiled for process_string_template.
+
+    The template is split into literal segments and optional ([...]) or
+    required groups of value lookups. Templates, or substituted values, that
+    could make the substitutions of process_string_template interact (such as a
+    value containing another token) are formatted by replaying the
+    substitutions one at a time instead, so the output is always the same.
+
+    Args:
+        template (str): The string template
+
+    Attributes:
+        template: The string template
+        tokens: The (token, [(replace_token, keys)]) substitutions, in order
+        segments: The (optional, [(text, keys)]) groups of the template, where
+            keys is None for literal text, or None if the template must be replayed
+    """
+    def __init__(self, template):
+        self.template = template
+        self.tokens = []
+        for token in STRING_TEMPLATE_TOKENS.findall(template):
+            replace_tokens = STRING_TEMPLATE_VALUES.findall(token)
+            if replace_tokens:
+                self.tokens.append((token, [(replace_token, replace_token[1:-1].split('.'))
+                    for replace_token in replace_tokens]))
+        self.segments = self._compile_segments()
+
+    def _compile_segments(self):
+        segments = []
+        spans = []
+        pos = 0
+        for match in STRING_TEMPLATE_TOKENS.finditer(self.template):
+            token = match.group()
+            values = list(STRING_TEMPLATE_VALUES.finditer(token))
+            if not values:
+                continue
+
+            if match.start() > pos:
+                segments.append((False, [(self.template[pos:match.start()], None)]))
+            parts = []
+            token_pos = 0
+            for value in values:
+                if value.start() > token_pos:
+                    parts.append((token[token_pos:value.start()], None))
+                parts.append((value.group(), value.group()[1:-1].split('.')))
+                spans.append((match.start() + value.start(), match.start() + value.end()))
+                token_pos = value.end()
+            if token_pos < len(token):
+                parts.append((token[token_pos:], None))
+            segments.append((token[0] == '[', parts))
+            pos = match.end()
+        if pos < len(self.template):
+            segments.append((False, [(self.template[pos:], None)]))
+
+        # Every value must be substituted where it is, and nowhere else
+        replace_tokens = [self.template[start:end] for start, end in spans]
+        if len(set(replace_tokens)) != len(replace_tokens):
+            return None
+        all_spans = [match.span() for match in STRING_TEMPLATE_VALUES.finditer(self.template)]
+        if all_spans != spans:
+            return None
+        literal = ''.join(text for _, parts in segments for text, keys in parts if keys is None)
+        if '{' in literal or '<' in literal:
+            return None
+        return segments
+
+    def format(self, context):
+        """
+        Substitute the values of context into the template.
+
+        Args:
+            context (dict): The context to look up values in
+
+        Returns:
+            str: The formatted string
+        """
+        if self.segments is None:
+            return self._replay(context)
+
+        result = []
+        for optional, parts in self.segments:
+            group = []
+            found = removed = False
+            for text, keys in parts:
+                if keys is None:
+                    group.append(text)
+                    continue
+                value = _get_template_value(text, keys, context)
+                if value is None:
+                    # An optional group is removed unless a value was already substituted in it
+                    removed = removed or (optional and not found)
+                    group.append(text)
+                elif '{' in value or '<' in value:
+                    return self._replay(context)
+                else:
+                    found = True
+                    group.append(value)
+            if not removed:
+                result.extend(group)
+
+        # Replace any [] from the string
+        return ''.join(result).replace('[', '').replace(']', '')
+
+    def _replay(self, context):
+        template = self.template
+        for token, replace_tokens in self.tokens:
+            for replace_token, keys in replace_tokens:
+                value = _get_template_value(replace_token, keys, context)
                 # If value found replace it
-                if result:
-                    # If replace token is <>, need to check if in BIDS
-                    if replace_token[0] == '<':
-                        # Check if result is already in BIDS format...
-                        #   if so, split and grab only the label
-                        if re.match('(sub|ses)-[a-zA-Z0-9]+', result):
-                            label, result = result.split('-')
-                        # If not, take the entire result and remove underscores and dashes
-                        else:
-                            result = ''.join(x for x in result.replace('_', ' ').replace('-', ' ') if x.isalnum())
-                    # Replace the token with the result
-                    template = template.replace(replace_token, str(result))
+                if value is not None:
+                    template = template.replace(replace_token, value)
                 # If result not found, but the token is option, remove the token from the template
                 elif token[0] == '[':
                     template = template.replace(token, '')
 
-                # TODO: Determine approach
-                # Else the value hasn't been found AND field is required, and so let's replace with 'UNKNOWN'
-                #elif token[0] != '[':
-                #    result = 'UNKNOWN'
-                #    template = template.replace(replace_token, result)
-        else:
-            pass
+        # Replace any [] from the string
+        return template.replace('[', '').replace(']', '')
 
-    # Replace any [] from the string
-    processed_template = re.sub('\[|\]', '', template)
-
-    return processed_template
+def _get_template_value(replace_token, keys, context):
+    """
+    Look up the value of a template token, or None if it is not found.
+    """
+    result = context
+    for key in keys:
+        if key in result:
+            result = result[key]
+        else:
+            return None
+    if not result:
+        return None
+
+    # If replace token is <>, need to check if in BIDS
+    if replace_token[0] == '<':
+        # Check if result is already in BIDS format...
+        #   if so, split and grab only the label
+        if BIDS_LABEL.match(result):
+            label, result = result.split('-')
+        # If not, take the entire result and remove underscores and dashes
+        else:
+            result = ''.join(x for x in result.replace('_', ' ').replace('-', ' ') if x.isalnum())
+    return str(result)
 
 
 def get_pattern(format_params):
@@ -197,35 +325,176 @@ def format_value(params, value):
     """
     Formats a string value based on list of given parameters i.e. [{"$replace": {"$pattern": "ab", "$replacement": "c"}}]
     will return "dcf" from "dabf"
+
+    params may also be a ValueFormat, compiled from the list of parameters.
     """
-    for param in params:
-        if "$replace" in param:
-            value = re.sub(get_pattern(param["$replace"]), param["$replace"].get('$replacement'), value)
-        elif "$lower" in param:
-            if isinstance(param['$lower'], dict) and get_pattern(param["$lower"]):
-                value = re.sub(get_pattern(param["$lower"]), lambda m: m.group(0).lower(), value)
-            else:
-                value = value.lower()
-        elif "$upper" in param:
-            if isinstance(param['$upper'], dict) and get_pattern(param["$upper"]):
-                value = re.sub(get_pattern(param["$upper"]), lambda m: m.group(0).upper(), value)
-            else:
-                value = value.upper()
-        elif "$camelCase" in param:
-            if isinstance(param['$camelCase'], dict) and get_pattern(param["$camelCase"]):
-                patterns = get_pattern(param["$camelCase"])
-                if not isinstance(patterns, list):
-                    patterns = [pattern]
-                for pattern in patterns:
-                    value = value.replace(patter, ' ')
-                value = ''.join(x for x in value.title() if x.isalnum())
-                value = value[0].lower() + value[1:]
-            else:
-                # Best to not process string with <...> with $camelCase : true
-                value = ''.join(x for x in value.replace('_', ' ').replace('-', ' ').title() if x.isalnum())
-                value = value[0].lower() + value[1:]
-
-    return value
+    if not isinstance(params, ValueFormat):
+        params = ValueFormat(params, memo_size=0)
+    return params(value)
+
+# The number of formatted values that a ValueFormat remembers
+VALUE_FORMAT_MEMO_SIZE = 1024
+
+class ValueFormat(object):
+    """
+    A list of format_value parameters, compiled into a pipeline of formatting steps.
+
+    The most recently formatted values are remembered, since the same values
+    (e.g. an acquisition label shared by every subject) are formatted over and over.
+
+    Args:
+        params (list): The format_value parameters
+        memo_size (int): The number of formatted values to remember
+
+    Attributes:
+        params: The format_value parameters
+        steps: The formatting steps, in order
+    """
+    def __init__(self, params, memo_size=VALUE_FORMAT_MEMO_SIZE):
+        self.params = params
+        self.steps = []
+        for param in params:
+            step = compile_format_step(param)
+            if step is not None:
+                self.steps.append(step)
+        self.memo_size = memo_size
+        self._memo = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __call__(self, value):
+        if self.memo_size <= 0:
+            return self.format(value)
+
+        key = (type(value), value)
+        try:
+            with self._lock:
+                result = self._memo.pop(key)
+                self._memo[key] = result
+            return result
+        except KeyError:
+            pass
+        except TypeError:
+            # Unhashable values are not remembered
+            return self.format(value)
+
+        result = self.format(value)
+        with self._lock:
+            self._memo[key] = result
+            while len(self._memo) > self.memo_size:
+                self._memo.popitem(last=False)
+        return result
+
+    def format(self, value):
+        """
+        Format value, without remembering the result.
+
+        Args:
+            value (str): The value to format
+
+        Returns:
+            str: The formatted value
+        """
+        for step in self.steps:
+            value = step(value)
+        return value
+
+    def __getstate__(self):
+        return {'params': self.params, 'steps': self.steps, 'memo_size': self.memo_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._memo = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+def compile_format_step(param):
+    """
+    Compile a single format_value parameter.
+
+    Args:
+        param (dict): The parameter, i.e. {"$lower": true}
+
+    Returns:
+        The formatting step, a callable taking and returning the value, or None
+            if the parameter has no effect
+    """
+    if "$replace" in param:
+        return ReplaceFormat(get_pattern(param["$replace"]), param["$replace"].get('$replacement'))
+    for key, method in (("$lower", "lower"), ("$upper", "upper")):
+        if key in param:
+            if isinstance(param[key], dict) and get_pattern(param[key]):
+                return CaseFormat(method, get_pattern(param[key]))
+            return CaseFormat(method)
+    if "$camelCase" in param:
+        if isinstance(param['$camelCase'], dict) and get_pattern(param["$camelCase"]):
+            patterns = get_pattern(param["$camelCase"])
+            if not isinstance(patterns, list):
+                patterns = [patterns]
+            return CamelCaseFormat(patterns)
+        # Best to not process string with <...> with $camelCase : true
+        return CamelCaseFormat(['_', '-'])
+    return None
+
+class ReplaceFormat(object):
+    """Replaces matches of a regular expression"""
+    def __init__(self, pattern, replacement):
+        self.regex = re.compile(pattern)
+        self.replacement = replacement
+
+    def __call__(self, value):
+        return self.regex.sub(self.replacement, value)
+
+class CaseFormat(object):
+    """Converts the case of a value, or of the matches of a regular expression"""
+    def __init__(self, method, pattern=None):
+        self.method = method
+        self.regex = re.compile(pattern) if pattern else None
+
+    def __call__(self, value):
+        if self.regex is None:
+            return getattr(value, self.method)()
+        return self.regex.sub(lambda m: getattr(m.group(0), self.method)(), value)
+
+class CamelCaseFormat(object):
+    """Converts a value to lowerCamelCase, splitting words on each of the patterns"""
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def __call__(self, value):
+        for pattern in self.patterns:
+            value = value.replace(pattern, ' ')
+        value = ''.join(x for x in value.title() if x.isalnum())
+        return value[:1].lower() + value[1:]
+
+
+def call_with_retries(func, args=(), retries=3, backoff=0.5):
+    """Call func, retrying with exponential backoff if it raises
+
+    Client errors (4xx other than 429) are not retried, since repeating the
+    request would not change the result.
+
+    Arguments:
+        func (function): The function to call
+        args (tuple): The arguments to call func with
+        retries (int): The maximum number of retries after the first attempt
+        backoff (float): The delay before the first retry, in seconds. Doubled on each retry.
+
+    Returns:
+        The return value of func
+    """
+    attempt = 0
+    while True:
+        try:
+            return func(*args)
+        except Exception as exc:
+            status = getattr(exc, 'status', None)
+            retryable = not (isinstance(status, int) and 400 <= status < 500 and status != 429)
+            if attempt >= retries or not retryable:
+                raise
+            delay = backoff * (2 ** attempt)
+            logger.warning('{} failed ({}), retrying in {:.1f}s'.format(
+                getattr(func, '__name__', func), exc, delay))
+            time.sleep(delay)
+            attempt += 1
 
 
 def confirmation_prompt(message):
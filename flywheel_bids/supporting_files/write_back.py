@@ -0,0 +1,212 @@
+import collections
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import profiling, project_tree, utils
+
+logger = logging.getLogger('curate-bids')
+
+def get_update_target(context):
+    """
+    Determine which Flywheel container (and file) to update for a context.
+
+    Args:
+        context (dict): The context of the node to update
+
+    Returns:
+        tuple: (container_type, container_id, file_name), file_name is None
+            for container updates. None if the target cannot be determined.
+    """
+    container_type = context['container_type']
+    if container_type == 'file':
+        parent_type = context['parent_container_type']
+        if parent_type not in ('project', 'session', 'acquisition'):
+            logger.info('Cannot determine file parent container type: {}'.format(parent_type))
+            return None
+        return parent_type, context[parent_type]['id'], context['file']['name']
+
+    if container_type not in ('project', 'session', 'acquisition'):
+        logger.info('Cannot determine container type: {}'.format(container_type))
+        return None
+    return container_type, context[container_type]['id'], None
+
+def write_info(fw, container_type, container_id, file_name, info):
+    """
+    Send an info update for a container, or a file of a container, to Flywheel.
+
+    Args:
+        fw: Flywheel client
+        container_type (str): The container type (project, session or acquisition)
+        container_id (str): The container id
+        file_name (str): The file name, or None to update the container itself
+        info (dict): The info object
+    """
+    if file_name is not None:
+        # Modify file
+        update = getattr(fw, 'set_{}_file_info'.format(container_type))
+        update(container_id, file_name, info)
+    else:
+        # Modify container
+        update = getattr(fw, 'replace_{}_info'.format(container_type))
+        update(container_id, info)
+
+def get_info_update(node):
+    """
+    Determine the smallest update that brings Flywheel up to date with a node.
+
+    Only the top-level keys of info that changed since the node was fetched
+    are sent, unless the update would be no smaller than the info itself
+    (measured in canonical JSON), in which case the whole info is sent.
+
+    Args:
+        node (TreeNode): The node to update
+
+    Returns:
+        tuple: The dict of keys to set and the list of keys to delete, or None
+            if the whole info should be written
+    """
+    info = node['info']
+    fingerprints = project_tree.get_info_fingerprints(info)
+    changed, deleted = project_tree.compare_info_fingerprints(node.info_fingerprints, fingerprints)
+    if not isinstance(info, dict) or None in changed or None in deleted:
+        return None
+    update_size = sum(len(key) + fingerprints[key][1] for key in changed) + sum(len(key) for key in deleted)
+    info_size = sum(len(key) + size for key, (_, size) in fingerprints.items())
+    if update_size >= info_size:
+        return None
+    return dict((key, info[key]) for key in changed), sorted(deleted)
+
+def write_node_info(fw, container_type, container_id, file_name, node):
+    """
+    Send the changes of a node's info to Flywheel.
+
+    Containers are updated with the changed keys set and the removed keys
+    deleted. File info updates only ever set keys, so files are updated with
+    the changed keys set, or if any keys were removed, their info is replaced.
+
+    Args:
+        fw: Flywheel client
+        container_type (str): The container type (project, session or acquisition)
+        container_id (str): The container id
+        file_name (str): The file name, or None to update the container itself
+        node (TreeNode): The node with the updated info
+    """
+    info = node['info']
+    if file_name is not None and isinstance(info, dict) and any(key not in info for key in node.info_fingerprints):
+        replace = getattr(fw, 'replace_{}_file_info'.format(container_type))
+        replace(container_id, file_name, info)
+        return
+
+    update = get_info_update(node)
+    if update is None:
+        write_info(fw, container_type, container_id, file_name, info)
+        return
+
+    set_keys, delete_keys = update
+    if file_name is not None:
+        if set_keys:
+            modify = getattr(fw, 'set_{}_file_info'.format(container_type))
+            modify(container_id, file_name, set_keys)
+    else:
+        body = {}
+        if set_keys:
+            body['set'] = set_keys
+        if delete_keys:
+            body['delete'] = delete_keys
+        modify = getattr(fw, 'modify_{}_info'.format(container_type))
+        modify(container_id, body)
+
+class WriteBackQueue(object):
+    """
+    Collects info updates of dirty nodes and flushes them to Flywheel.
+
+    Updates are grouped by container: a container's own update and the updates
+    of all of its files are sent in tree order by the same worker. Groups are
+    flushed concurrently, and each request is retried with backoff. Only the
+    keys of info that changed are sent (see write_node_info).
+
+    Args:
+        fw: Flywheel client
+        workers (int): The number of concurrent requests to make while flushing
+        retries (int): The number of times to retry a failed request
+        backoff (float): The delay before the first retry, in seconds
+
+    Attributes:
+        groups: The pending updates by (container_type, container_id)
+        skipped: The number of nodes that were added without changes
+    """
+    def __init__(self, fw, workers=1, retries=3, backoff=0.5):
+        self.fw = fw
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.groups = collections.OrderedDict()
+        self.skipped = 0
+
+    def add(self, context):
+        """
+        Queue an update for the node of context, if it is dirty.
+
+        Args:
+            context (dict): The context of the node
+
+        Returns:
+            bool: True if an update was queued
+        """
+        node = context[context['container_type']]
+        target = None
+        if node.is_dirty():
+            target = get_update_target(context)
+
+        if target is None:
+            self.skipped += 1
+            return False
+
+        container_type, container_id, file_name = target
+        key = (container_type, container_id)
+        if key not in self.groups:
+            self.groups[key] = []
+        self.groups[key].append((file_name, node))
+        return True
+
+    def flush(self):
+        """
+        Send all queued updates to Flywheel.
+
+        Returns:
+            dict: The number of nodes 'updated', 'failed' and 'skipped'
+        """
+        summary = {'updated': 0, 'failed': 0, 'skipped': self.skipped}
+        groups = list(self.groups.items())
+
+        with profiling.phase('write_back'):
+            if self.workers > 1 and len(groups) > 1:
+                with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    results = list(executor.map(self._flush_group, groups))
+            else:
+                results = [self._flush_group(group) for group in groups]
+
+        for updated, failed in results:
+            summary['updated'] += updated
+            summary['failed'] += failed
+
+        self.groups = collections.OrderedDict()
+        self.skipped = 0
+
+        logger.info('Updated {updated} containers/files, {failed} failed, {skipped} unchanged'.format(**summary))
+        return summary
+
+    def _flush_group(self, group):
+        (container_type, container_id), updates = group
+        updated = failed = 0
+        for file_name, node in updates:
+            args = (self.fw, container_type, container_id, file_name, node)
+            try:
+                utils.call_with_retries(write_node_info, args, retries=self.retries, backoff=self.backoff)
+                updated += 1
+            except Exception as exc:
+                logger.error('Could not update {} {} {}: {}'.format(container_type, container_id,
+                    file_name or '', exc))
+                failed += 1
+        return updated, failed
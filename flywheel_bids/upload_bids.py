@@ -9,9 +9,10 @@ import sys
 
 import flywheel
 
+from concurrent.futures import ThreadPoolExecutor
 from six.moves import reduce
 
-from .supporting_files import bidsify_flywheel, classifications, utils
+from .supporting_files import bidsify_flywheel, cassette, classifications, profiling, utils
 from .supporting_files.templates import BIDS_TEMPLATE as template
 
 
@@ -238,46 +239,112 @@ def handle_acquisition(fw, session_id, acquisition_label):
 
     return acquisition.to_dict()
 
-def upload_project_file(fw, context, full_fname):
-    """"""
-    # Upload file
-    fw.upload_file_to_project(context['project']['id'], full_fname)
-    # Get project
-    proj = fw.get_project(context['project']['id']).to_dict()
-    # Return project file object
-    return proj['files'][-1]
-
-def upload_session_file(fw, context, full_fname):
-    """"""
-    # Upload file
-    fw.upload_file_to_session(context['session']['id'], full_fname)
-    # Get session
-    ses = fw.get_session(context['session']['id']).to_dict()
-    # Return session file object
-    return ses['files'][-1]
-
-def upload_acquisition_file(fw, context, full_fname):
-    """"""
-    # Upload file
-    fw.upload_file_to_acquisition(context['acquisition']['id'], full_fname)
-
-    ### Classify acquisition
-    # Get classification based on filename
-    classification = classify_acquisition(full_fname)
+# Flywheel file types by extension, compound extensions first
+FILE_TYPES = [
+    ('.dicom.zip', 'dicom'),
+    ('.dcm.zip', 'dicom'),
+    ('.nii.gz', 'nifti'),
+    ('.tsv.gz', 'tabular data'),
+    ('.csv.gz', 'tabular data'),
+    ('.tar.gz', 'archive'),
+    ('.nii', 'nifti'),
+    ('.dcm', 'dicom'),
+    ('.dicom', 'dicom'),
+    ('.bval', 'bval'),
+    ('.bvals', 'bval'),
+    ('.bvec', 'bvec'),
+    ('.bvecs', 'bvec'),
+    ('.tsv', 'tabular data'),
+    ('.csv', 'tabular data'),
+    ('.json', 'source code'),
+    ('.py', 'source code'),
+    ('.m', 'source code'),
+    ('.sh', 'source code'),
+    ('.mat', 'MATLAB data'),
+    ('.zip', 'archive'),
+    ('.tgz', 'archive'),
+    ('.tar', 'archive'),
+    ('.txt', 'text'),
+    ('.md', 'markdown'),
+    ('.pdf', 'pdf'),
+    ('.html', 'HTML'),
+    ('.png', 'image'),
+    ('.jpg', 'image'),
+    ('.jpeg', 'image'),
+]
+
+def get_file_type(fname):
+    """ Return the Flywheel file type for fname, based on its extension"""
+    fname = fname.lower()
+    for ext, file_type in FILE_TYPES:
+        if fname.endswith(ext):
+            return file_type
+    return None
+
+def make_file_entry(full_fname, classification=None):
+    """
+    Build the file object of a local file, as Flywheel would after uploading it
 
-    # Assign classification
+    full_fname: Path to the local file
+    classification: The classification to give the file, if any
+    """
+    f = {
+        u'name': os.path.basename(full_fname),
+        u'type': get_file_type(full_fname),
+        u'info': {}
+    }
     if classification:
-        update = {
-            'modality': 'MR',
-            'replace': classification
-        }
-        fw.modify_acquisition_file_classification(context['acquisition']['id'],
-              context['file']['name'], update)
-
-    # Get acquisition
-    acq = fw.get_acquisition(context['acquisition']['id']).to_dict()
-    # Return acquisition file object
-    return acq['files'][-1]
+        f[u'modality'] = 'MR'
+        f[u'classification'] = classification
+    return f
+
+def upload_file(fw, container_type, container_id, full_fname, f):
+    """
+    Upload a file, setting its type, classification and info in the same request
+
+    fw: Flywheel client
+    container_type: The parent container type (project, session or acquisition)
+    container_id: The parent container id
+    full_fname: Path to the local file
+    f: The file object, from make_file_entry
+    """
+    metadata = {'info': f.get('info', {})}
+    for key in ('type', 'modality', 'classification'):
+        if f.get(key):
+            metadata[key] = f[key]
+    upload = getattr(fw, 'upload_file_to_{}'.format(container_type))
+    upload(container_id, full_fname, metadata=json.dumps(metadata))
+
+def upload_bids_file(fw, context, parent_type, full_fname, full_path, local_properties, classification=None):
+    """
+    Match the templates of a local file, and upload it with its BIDS info
+
+    The file object is built locally rather than fetched back after uploading,
+    so that each file is uploaded with a single request.
+
+    fw: Flywheel client
+    context: The upload context, with the parent container of the file
+    parent_type: The parent container type (project, session or acquisition)
+    full_fname: Path to the local file
+    full_path: The BIDS path of the file's folder
+    local_properties: Whether to prioritize BIDS info from the filename over template defaults
+    classification: The classification to give the file, if any
+
+    Returns the file object
+    """
+    context['file'] = make_file_entry(full_fname, classification)
+    # Update the context for this file
+    context['container_type'] = 'file'
+    context['parent_container_type'] = parent_type
+    context['ext'] = utils.get_extension(context['file']['name'])
+    # Identify the templates for the file and return file object
+    context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
+    # Check that the file matched a template
+    if context['file'].get('info'):
+        # Update the meta info files w/ BIDS info from the filename and foldername...
+        fill_in_properties(context, full_path, local_properties)
+    upload_file(fw, parent_type, context[parent_type]['id'], full_fname, context['file'])
+    return context['file']
 
 def determine_acquisition_label(foldername, fname, hierarchy_type):
     """ """
@@ -412,18 +479,9 @@ def handle_subject_folder(fw, context, files_of_interest, subject, rootdir, sub_
                         }
                 continue
             # Upload project file ## TODO: once subjects are containers, add new method to upload to subject
-            context['file'] = upload_project_file(fw, context, full_fname)
-            # Update the context for this file
-            context['container_type'] = 'file'
-            context['parent_container_type'] = 'project' # TODO: once subjects are containers, change this to 'subject'
-            context['ext'] = utils.get_extension(fname)
-            # Identify the templates for the file and return file object
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
-            # Update the meta info files w/ BIDS info from the filename...
+            #   TODO: once subjects are containers, change the parent to 'subject'
             full_path = os.path.join(sub_rootdir, subject_code)
-            meta_info = fill_in_properties(context, full_path, local_properties)
-            # Upload the meta info onto the project file
-            fw.set_project_file_info(context['project']['id'], fname, meta_info)
+            upload_bids_file(fw, context, 'project', full_fname, full_path, local_properties)
 
             # Check if any subject files are of interest (to be parsed later)
             #   interested in _sessions files and JSON files
@@ -467,17 +525,7 @@ def handle_subject_folder(fw, context, files_of_interest, subject, rootdir, sub_
                         }
                 continue
             # Upload session file
-            context['file'] = upload_session_file(fw, context, full_fname)
-            # Update the context for this file
-            context['container_type'] = 'file'
-            context['parent_container_type'] = 'session'
-            context['ext'] = utils.get_extension(fname)
-            # Identify the templates for the file and return file object
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
-            # Update the meta info files w/ BIDS info from the filename...
-            meta_info = fill_in_properties(context, full_path, local_properties)
-            # Upload the meta info onto the project file
-            fw.set_session_file_info(context['session']['id'], fname, meta_info)
+            upload_bids_file(fw, context, 'session', full_fname, full_path, local_properties)
 
             # Check if any session files are of interest (to be parsed later)
             #   interested in _scans.tsv and JSON files
@@ -525,26 +573,16 @@ def handle_subject_folder(fw, context, files_of_interest, subject, rootdir, sub_
                             }
                     continue
 
-                # Place filename in context
-                context['file'] = {u'name': fname}
+                ### Classify acquisition
+                # Get classification based on filename
+                classification = classify_acquisition(full_fname)
                 # Upload acquisition file
-                context['file'] = upload_acquisition_file(fw, context, full_fname)
-                # Update the context for this file
-                context['container_type'] = 'file'
-                context['parent_container_type'] = 'acquisition'
-                context['ext'] = utils.get_extension(fname)
-                # Identify the templates for the file and return file object
-                context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
-                # Check that the file matched a template
-                if context['file'].get('info'):
-                    # Update the meta info files w/ BIDS info from the filename and foldername...
-                    meta_info = fill_in_properties(context, full_path, local_properties)
-                    # Upload the meta info onto the project file
-                    fw.set_acquisition_file_info(context['acquisition']['id'], fname, meta_info)
+                upload_bids_file(fw, context, 'acquisition', full_fname, full_path, local_properties,
+                                 classification=classification)
 
 
 def upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type,
-                    local_properties, assume_yes):
+                    local_properties, assume_yes, workers=1):
     """
 
     fw: Flywheel client
@@ -553,6 +591,7 @@ def upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type,
     hierarchy_type: either 'Flywheel' or 'BIDS'
             if 'Flywheel', the base filename is used as the acquisition label
             if 'BIDS', the BIDS foldername (anat,func,dwi etc...) is used as the acquisition label
+    workers: The number of subjects to upload concurrently
 
     """
 
@@ -601,18 +640,7 @@ def upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type,
                         }
                 continue
             # Upload project file
-            context['file'] = upload_project_file(fw, context, full_fname)
-            # Update the context for this file
-            context['container_type'] = 'file'
-            context['parent_container_type'] = 'project'
-            context['ext'] = utils.get_extension(fname)
-            # Identify the templates for the file and return file object
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
-            # Update the meta info files w/ BIDS info from the filename...
-            full_path = ''
-            meta_info = fill_in_properties(context, full_path, local_properties)
-            # Upload the meta info onto the project file
-            fw.set_project_file_info(context['project']['id'], fname, meta_info)
+            upload_bids_file(fw, context, 'project', full_fname, '', local_properties)
 
             # Check if project files are of interest (to be parsed later)
             #    Interested in participants.tsv or any JSON file
@@ -640,36 +668,52 @@ def upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type,
             full_zname = os.path.join(rootdir, dirr + '.zip')
             shutil.make_archive(full_dname, 'zip', full_dname)
             # Upload project file
-            context['file'] = upload_project_file(fw, context, full_zname)
+            upload_bids_file(fw, context, 'project', full_zname, '', local_properties)
             # remove the generated zipfile
             os.remove(full_zname)
-            # Update the context for this file
-            context['container_type'] = 'file'
-            context['parent_container_type'] = 'project'
-            context['ext'] = utils.get_extension(full_zname)
-            # Identify the templates for the file and return file object
-            context['file'] = bidsify_flywheel.process_matching_templates(context, template, upload=True)
-            # Update the meta info files w/ BIDS info from the filename...
-            full_path = ''
-            meta_info = fill_in_properties(context, full_path, local_properties)
-            # Upload the meta info onto the project file
-            fw.set_project_file_info(context['project']['id'], dirr+'.zip', meta_info)
 
         ### Iterate over subjects
-        for subject_code in subjects:
-            subject = bids_hierarchy[proj_label][subject_code]
-            handle_subject_folder(fw, context, files_of_interest, subject, rootdir,
-                                  '', hierarchy_type, subject_code, local_properties)
+        subject_folders = [(bids_hierarchy[proj_label][subject_code], '', subject_code)
+                           for subject_code in subjects]
+        upload_subject_folders(fw, context, files_of_interest, subject_folders, rootdir,
+                               hierarchy_type, local_properties, workers)
 
         # upload sourcedata (If option not set, the folder was popped in handle_project_label)
-        for subject_code in sourcedata_folder:
-            subject = bids_hierarchy[proj_label]['sourcedata'][subject_code]
-            handle_subject_folder(fw, context, files_of_interest, subject,
-                                  rootdir, 'sourcedata', hierarchy_type,
-                                  subject_code, local_properties)
+        #   NOTE: after the subjects, since these add to the same sessions
+        subject_folders = [(bids_hierarchy[proj_label]['sourcedata'][subject_code], 'sourcedata', subject_code)
+                           for subject_code in sourcedata_folder]
+        upload_subject_folders(fw, context, files_of_interest, subject_folders, rootdir,
+                               hierarchy_type, local_properties, workers)
 
     return files_of_interest
 
+def upload_subject_folders(fw, context, files_of_interest, subject_folders, rootdir, hierarchy_type,
+                           local_properties, workers=1):
+    """
+    Upload subject folders, concurrently if workers > 1
+
+    Each subject is uploaded with its own copy of the context, and the files of
+    interest are merged in subject order, so that the result does not depend on
+    the number of workers.
+
+    subject_folders: list of (subject hierarchy, sub_rootdir, subject_code)
+    """
+    def upload_subject(subject_folder):
+        subject, sub_rootdir, subject_code = subject_folder
+        subject_files_of_interest = {}
+        handle_subject_folder(fw, dict(context), subject_files_of_interest, subject, rootdir,
+                              sub_rootdir, hierarchy_type, subject_code, local_properties)
+        return subject_files_of_interest
+
+    if workers > 1 and len(subject_folders) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(upload_subject, subject_folders))
+    else:
+        results = [upload_subject(subject_folder) for subject_folder in subject_folders]
+
+    for subject_files_of_interest in results:
+        files_of_interest.update(subject_files_of_interest)
+
 def parse_json(filename):
     """ """
     with open(filename) as json_data:
@@ -949,29 +993,34 @@ def parse_meta_files(fw, files_of_interest):
 
 def upload_bids(fw, bids_dir, group_id, project_label=None, hierarchy_type='Flywheel', validate=True,
                 include_source_data=False, local_properties=True, assume_yes=False, subject_label=None,
-                session_label=None):
+                session_label=None, workers=1):
     ### Prep
     # Check directory name - ensure it exists
     validate_dirname(bids_dir)
 
     ### Read in hierarchy & Validate as BIDS
     # parse BIDS dir
-    bids_hierarchy = parse_bids_dir(bids_dir)
-    # TODO: Determine if project label are present
-    bids_hierarchy, rootdir = handle_project_label(bids_hierarchy, project_label, bids_dir,
-                                                   include_source_data, subject_label, session_label)
+    with profiling.phase('walk'):
+        bids_hierarchy = parse_bids_dir(bids_dir)
+        # TODO: Determine if project label are present
+        bids_hierarchy, rootdir = handle_project_label(bids_hierarchy, project_label, bids_dir,
+                                                       include_source_data, subject_label, session_label)
 
     # Determine if hierarchy is valid BIDS
     if validate:
-        utils.validate_bids(rootdir)
+        with profiling.phase('validate'):
+            utils.validate_bids(rootdir)
 
     ### Upload BIDS directory
     # upload bids dir (and get files of interest and project id)
-    files_of_interest = upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type, local_properties, assume_yes)
+    with profiling.phase('upload'):
+        files_of_interest = upload_bids_dir(fw, bids_hierarchy, group_id, rootdir, hierarchy_type, local_properties,
+                                            assume_yes, workers=workers)
 
     # Parse the BIDS meta files
     #    data_description.json, participants.tsv, *_sessions.tsv, *_scans.tsv
-    parse_meta_files(fw, files_of_interest)
+    with profiling.phase('meta_parse'):
+        parse_meta_files(fw, files_of_interest)
 
 def main():
     ### Read in arguments
@@ -979,7 +1028,7 @@ def main():
     parser.add_argument('--bids-dir', dest='bids_dir', action='store',
             required=True, help='BIDS directory')
     parser.add_argument('--api-key', dest='api_key', action='store',
-            required=True, help='API key')
+            required=False, default=None, help='API key')
     parser.add_argument('-g', dest='group_id', action='store',
             required=True, help='Group ID on Flywheel instance')
     parser.add_argument('-p', dest='project_label', action='store',
@@ -994,19 +1043,33 @@ def main():
     parser.add_argument('--use-template-defaults', dest='local_properties', action='store_false',
             default=True, required=False, help='Prioiritize template default values for BIDS information')
     parser.add_argument('-y', '--yes', action='store_true', help='Assume the answer is yes to all prompts')
+    parser.add_argument('--workers', type=int, default=1, help='Number of subjects to upload concurrently')
+    parser.add_argument('--profile', default=None,
+                        help='Write the time spent in each phase, and API call statistics, to this JSON file')
+    parser.add_argument('--record', default=None, help='Record every Flywheel API call of the run to this cassette file')
+    parser.add_argument('--replay', default=None,
+                        help='Serve the Flywheel API calls from this recorded cassette, instead of a Flywheel instance')
+    parser.add_argument('--replay-latency-scale', type=float, default=1.0,
+                        help='Factor to scale the recorded latency of replayed calls by')
     args = parser.parse_args()
+    if not args.api_key and not args.replay:
+        parser.error('--api-key is required, unless replaying a cassette')
 
     if args.session and not args.subject:
         logger.error('Cannot only provide session without subject')
         sys.exit(1)
 
-    # Check API key - raises Error if key is invalid
-    fw = flywheel.Flywheel(args.api_key)
-
-    upload_bids(fw, args.bids_dir, args.group_id, project_label=args.project_label,
-                hierarchy_type=args.hierarchy_type, include_source_data=args.source_data,
-                local_properties=args.local_properties, assume_yes=args.yes,
-                subject_label=args.subject, session_label=args.session)
+    if args.replay:
+        fw = cassette.ReplayClient(args.replay, latency_scale=args.replay_latency_scale)
+    else:
+        # Check API key - raises Error if key is invalid
+        fw = flywheel.Flywheel(args.api_key)
+
+    with cassette.record(args.record, fw) as fw, profiling.profile(args.profile, fw) as fw:
+        upload_bids(fw, args.bids_dir, args.group_id, project_label=args.project_label,
+                    hierarchy_type=args.hierarchy_type, include_source_data=args.source_data,
+                    local_properties=args.local_properties, assume_yes=args.yes,
+                    subject_label=args.subject, session_label=args.session, workers=args.workers)
 
 if __name__ == '__main__':
     main()
@@ -18,7 +18,7 @@ VERSION = "0.7.1"
 # prerequisite: setuptools
 # http://pypi.python.org/pypi/setuptools
 
-REQUIRES = ["jsonschema>=2.6.0", "flywheel-sdk>=2.4.0", "future>=0.16.0"]
+REQUIRES = ["jsonschema>=2.6.0", "flywheel-sdk>=2.4.0", "future>=0.16.0", "futures>=3.0.0; python_version < '3.2'"]
 
 class VerifyVersionCommand(install):
     """Custom command to verify that the git tag matches our version"""
@@ -37,7 +37,7 @@ setup(
     url="",
     keywords=["Flywheel", "flywheel", "BIDS", "SDK"],
     install_requires=REQUIRES,
-    packages=find_packages(),
+    packages=find_packages(exclude=['tests', 'benchmarks']),
     include_package_data=True,
     package_data={
         'flywheel_bids': ['templates/*.json']
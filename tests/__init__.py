@@ -0,0 +1,2 @@
+
+# This is a comment to prevent CircleCI from considering the file as empty.
@@ -0,0 +1,384 @@
+"""
+An in-process fake Flywheel client, and a builder of the projects that it serves.
+
+Shared by the tests and the benchmarks.
+"""
+import collections
+import copy
+import datetime
+import io
+import json
+import os
+import threading
+import time
+import zipfile
+
+from dateutil import tz
+
+
+class FakeContainer(dict):
+    """
+    A dictionary standing in for a Flywheel SDK model object.
+
+    Supports item access by '_id', attribute access and to_dict, which is
+    all that the bids client uses from the SDK models.
+    """
+    def __getitem__(self, key):
+        if key == '_id':
+            key = 'id'
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key == '_id':
+            key = 'id'
+        return dict.get(self, key, default)
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def to_dict(self):
+        return copy.deepcopy(dict(self))
+
+
+class FakeApiClient(object):
+    """Implements the serialization helper of the SDK api_client"""
+    def sanitize_for_serialization(self, obj):
+        if isinstance(obj, (datetime.datetime, datetime.date)):
+            return obj.isoformat()
+        if isinstance(obj, dict):
+            return {key: self.sanitize_for_serialization(val) for key, val in obj.items()}
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self.sanitize_for_serialization(val) for val in obj)
+        return obj
+
+
+class FakeApiException(Exception):
+    """Mimics flywheel.ApiException"""
+    def __init__(self, status=500, reason='Internal Server Error'):
+        super(FakeApiException, self).__init__('({}) {}'.format(status, reason))
+        self.status = status
+        self.reason = reason
+
+
+class FakeFlywheel(object):
+    """
+    In-process stand-in for the Flywheel client, serving a single project.
+
+    Every call sleeps for latency seconds (releasing the GIL like a real
+    request would), and is counted in calls by method name.
+
+    Args:
+        project (dict): The project, with nested 'sessions' and 'acquisitions' lists
+        latency (float): The simulated round trip time of each call, in seconds, or a dict
+            of the round trip time by method name (with the default under None)
+        failures (dict): The number of times each method should fail before succeeding
+        failure_status (int): The HTTP status of the injected failures
+        list_files (bool): Whether listed sessions and acquisitions include their files
+
+    Attributes:
+        calls (Counter): The number of calls made, by method name
+        now (datetime): The modified timestamp given to containers that are updated
+    """
+    def __init__(self, project, latency=0.0, failures=None, failure_status=500, list_files=False):
+        self.api_client = FakeApiClient()
+        self.list_files = list_files
+        self.latency = latency
+        self.failures = collections.Counter(failures or {})
+        self.failure_status = failure_status
+        self.calls = collections.Counter()
+        self.now = datetime.datetime(2019, 1, 1, tzinfo=tz.tzutc())
+        self._lock = threading.Lock()
+
+        self.projects = {}
+        self.sessions = {}
+        self.acquisitions = {}
+        self.project_sessions = collections.defaultdict(list)
+        self.session_acquisitions = collections.defaultdict(list)
+        self.project_rules = collections.defaultdict(list)
+        self.add_project_tree(project)
+
+    def add_project_tree(self, project):
+        project = copy.deepcopy(project)
+        sessions = project.pop('sessions', [])
+        self.projects[project['id']] = project
+        for session in sessions:
+            acquisitions = session.pop('acquisitions', [])
+            session.setdefault('project', project['id'])
+            self.sessions[session['id']] = session
+            self.project_sessions[project['id']].append(session['id'])
+            for acquisition in acquisitions:
+                acquisition.setdefault('session', session['id'])
+                self.acquisitions[acquisition['id']] = acquisition
+                self.session_acquisitions[session['id']].append(acquisition['id'])
+
+    def _call(self, name):
+        with self._lock:
+            self.calls[name] += 1
+            fail = self.failures[name] > 0
+            if fail:
+                self.failures[name] -= 1
+        latency = self.latency
+        if isinstance(latency, dict):
+            latency = latency.get(name, latency.get(None))
+        if latency:
+            time.sleep(latency)
+        if fail:
+            raise FakeApiException(self.failure_status)
+
+    def _container(self, container_type, container_id):
+        return getattr(self, container_type + 's')[container_id]
+
+    def _file(self, container_type, container_id, file_name):
+        for f in self._container(container_type, container_id).get('files', []):
+            if f['name'] == file_name:
+                return f
+        raise FakeApiException(404, 'File not found')
+
+    def get_project(self, project_id):
+        self._call('get_project')
+        return FakeContainer(copy.deepcopy(self.projects[project_id]))
+
+    def get_project_sessions(self, project_id):
+        self._call('get_project_sessions')
+        return [_summary(self.sessions[sid], self.list_files) for sid in self.project_sessions[project_id]]
+
+    def get_session(self, session_id):
+        self._call('get_session')
+        return FakeContainer(copy.deepcopy(self.sessions[session_id]))
+
+    def get_session_acquisitions(self, session_id):
+        self._call('get_session_acquisitions')
+        return [_summary(self.acquisitions[aid], self.list_files) for aid in self.session_acquisitions[session_id]]
+
+    def get_acquisition(self, acquisition_id):
+        self._call('get_acquisition')
+        return FakeContainer(copy.deepcopy(self.acquisitions[acquisition_id]))
+
+    def _download_file(self, container_type, container_id, file_name, dest_file):
+        self._call('download_file_from_{}'.format(container_type))
+        f = self._file(container_type, container_id, file_name)
+        with open(dest_file, 'wb') as fp:
+            fp.write(f.get('content', file_name.encode('utf-8')))
+
+    def download_file_from_project(self, project_id, file_name, dest_file):
+        self._download_file('project', project_id, file_name, dest_file)
+
+    def download_file_from_session(self, session_id, file_name, dest_file):
+        self._download_file('session', session_id, file_name, dest_file)
+
+    def download_file_from_acquisition(self, acquisition_id, file_name, dest_file):
+        self._download_file('acquisition', acquisition_id, file_name, dest_file)
+
+    def _zip_file(self, container_type, container_id, file_name):
+        f = self._file(container_type, container_id, file_name)
+        return zipfile.ZipFile(io.BytesIO(f.get('content', b'')))
+
+    def get_project_file_zip_info(self, project_id, file_name):
+        self._call('get_project_file_zip_info')
+        with self._zip_file('project', project_id, file_name) as zf:
+            members = [FakeContainer({
+                'path': member.filename,
+                'size': member.file_size,
+                # Zip entries store local time
+                'timestamp': datetime.datetime.fromtimestamp(time.mktime(member.date_time + (0, 0, -1)), tz.tzutc())
+            }) for member in zf.infolist()]
+        return FakeContainer({'members': members})
+
+    def download_project_file_zip_member(self, project_id, file_name, member_path, dest_file):
+        self._call('download_project_file_zip_member')
+        with self._zip_file('project', project_id, file_name) as zf, open(dest_file, 'wb') as fp:
+            fp.write(zf.read(member_path))
+
+    def get_all_projects(self):
+        self._call('get_all_projects')
+        return [_summary(project) for project in self.projects.values()]
+
+    def get_project_rules(self, project_id):
+        self._call('get_project_rules')
+        return [FakeContainer(copy.deepcopy(rule)) for rule in self.project_rules[project_id]]
+
+    def modify_project_rule(self, project_id, rule_id, body):
+        self._call('modify_project_rule')
+        for rule in self.project_rules[project_id]:
+            if rule['id'] == rule_id:
+                rule.update(copy.deepcopy(body))
+
+    def _add_container(self, container_type, body):
+        self._call('add_{}'.format(container_type))
+        with self._lock:
+            containers = getattr(self, container_type + 's')
+            container_id = '{}{}'.format(container_type, len(containers))
+            container = copy.deepcopy(body)
+            container.update({'id': container_id, 'files': [], 'created': self.now, 'modified': self.now})
+            container.setdefault('info', {})
+            containers[container_id] = container
+            if container_type == 'session':
+                self.project_sessions[body['project']].append(container_id)
+            elif container_type == 'acquisition':
+                self.session_acquisitions[body['session']].append(container_id)
+        return container_id
+
+    def add_project(self, body):
+        return self._add_container('project', body)
+
+    def add_session(self, body):
+        return self._add_container('session', body)
+
+    def add_acquisition(self, body):
+        return self._add_container('acquisition', body)
+
+    def _modify(self, container_type, container_id, body):
+        self._call('modify_{}'.format(container_type))
+        container = self._container(container_type, container_id)
+        for key, value in copy.deepcopy(body).items():
+            if key == 'info':
+                container.setdefault('info', {}).update(value)
+            else:
+                container[key] = value
+        container['modified'] = self.now
+
+    def modify_project(self, project_id, body):
+        self._modify('project', project_id, body)
+
+    def modify_session(self, session_id, body):
+        self._modify('session', session_id, body)
+
+    def modify_acquisition(self, acquisition_id, body):
+        self._modify('acquisition', acquisition_id, body)
+
+    def _upload_file(self, container_type, container_id, file, metadata=None):
+        self._call('upload_file_to_{}'.format(container_type))
+        metadata = json.loads(metadata) if metadata else {}
+        f = {
+            'name': os.path.basename(file),
+            'type': metadata.get('type'),
+            'info': metadata.get('info', {}),
+            'size': os.path.getsize(file),
+            'modified': self.now
+        }
+        for key in ('modality', 'classification'):
+            if key in metadata:
+                f[key] = metadata[key]
+        container = self._container(container_type, container_id)
+        with self._lock:
+            container['files'] = [x for x in container.get('files', []) if x['name'] != f['name']] + [f]
+            container['modified'] = self.now
+
+    def upload_file_to_project(self, project_id, file, metadata=None):
+        self._upload_file('project', project_id, file, metadata)
+
+    def upload_file_to_session(self, session_id, file, metadata=None):
+        self._upload_file('session', session_id, file, metadata)
+
+    def upload_file_to_acquisition(self, acquisition_id, file, metadata=None):
+        self._upload_file('acquisition', acquisition_id, file, metadata)
+
+    def _replace_info(self, container_type, container_id, info):
+        self._call('replace_{}_info'.format(container_type))
+        container = self._container(container_type, container_id)
+        container['info'] = copy.deepcopy(info)
+        container['modified'] = self.now
+
+    def _modify_info(self, container_type, container_id, body):
+        self._call('modify_{}_info'.format(container_type))
+        container = self._container(container_type, container_id)
+        info = container.setdefault('info', {})
+        if 'replace' in body:
+            info.clear()
+            info.update(copy.deepcopy(body['replace']))
+        info.update(copy.deepcopy(body.get('set', {})))
+        for key in body.get('delete', []):
+            info.pop(key, None)
+        container['modified'] = self.now
+
+    def _set_file_info(self, container_type, container_id, file_name, info):
+        self._call('set_{}_file_info'.format(container_type))
+        f = self._file(container_type, container_id, file_name)
+        f.setdefault('info', {}).update(copy.deepcopy(info))
+        f['modified'] = self._container(container_type, container_id)['modified'] = self.now
+
+    def _replace_file_info(self, container_type, container_id, file_name, info):
+        self._call('replace_{}_file_info'.format(container_type))
+        f = self._file(container_type, container_id, file_name)
+        f['info'] = copy.deepcopy(info)
+        f['modified'] = self._container(container_type, container_id)['modified'] = self.now
+
+    def replace_project_info(self, project_id, info):
+        self._replace_info('project', project_id, info)
+
+    def replace_session_info(self, session_id, info):
+        self._replace_info('session', session_id, info)
+
+    def replace_acquisition_info(self, acquisition_id, info):
+        self._replace_info('acquisition', acquisition_id, info)
+
+    def modify_project_info(self, project_id, body):
+        self._modify_info('project', project_id, body)
+
+    def modify_session_info(self, session_id, body):
+        self._modify_info('session', session_id, body)
+
+    def modify_acquisition_info(self, acquisition_id, body):
+        self._modify_info('acquisition', acquisition_id, body)
+
+    def set_project_file_info(self, project_id, file_name, info):
+        self._set_file_info('project', project_id, file_name, info)
+
+    def set_session_file_info(self, session_id, file_name, info):
+        self._set_file_info('session', session_id, file_name, info)
+
+    def set_acquisition_file_info(self, acquisition_id, file_name, info):
+        self._set_file_info('acquisition', acquisition_id, file_name, info)
+
+    def replace_project_file_info(self, project_id, file_name, info):
+        self._replace_file_info('project', project_id, file_name, info)
+
+    def replace_session_file_info(self, session_id, file_name, info):
+        self._replace_file_info('session', session_id, file_name, info)
+
+    def replace_acquisition_file_info(self, acquisition_id, file_name, info):
+        self._replace_file_info('acquisition', acquisition_id, file_name, info)
+
+
+def _summary(container, list_files=False):
+    """Containers are listed without their files by default, like the real API"""
+    result = FakeContainer(copy.deepcopy(container))
+    if not list_files:
+        result.pop('files', None)
+    return result
+
+
+def make_project(n_sessions, n_acquisitions, n_files=2):
+    """Build a minimal project of the given shape"""
+    base = datetime.datetime(2018, 1, 1, 8, 0, 0, tzinfo=tz.tzutc())
+    project = {'id': 'project', 'label': 'bench', 'info': {}, 'files': [], 'sessions': []}
+    for s in range(n_sessions):
+        session = {
+            'id': 'ses{}'.format(s),
+            'label': 'ses{}'.format(s),
+            'subject': {'code': 'sub{}'.format(s)},
+            'modified': base,
+            'info': {},
+            'files': [],
+            'acquisitions': []
+        }
+        for a in range(n_acquisitions):
+            # Store in reverse order so that fetching has to sort them
+            created = base + datetime.timedelta(minutes=n_acquisitions - a)
+            session['acquisitions'].append({
+                'id': 'ses{}-acq{}'.format(s, a),
+                'label': 'task-rest_run-{}'.format(a + 1),
+                'created': created,
+                'timestamp': created,
+                'modified': created,
+                'info': {},
+                'files': [{'name': 'file{}.nii.gz'.format(f), 'type': 'nifti', 'info': {},
+                           'size': len('file{}.nii.gz'.format(f)),
+                           'modified': created, 'classification': {'Intent': ['Functional']}}
+                          for f in range(n_files)]
+            })
+        project['sessions'].append(session)
+    return project
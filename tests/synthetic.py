@@ -0,0 +1,151 @@
+"""
+Generate synthetic Flywheel projects of a configurable shape.
+
+Acquisitions follow a typical imaging protocol (structural, fieldmaps, a task
+bold run with its sbref and diffusion), followed by further task runs, with
+the classifications that the bids-v1 template matches on. Files carry header
+info of a configurable size, like the DICOM headers that real NIfTI files are
+annotated with, and fieldmaps are curated with IntendedFor lists.
+
+Usage:
+    python -m tests.synthetic --sessions 2 --acquisitions 8
+"""
+import argparse
+import datetime
+import json
+import random
+
+from dateutil import tz
+
+# (label, [(file suffix, file type, classification, header info)]) of each acquisition in the protocol
+BOLD_IMAGE_TYPE = ['ORIGINAL', 'PRIMARY', 'M', 'MB', 'ND', 'MOSAIC']
+SBREF_IMAGE_TYPE = ['ORIGINAL', 'PRIMARY', 'M', 'ND', 'MOSAIC']
+PROTOCOL = [
+    ('T1w_MPR', [('.nii.gz', 'nifti', {'Intent': ['Structural'], 'Measurement': ['T1']}, {}),
+                 ('.dicom.zip', 'dicom', {'Intent': ['Structural'], 'Measurement': ['T1']}, {})]),
+    ('T2w_SPC', [('.nii.gz', 'nifti', {'Intent': ['Structural'], 'Measurement': ['T2']}, {})]),
+    ('fmap_phasediff', [('.nii.gz', 'nifti', {'Intent': ['Fieldmap'], 'Measurement': ['B0']}, {})]),
+    ('task-rest_run-{run}_bold', [('.nii.gz', 'nifti', {'Intent': ['Functional']}, {'ImageType': BOLD_IMAGE_TYPE}),
+                                  ('_events.tsv', 'tabular data', {'Intent': ['Functional']}, {}),
+                                  ('.dicom.zip', 'dicom', {'Intent': ['Functional']}, {})]),
+    ('task-rest_run-{run}_sbref', [('.nii.gz', 'nifti', {'Intent': ['Functional']}, {'ImageType': SBREF_IMAGE_TYPE})]),
+    ('dwi_AP', [('.nii.gz', 'nifti', {'Intent': ['Structural'], 'Measurement': ['Diffusion']}, {}),
+                ('.bval', 'bval', {'Intent': ['Structural'], 'Measurement': ['Diffusion']}, {}),
+                ('.bvec', 'bvec', {'Intent': ['Structural'], 'Measurement': ['Diffusion']}, {})]),
+    ('fmap_topup_PA', [('.nii.gz', 'nifti', {'Intent': ['Fieldmap']}, {})]),
+]
+# Acquisitions beyond the protocol are further task runs
+RUN_PROTOCOL = PROTOCOL[3:5]
+
+# Header fields of every file, the rest of the header is filled with generated tags
+HEADER_FIELDS = {
+    'Manufacturer': 'SIEMENS',
+    'MagneticFieldStrength': 3,
+    'RepetitionTime': 2.0,
+    'EchoTime': 0.03,
+    'FlipAngle': 90,
+}
+
+def make_header(rng, n_fields):
+    """
+    Build header info with n_fields fields.
+
+    Args:
+        rng (Random): The random number generator
+        n_fields (int): The number of fields in the header
+
+    Returns:
+        dict: The header
+    """
+    header = dict(HEADER_FIELDS)
+    for i in range(len(header), n_fields):
+        if i % 3 == 0:
+            value = [round(rng.random(), 6) for _ in range(8)]
+        elif i % 3 == 1:
+            value = 'value-{:08x}'.format(rng.getrandbits(32))
+        else:
+            value = rng.randint(0, 1 << 16)
+        header['Tag{:04d}'.format(i)] = value
+    return header
+
+def make_synthetic_project(n_sessions, n_acquisitions, n_files=None, header_fields=50, seed=0):
+    """
+    Build a project of the given shape, as accepted by FakeFlywheel.
+
+    Args:
+        n_sessions (int): The number of sessions (each with its own subject)
+        n_acquisitions (int): The number of acquisitions per session
+        n_files (int): The maximum number of files per acquisition, default is all files of the protocol
+        header_fields (int): The number of header fields in the info of each file
+        seed (int): The seed of the generated header values
+
+    Returns:
+        dict: The project, with nested 'sessions' and 'acquisitions' lists
+    """
+    rng = random.Random(seed)
+    base = datetime.datetime(2018, 1, 1, 8, 0, 0, tzinfo=tz.tzutc())
+    project = {'id': 'project', 'label': 'synthetic', 'group': 'group', 'info': {}, 'files': [], 'sessions': []}
+
+    for s in range(n_sessions):
+        session_time = base + datetime.timedelta(days=s)
+        session = {
+            'id': 'ses{}'.format(s),
+            'label': 'ses{}'.format(s),
+            'subject': {'code': 'sub{:03d}'.format(s)},
+            'timestamp': session_time,
+            'modified': session_time,
+            'info': {},
+            'files': [],
+            'acquisitions': []
+        }
+        runs = 0
+        for a in range(n_acquisitions):
+            if a < len(PROTOCOL):
+                label, files = PROTOCOL[a]
+            else:
+                label, files = RUN_PROTOCOL[(a - len(PROTOCOL)) % len(RUN_PROTOCOL)]
+            if label.endswith('_bold'):
+                runs += 1
+            label = label.format(run=runs)
+            created = session_time + datetime.timedelta(minutes=a)
+
+            acquisition = {
+                'id': 'ses{}-acq{}'.format(s, a),
+                'label': label,
+                'created': created,
+                'timestamp': created,
+                'modified': created,
+                'info': {},
+                'files': []
+            }
+            for suffix, file_type, classification, file_info in files[:n_files]:
+                name = '{}{}'.format(label, suffix)
+                info = make_header(rng, header_fields)
+                info.update(file_info)
+                acquisition['files'].append({
+                    'name': name,
+                    'type': file_type,
+                    'classification': dict(classification),
+                    'info': info,
+                    'size': len(name),
+                    'modified': created
+                })
+            session['acquisitions'].append(acquisition)
+        project['sessions'].append(session)
+    return project
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic project')
+    parser.add_argument('--sessions', type=int, default=2)
+    parser.add_argument('--acquisitions', type=int, default=len(PROTOCOL))
+    parser.add_argument('--files', type=int, default=None, help='Maximum number of files per acquisition')
+    parser.add_argument('--header-fields', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    project = make_synthetic_project(args.sessions, args.acquisitions, n_files=args.files,
+            header_fields=args.header_fields, seed=args.seed)
+    print(json.dumps(project, indent=2, sort_keys=True, default=str))
+
+if __name__ == '__main__':
+    main()
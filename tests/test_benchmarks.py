@@ -0,0 +1,60 @@
+import os
+import shutil
+import unittest
+
+from benchmarks import bench_suite
+from flywheel_bids import curate_bids
+from tests.fake_client import FakeFlywheel
+from tests.synthetic import PROTOCOL, make_synthetic_project
+
+class BenchmarkTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Define testdir
+        self.testdir = 'testdir'
+
+    def tearDown(self):
+        # Cleanup 'testdir', if present
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def test_make_synthetic_project(self):
+        """ Synthetic projects have the requested shape, and curate to valid BIDS files """
+        project = make_synthetic_project(2, len(PROTOCOL) + 2, header_fields=20)
+        self.assertEqual(project, make_synthetic_project(2, len(PROTOCOL) + 2, header_fields=20))
+        self.assertEqual(len(project['sessions']), 2)
+        self.assertEqual(len(project['sessions'][0]['acquisitions']), len(PROTOCOL) + 2)
+        self.assertEqual(len(make_synthetic_project(1, 1, n_files=1)['sessions'][0]['acquisitions'][0]['files']), 1)
+
+        fw = FakeFlywheel(project)
+        curate_bids.curate_bids_dir(fw, 'project')
+        files = dict((f['name'], f) for acq in fw.acquisitions.values() if acq['session'] == 'ses0'
+                for f in acq['files'])
+        self.assertEqual(len(files['T1w_MPR.nii.gz']['info']), 21)
+        for f in files.values():
+            self.assertTrue(f['info']['BIDS']['valid'], f['name'])
+
+        self.assertEqual(files['task-rest_run-2_sbref.nii.gz']['info']['BIDS']['Filename'],
+                'sub-sub000_ses-ses0_task-rest_run-2_sbref.nii.gz')
+        self.assertIn('ses-ses0/func/sub-sub000_ses-ses0_task-rest_run-2_bold.nii.gz',
+                files['fmap_phasediff.nii.gz']['info']['IntendedFor'])
+
+    def test_run_benchmark(self):
+        """ Benchmarks report their API calls, and regress on more calls or much more CPU time """
+        result = bench_suite.run_benchmark('curate', 'small', repeat=1)
+        self.assertEqual(sorted(result), ['api_calls', 'cpu_time', 'wall_time'])
+        self.assertGreater(result['api_calls'], 0)
+
+        baseline = {'api_calls': 100, 'cpu_time': 1.0, 'wall_time': 1.0}
+        self.assertEqual(bench_suite.compare_to_baseline(dict(baseline), baseline), [])
+        self.assertEqual(bench_suite.compare_to_baseline(dict(baseline, cpu_time=1.4), baseline), [])
+        self.assertEqual(bench_suite.compare_to_baseline(dict(baseline, api_calls=99), baseline), [])
+        self.assertEqual(len(bench_suite.compare_to_baseline(dict(baseline, cpu_time=1.6), baseline)), 1)
+        self.assertEqual(len(bench_suite.compare_to_baseline(dict(baseline, api_calls=101), baseline)), 1)
+        self.assertEqual(bench_suite.compare_to_baseline(dict(baseline, api_calls=101), None), [])
+
+
+if __name__ == "__main__":
+
+    unittest.main()
+    run_module_suite()
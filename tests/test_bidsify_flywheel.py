@@ -4,7 +4,9 @@ import re
 import shutil
 import unittest
 
-from flywheel_bids.supporting_files import utils, bidsify_flywheel
+from benchmarks import bench_string_template
+from flywheel_bids.supporting_files import utils, bidsify_flywheel, classifications
+from flywheel_bids.supporting_files.templates import BIDS_TEMPLATE
 
 class BidsifyTestCases(unittest.TestCase):
 
@@ -193,6 +195,100 @@ class BidsifyTestCases(unittest.TestCase):
                     context['session']['label']
                     ))
 
+    def test_process_string_template_compiled(self):
+        """ Compiled templates format exactly like the substitution loop """
+        string_templates = bench_string_template.get_string_templates() + [
+            # Partially substituted optional groups keep their missing tokens
+            'sub-<subject.code>[_acq-{acquisition.label}_run-{file.info.BIDS.Run}]_bold',
+            'sub-<subject.code>[_run-{file.info.BIDS.Run}_acq-{acquisition.label}]_bold',
+            # Repeated tokens, and tokens that are only substituted as a side effect
+            '{subject.code}[_{acquisition.label}]_{subject.code}',
+            '[_{acquisition.label}][_{acquisition.label}-{file.info.BIDS.Run}]',
+            '{ext}{ext}[{file.info.BIDS.Run}]_{project.label}',
+            '{file.info.BIDS.Run}_{{ext}}<<subject.code>',
+            '[{file.info.BIDS.Template}]_{ext}_[<acquisition.label>]',
+            '', 'no tokens', '[]', '[_{missing.value}]', '_<session.label>/{file.info}'
+        ]
+        contexts = bench_string_template.get_file_contexts(2, 3)
+        contexts.append({
+            'project': {'label': 'p[1]'},
+            'subject': {'code': 'sub-01'},
+            'session': {'label': 'ses_pre-op'},
+            'acquisition': {'label': '{ext}'},
+            'file': {'info': {'BIDS': {'Run': '<subject.code>', 'Template': '[_{acquisition.label}]'}}},
+            'ext': '.nii.gz'
+        })
+        contexts.append({'subject': {'code': 'x'}, 'acquisition': {'label': 0}, 'file': {}, 'ext': ''})
+
+        for string_template in string_templates:
+            for context in contexts:
+                self.assertEqual(utils.process_string_template(string_template, context),
+                        bench_string_template.legacy_process_string_template(string_template, context))
+
+    def test_determine_enum_index(self):
+        """ Indexed modality lookup matches trying every classification in turn """
+        all_types = classifications.classifications
+        enums = [prop['enum'] for templateDef in BIDS_TEMPLATE.definitions.values()
+                 for key, prop in templateDef.get('properties', {}).items() if key == 'Modality' and 'enum' in prop]
+        enums.append(sorted(set(name for data_type in all_types.values() for name in data_type)))
+        enums.append(list(reversed(enums[-1])))
+        enums.append([])
+
+        # Every classification entry, alone, combined with another and with extra features
+        entries = [req for data_type in all_types.values() for req in data_type.values()]
+        test_classifications = [{}, {'Intent': ''}, {'Intent': []}, {'Custom': ['Unknown']}, None, {'Intent': [{}]}]
+        for req in entries:
+            test_classifications.append(req)
+            test_classifications.append(dict((k, v if isinstance(v, list) else [v]) for k, v in req.items()))
+            test_classifications.append(dict(req, Features=['Extra', 'Quantitative']))
+            for other in entries[::3]:
+                combined = dict((k, [v] if not isinstance(v, list) else list(v)) for k, v in req.items())
+                for k, v in other.items():
+                    combined.setdefault(k, []).extend(v if isinstance(v, list) else [v])
+                test_classifications.append(combined)
+            for k in req:
+                test_classifications.append(dict((k2, v) for k2, v in req.items() if k2 != k))
+
+        for enum in enums:
+            prop = {'type': 'string', 'enum': enum}
+            for classification in test_classifications:
+                try:
+                    expected = bidsify_flywheel.scan_classifications(enum, classification)
+                except AttributeError:
+                    with self.assertRaises(AttributeError):
+                        bidsify_flywheel.determine_enum(prop, 'Modality', classification)
+                    continue
+                self.assertEqual(bidsify_flywheel.determine_enum(prop, 'Modality', classification), expected)
+                # Repeated lookups are remembered
+                self.assertEqual(bidsify_flywheel.determine_enum(prop, 'Modality', classification), expected)
+
+        self.assertEqual(bidsify_flywheel.determine_enum({'enum': ['bold', 'sbref']}, 'Modality',
+            {'Intent': ['Functional']}), 'bold')
+        self.assertEqual(bidsify_flywheel.determine_enum({'enum': ['sbref', 'dwi']}, 'Modality',
+            {'Intent': ['Structural'], 'Measurement': ['Diffusion']}), 'sbref')
+        self.assertEqual(bidsify_flywheel.determine_enum({'enum': ['T1w'], 'default': 'x'}, 'Modality', {}), 'x')
+
+    def test_property_plan(self):
+        """ Compiled property plans initialize and update like add_properties and update_properties """
+        contexts = bench_string_template.get_file_contexts(1, 2)
+        classifications = [{'Intent': ['Functional']}, {'Measurement': ['T1'], 'Intent': ['Structural']}]
+        for name, templateDef in BIDS_TEMPLATE.definitions.items():
+            if 'properties' not in templateDef:
+                continue
+            plan = bidsify_flywheel.get_property_plan(templateDef)
+            self.assertIs(bidsify_flywheel.get_property_plan(templateDef), plan)
+
+            for classification in classifications:
+                expected = bidsify_flywheel.add_properties(templateDef['properties'], {'template': name}, classification)
+                self.assertEqual(plan.add_properties({'template': name}, classification), expected)
+            for context in contexts:
+                self.assertEqual(plan.update_properties(context, {}),
+                        bidsify_flywheel.update_properties(templateDef['properties'], context, {}))
+
+        # Object properties without a default get a new object each time
+        plan = bidsify_flywheel.PropertyPlan({'Obj': {'type': 'object'}})
+        self.assertIsNot(plan.add_properties({}, None)['Obj'], plan.add_properties({}, None)['Obj'])
+
     def test_add_properties_valid(self):
         """ """
         properties = {
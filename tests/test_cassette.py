@@ -0,0 +1,103 @@
+import os
+import shutil
+import unittest
+
+from flywheel_bids import curate_bids, export_bids
+from flywheel_bids.supporting_files import cassette
+from tests.fake_client import FakeApiException, FakeFlywheel
+from tests.synthetic import make_synthetic_project
+
+class CassetteTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Define testdir
+        self.testdir = 'testdir'
+        self.path = os.path.join(self.testdir, 'cassette.json.gz')
+        os.makedirs(self.testdir)
+
+    def tearDown(self):
+        # Cleanup 'testdir', if present
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def _list_files(self, dirname):
+        result = {}
+        for root, _, files in os.walk(dirname):
+            for name in files:
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    result[os.path.relpath(path, dirname)] = f.read()
+        return result
+
+    def test_replay_curate(self):
+        """ A replayed curation makes the same calls as the recorded one """
+        fw = FakeFlywheel(make_synthetic_project(2, 8, header_fields=10))
+        with cassette.record(self.path, fw) as recording_fw:
+            curate_bids.curate_bids_dir(recording_fw, 'project')
+        self.assertTrue(os.path.isfile(self.path))
+
+        replay_fw = cassette.ReplayClient(self.path, latency_scale=0)
+        curate_bids.curate_bids_dir(replay_fw, 'project')
+        self.assertEqual(replay_fw.calls, fw.calls)
+
+        # The written info matches the recording
+        interactions = cassette.load_cassette(self.path)
+        written = [i for i in interactions if i['method'] == 'set_acquisition_file_info']
+        self.assertEqual(len(written), fw.calls['set_acquisition_file_info'])
+        self.assertIn('BIDS', written[0]['args'][2])
+
+    def test_replay_export(self):
+        """ Downloads are replayed with the recorded content, or zeros of the recorded size """
+        project = make_synthetic_project(1, 3, header_fields=10)
+        for acquisition in project['sessions'][0]['acquisitions']:
+            for f in acquisition['files']:
+                f['content'] = f['name'].encode('utf-8') * (10 if f['name'].startswith('T1w') else 1)
+                f['size'] = len(f['content'])
+        fw = FakeFlywheel(project)
+        curate_bids.curate_bids_dir(fw, 'project')
+
+        recorded_dir = os.path.join(self.testdir, 'recorded')
+        with cassette.record(self.path, fw) as recording_fw:
+            recording_fw._max_file_size = 40
+            export_bids.download_bids_dir(recording_fw, 'project', 'project', recorded_dir)
+
+        replayed_dir = os.path.join(self.testdir, 'replayed')
+        replay_fw = cassette.ReplayClient(self.path, latency_scale=0)
+        export_bids.download_bids_dir(replay_fw, 'project', 'project', replayed_dir)
+
+        recorded, replayed = self._list_files(recorded_dir), self._list_files(replayed_dir)
+        self.assertEqual(sorted(replayed), sorted(recorded))
+        self.assertEqual(replayed['sub-sub000/ses-ses0/anat/sub-sub000_ses-ses0_T2w.nii.gz'],
+                recorded['sub-sub000/ses-ses0/anat/sub-sub000_ses-ses0_T2w.nii.gz'])
+        self.assertEqual(replayed['sub-sub000/ses-ses0/anat/sub-sub000_ses-ses0_T1w.nii.gz'], b'\0' * 140)
+
+    def test_replay_errors(self):
+        """ Errors and latency are replayed, and unrecorded calls fail """
+        fw = FakeFlywheel(make_synthetic_project(1, 1), latency={'get_project': 0.05},
+                failures={'get_project': 1}, failure_status=503)
+        with cassette.record(self.path, fw) as recording_fw:
+            with self.assertRaises(FakeApiException):
+                recording_fw.get_project('project')
+            project = recording_fw.get_project('project')
+            recording_fw.get_project_sessions('project')
+
+        replay_fw = cassette.ReplayClient(self.path, latency_scale=0.5)
+        with self.assertRaises(cassette.ReplayApiException) as context:
+            replay_fw.get_project('project')
+        self.assertEqual(context.exception.status, 503)
+
+        replayed = replay_fw.get_project('project')
+        self.assertEqual(replayed.to_dict(), project.to_dict())
+        self.assertEqual(replayed['_id'], 'project')
+        self.assertEqual(replayed.label, 'synthetic')
+        self.assertEqual(replay_fw.get_project_sessions('project')[0].timestamp, fw.sessions['ses0']['timestamp'])
+
+        with self.assertRaises(cassette.CassetteMissError):
+            replay_fw.get_project('other')
+        self.assertGreaterEqual(cassette.load_cassette(self.path)[0]['latency'], 0.05)
+
+
+if __name__ == "__main__":
+
+    unittest.main()
+    run_module_suite()
@@ -1,11 +1,15 @@
+import copy
+import json
 import os
 import shutil
 import unittest
 
 import flywheel
 
+from tests.fake_client import FakeFlywheel, make_project
 from flywheel_bids import curate_bids
-from flywheel_bids.supporting_files import project_tree
+from flywheel_bids.supporting_files import project_tree, write_back
+from flywheel_bids.supporting_files.errors import BIDSCurationError
 from flywheel_bids.supporting_files.templates import BIDS_TEMPLATE
 
 class BidsCurateTestCases(unittest.TestCase):
@@ -249,6 +253,251 @@ class BidsCurateTestCases(unittest.TestCase):
         self.assertEqual(len(file1['info']['IntendedFor']), 1)
         self.assertEqual(file1['info']['IntendedFor'][0], 'ses-session1/func/sub-subj1_ses-session1_task-rest_run-1_bold.nii.gz')
 
+    def test_curate_bids_dir_write_back(self):
+        """ Concurrent write-back results in the same info as serial write-back """
+        project = make_project(3, 2)
+        serial_fw = FakeFlywheel(project)
+        curate_bids.curate_bids_dir(serial_fw, 'project')
+
+        concurrent_fw = FakeFlywheel(project)
+        curate_bids.curate_bids_dir(concurrent_fw, 'project', workers=4)
+
+        self.assertEqual(serial_fw.acquisitions, concurrent_fw.acquisitions)
+        self.assertEqual(serial_fw.sessions, concurrent_fw.sessions)
+        self.assertEqual(serial_fw.projects, concurrent_fw.projects)
+        self.assertEqual(serial_fw.calls['set_acquisition_file_info'], 12)
+        self.assertEqual(serial_fw.acquisitions['ses0-acq0']['files'][0]['info']['BIDS']['Filename'],
+                'sub-sub0_ses-ses0_task-rest_run-1_bold.nii.gz')
+
+    def test_write_back_queue_retry(self):
+        """ Failed updates are retried, and reported if they keep failing """
+        fw = FakeFlywheel(make_project(1, 2), failures={'replace_acquisition_info': 1, 'set_acquisition_file_info': 12})
+        project = project_tree.get_project_tree(fw, 'project')
+        for context in project.context_iter():
+            if context['container_type'] in ('acquisition', 'file'):
+                context[context['container_type']]['info']['BIDS'] = {'updated': True}
+
+        queue = write_back.WriteBackQueue(fw, workers=2, retries=2, backoff=0)
+        for context in project.context_iter():
+            queue.add(context)
+        summary = queue.flush()
+
+        self.assertEqual(summary, {'updated': 2, 'failed': 4, 'skipped': 2})
+        self.assertEqual(fw.calls['replace_acquisition_info'], 3)
+        self.assertEqual(fw.acquisitions['ses0-acq1']['info'], {'BIDS': {'updated': True}})
+
+    def test_write_back_queue_changes(self):
+        """ Only the changed keys of info are sent """
+        project = make_project(1, 1)
+        project['sessions'][0]['info'] = {'BIDS': {'Label': 'old'}, 'drop': 1, 'keep': 2}
+        project['sessions'][0]['acquisitions'][0]['files'][0]['info'] = {'header': {'dim': [64, 64]}}
+        fw = FakeFlywheel(project)
+        bodies = []
+        set_file_info = fw.set_acquisition_file_info
+        fw.set_acquisition_file_info = lambda *args: bodies.append(args[2]) or set_file_info(*args)
+
+        tree = project_tree.get_project_tree(fw, 'project')
+        session = tree.children[0]
+        session['info']['BIDS']['Label'] = 'new'
+        del session['info']['drop']
+        acquisition = session.children[0]
+        acquisition.children[0]['info']['BIDS'] = {'Folder': 'func'}
+        acquisition.children[1]['info']['BIDS'] = {'Folder': 'func'}
+
+        queue = write_back.WriteBackQueue(fw)
+        for context in tree.context_iter():
+            queue.add(context)
+        self.assertEqual(queue.flush(), {'updated': 3, 'failed': 0, 'skipped': 2})
+
+        self.assertEqual(fw.calls['modify_session_info'], 1)
+        self.assertEqual(fw.calls['replace_session_info'], 0)
+        self.assertEqual(fw.sessions['ses0']['info'], {'BIDS': {'Label': 'new'}, 'keep': 2})
+        # The header of the first file is not sent again
+        self.assertEqual(bodies, [{'BIDS': {'Folder': 'func'}}, {'BIDS': {'Folder': 'func'}}])
+        self.assertEqual(fw.acquisitions['ses0-acq0']['files'][0]['info'],
+                {'header': {'dim': [64, 64]}, 'BIDS': {'Folder': 'func'}})
+
+        # Updates are no larger than the info itself
+        node = project_tree.TreeNode('session', {'info': {'a': 1, 'b': 2}})
+        node['info'] = {'a': 2}
+        self.assertIsNone(write_back.get_info_update(node))
+        node['info'] = {'a': 1, 'b': 3}
+        self.assertEqual(write_back.get_info_update(node), ({'b': 3}, []))
+        node = project_tree.TreeNode('session', {'info': {'a': 'x' * 100, 'b': 2, 'c': 3}})
+        node['info'] = {'a': 'y' * 100, 'b': 2}
+        self.assertEqual(write_back.get_info_update(node), ({'a': 'y' * 100}, ['c']))
+        node['info'] = {'a': 'y' * 100}
+        self.assertIsNone(write_back.get_info_update(node))
+        node['info'] = {'a': 'x' * 100, 'b': 3}
+        self.assertEqual(write_back.get_info_update(node), ({'b': 3}, ['c']))
+
+        # Removed file info keys are removed by replacing the file's info
+        file_node = tree.children[0].children[0].children[0]
+        del file_node['info']['header']
+        write_back.write_node_info(fw, 'acquisition', 'ses0-acq0', file_node['name'], file_node)
+        self.assertEqual(fw.calls['replace_acquisition_file_info'], 1)
+        self.assertEqual(fw.acquisitions['ses0-acq0']['files'][0]['info'], {'BIDS': {'Folder': 'func'}})
+
+    def test_curate_bids_dir_write_back_failure(self):
+        """ Curation raises once write-back has finished if any update failed """
+        fw = FakeFlywheel(make_project(1, 1), failures={'replace_session_info': 10}, failure_status=403)
+        with self.assertRaises(BIDSCurationError):
+            curate_bids.curate_bids_dir(fw, 'project')
+        self.assertIn('BIDS', fw.acquisitions['ses0-acq0']['info'])
+        # Client errors are not retried
+        self.assertEqual(fw.calls['replace_session_info'], 1)
+
+    def _make_fieldmap_project(self, n_sessions):
+        project = project_tree.TreeNode('project', {'id': 'project', 'label': 'testProj'})
+        for i in range(n_sessions):
+            session = project_tree.TreeNode('session', {'id': 'ses{}'.format(i), 'label': 'session{}'.format(i),
+                                                        'subject': {'code': 'subj{}'.format(i % 2)}})
+            project.children.append(session)
+            for j, (label, name, intent) in enumerate([('acq1_LR', 'fieldmap.nii.gz', 'Fieldmap'),
+                                                       ('acq2_task-rest_run-1', 'task1.nii.gz', 'Functional'),
+                                                       ('acq3_task-rest_run-2', 'task2.nii.gz', 'Functional')]):
+                f = {'name': name, 'type': 'nifti', 'classification': {'Intent': intent}}
+                acq = project_tree.TreeNode('acquisition', {'id': 'ses{}-acq{}'.format(i, j), 'label': label,
+                                                            'files': [f]})
+                acq.children.append(project_tree.TreeNode('file', f))
+                session.children.append(acq)
+        return project
+
+    def test_curate_bids_tree_processes(self):
+        """ Curating sessions in worker processes gives the same tree as serial curation """
+        serial = self._make_fieldmap_project(4)
+        curate_bids.curate_bids_tree(None, serial, False, None, False)
+
+        sharded = self._make_fieldmap_project(4)
+        curate_bids.curate_bids_tree(None, sharded, False, None, False, processes=2)
+
+        self.assertEqual(json.dumps(sharded.to_json(), sort_keys=True), json.dumps(serial.to_json(), sort_keys=True))
+        fieldmap = sharded.children[3].children[0].children[0]
+        self.assertTrue(fieldmap.is_dirty())
+        # Files are sent once, and the files list is linked to the file nodes again
+        self.assertNotIn('files', curate_bids.to_worker_json(sharded.children[3].children[0])['data'])
+        self.assertIs(sharded.children[3].children[0]['files'][0], fieldmap.data)
+        self.assertEqual(fieldmap['info']['IntendedFor'],
+                ['ses-session3/func/sub-subj1_ses-session3_task-rest_run-1_bold.nii.gz',
+                 'ses-session3/func/sub-subj1_ses-session3_task-rest_run-2_bold.nii.gz'])
+
+    def test_curate_bids_dir_processes(self):
+        """ Sessions curated in worker processes are written back like serial curation """
+        project = make_project(3, 2)
+        serial_fw = FakeFlywheel(project)
+        curate_bids.curate_bids_dir(serial_fw, 'project')
+
+        sharded_fw = FakeFlywheel(project)
+        curate_bids.curate_bids_dir(sharded_fw, 'project', processes=2)
+
+        self.assertEqual(serial_fw.acquisitions, sharded_fw.acquisitions)
+        self.assertEqual(serial_fw.sessions, sharded_fw.sessions)
+        self.assertEqual(serial_fw.projects, sharded_fw.projects)
+        self.assertEqual(serial_fw.calls, sharded_fw.calls)
+
+    def test_curate_bids_dir_stream(self):
+        """ Streaming curation makes the same updates and requests as curating the whole tree """
+        project = make_project(4, 2)
+        serial_fw = FakeFlywheel(project)
+        curate_bids.curate_bids_dir(serial_fw, 'project')
+
+        for window in (0, 2):
+            stream_fw = FakeFlywheel(project)
+            curate_bids.curate_bids_dir(stream_fw, 'project', stream=True, stream_window=window)
+
+            self.assertEqual(serial_fw.acquisitions, stream_fw.acquisitions)
+            self.assertEqual(serial_fw.sessions, stream_fw.sessions)
+            self.assertEqual(serial_fw.projects, stream_fw.projects)
+            self.assertEqual(serial_fw.calls, stream_fw.calls)
+
+    def test_curate_bids_dir_stream_session_only(self):
+        """ Streaming curation of a single session only fetches and updates that session """
+        fw = FakeFlywheel(make_project(3, 1))
+        curate_bids.curate_bids_dir(fw, 'project', session_id='ses1', session_only=True, stream=True)
+
+        self.assertEqual(fw.calls['get_session'], 1)
+        self.assertIn('BIDS', fw.sessions['ses1']['info'])
+        self.assertNotIn('BIDS', fw.sessions['ses0']['info'])
+
+    def _without_fingerprints(self, sessions):
+        sessions = copy.deepcopy(sessions)
+        for session in sessions.values():
+            session['info'].get('BIDS', {}).pop(curate_bids.FINGERPRINT_KEY, None)
+        return sessions
+
+    def test_curate_bids_dir_incremental(self):
+        """ Incremental curation only curates and updates sessions that changed """
+        for stream in (False, True):
+            fw = FakeFlywheel(make_project(3, 2))
+            curate_bids.curate_bids_dir(fw, 'project', incremental=True, stream=stream)
+            self.assertEqual(len(set(s['info']['BIDS'][curate_bids.FINGERPRINT_KEY] for s in fw.sessions.values())), 3)
+
+            # Nothing changed
+            fw.calls.clear()
+            curate_bids.curate_bids_dir(fw, 'project', incremental=True, stream=stream)
+            self.assertEqual(fw.calls['set_acquisition_file_info'], 0)
+            self.assertEqual(fw.calls['modify_session_info'] + fw.calls['replace_session_info'], 0)
+
+            # A single acquisition was renamed
+            fw.acquisitions['ses1-acq0']['label'] = 'task-rest_run-5'
+            fw.calls.clear()
+            curate_bids.curate_bids_dir(fw, 'project', incremental=True, stream=stream)
+            self.assertEqual(fw.calls['modify_session_info'] + fw.calls['replace_session_info'], 1)
+
+            # The result is the same as curating every session
+            expected_fw = FakeFlywheel(make_project(3, 2))
+            curate_bids.curate_bids_dir(expected_fw, 'project')
+            expected_fw.acquisitions['ses1-acq0']['label'] = 'task-rest_run-5'
+            curate_bids.curate_bids_dir(expected_fw, 'project')
+            self.assertEqual(fw.acquisitions, expected_fw.acquisitions)
+            self.assertEqual(self._without_fingerprints(fw.sessions), expected_fw.sessions)
+
+    def test_get_changed_tree(self):
+        """ Templates that resolve across sessions curate every session if any changed """
+        project = project_tree.get_project_tree(FakeFlywheel(make_project(2, 1)), 'project')
+        curate_bids.curate_bids_tree(None, project, update=False, incremental=True)
+        project.children[0].children[0]['label'] = 'changed'
+
+        changed = curate_bids.get_changed_tree(project, BIDS_TEMPLATE)
+        self.assertEqual([child['id'] for child in changed.children], ['ses0'])
+
+        template = copy.copy(BIDS_TEMPLATE)
+        template.resolvers = [{'id': 'project_resolver', 'templates': ['bold_file'], 'resolveFor': 'project',
+                               'type': 'file', 'filter': 'file.info.BIDS.Filter', 'update': 'file.info.Resolved'}]
+        template.compile_resolvers()
+        changed = curate_bids.get_changed_tree(project, template)
+        self.assertEqual([child['id'] for child in changed.children], ['ses0', 'ses1'])
+
+    def test_session_fingerprint(self):
+        """ Fingerprints ignore fields that writing back changes, and depend on the curation code """
+        project = project_tree.get_project_tree(FakeFlywheel(make_project(1, 1)), 'project')
+        session = project.children[0]
+        key = curate_bids.get_template_key(BIDS_TEMPLATE)
+        session['subject'] = {'code': 'sub0', 'modified': 'now'}
+        fingerprint = curate_bids.get_session_fingerprint(project, session, key, 'BIDS')
+        session['subject']['modified'] = 'later'
+        session.children[0].children[0]['info_exists'] = True
+        self.assertEqual(curate_bids.get_session_fingerprint(project, session, key, 'BIDS'), fingerprint)
+        session['subject']['code'] = 'sub1'
+        self.assertNotEqual(curate_bids.get_session_fingerprint(project, session, key, 'BIDS'), fingerprint)
+
+        code_version = curate_bids._curation_code_version
+        try:
+            curate_bids._curation_code_version = 'changed'
+            self.assertNotEqual(curate_bids.get_template_key(BIDS_TEMPLATE), key)
+        finally:
+            curate_bids._curation_code_version = code_version
+
+    def test_is_session_sharded(self):
+        """ Templates with resolvers outside of sessions are not sharded """
+        self.assertTrue(curate_bids.is_session_sharded(BIDS_TEMPLATE))
+
+        template = copy.copy(BIDS_TEMPLATE)
+        template.resolvers = [{'id': 'project_resolver', 'templates': ['bold_file'], 'resolveFor': 'project',
+                               'type': 'file', 'filter': 'file.info.BIDS.Filter', 'update': 'file.info.Resolved'}]
+        template.compile_resolvers()
+        self.assertFalse(curate_bids.is_session_sharded(template))
+
 
 if __name__ == "__main__":
 
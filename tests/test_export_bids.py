@@ -1,15 +1,19 @@
 import csv
 import datetime
+import io
 import json
 import os
 import shutil
+import time
 import unittest
+import zipfile
 import dateutil.parser
 
 import flywheel
 
 from flywheel_bids import export_bids
 from flywheel_bids.supporting_files.errors import BIDSExportError
+from tests.fake_client import FakeFlywheel, make_project
 
 class BidsExportTestCases(unittest.TestCase):
 
@@ -262,6 +266,280 @@ class BidsExportTestCases(unittest.TestCase):
         cid = '123456789009876543211224'
         self.assertTrue(export_bids.determine_container(None, None, ctype, cid) == (ctype, cid))
 
+    def _acquisition_downloads(self, fw):
+        modified = dateutil.parser.parse('2018-01-01T08:00:00Z')
+        filepath_downloads = {'project': {}, 'session': {}, 'acquisition': {}, 'sidecars': {}}
+        for acq_id in sorted(fw.acquisitions):
+            for f in fw.acquisitions[acq_id]['files']:
+                path = os.path.join(self.testdir, '{}_{}'.format(acq_id, f['name']))
+                filepath_downloads['acquisition'][path] = {'args': (acq_id, f['name'], path), 'modified': modified}
+        return filepath_downloads, modified
+
+    def test_download_bids_files_concurrent(self):
+        """ Files are downloaded concurrently, with retries and mtime set """
+        os.mkdir(self.testdir)
+        fw = FakeFlywheel(make_project(2, 3), failures={'download_file_from_acquisition': 2})
+        filepath_downloads, modified = self._acquisition_downloads(fw)
+
+        export_bids.download_bids_files(fw, filepath_downloads, False, workers=4, retries=3)
+
+        self.assertEqual(fw.calls['download_file_from_acquisition'], 14)
+        self.assertEqual(sorted(os.listdir(self.testdir)), sorted(os.path.basename(path)
+            for path in filepath_downloads['acquisition']))
+        for path in filepath_downloads['acquisition']:
+            self.assertEqual(int(os.path.getmtime(path)), export_bids.timestamp_to_int(modified))
+
+    def test_download_bids_files_failure(self):
+        """ Failed downloads leave neither partial nor temporary files behind """
+        os.mkdir(self.testdir)
+        fw = FakeFlywheel(make_project(1, 1, n_files=1), failures={'download_file_from_acquisition': 1},
+                failure_status=403)
+        filepath_downloads, modified = self._acquisition_downloads(fw)
+        # Write a partial file before failing
+        fail = fw.download_file_from_acquisition
+        def partial_download(acquisition_id, file_name, dest_file):
+            with open(dest_file, 'w') as fp:
+                fp.write('partial')
+            return fail(acquisition_id, file_name, dest_file)
+        fw.download_file_from_acquisition = partial_download
+
+        with self.assertRaises(BIDSExportError):
+            export_bids.download_bids_files(fw, filepath_downloads, False, retries=3)
+
+        self.assertEqual(fw.calls['download_file_from_acquisition'], 1)
+        self.assertEqual(os.listdir(self.testdir), [])
+    def test_export_manifest_resume(self):
+        """ Only unfinished downloads and sidecars are continued from the manifest """
+        os.mkdir(self.testdir)
+        fw = FakeFlywheel(make_project(1, 2), failures={'download_file_from_acquisition': 1},
+                failure_status=403)
+        filepath_downloads, modified = self._acquisition_downloads(fw)
+        for path, download in filepath_downloads['acquisition'].items():
+            acq_id, name, _ = download['args']
+            download['size'] = len(name)
+            filepath_downloads['sidecars'][path] = {'args': ({'EchoTime': 1, 'BIDS': {}}, path, 'BIDS'),
+                'source': ('acquisition', acq_id, name, None)}
+            fw._file('acquisition', acq_id, name)['info'] = {'EchoTime': 2, 'BIDS': {}}
+
+        manifest = export_bids.ExportManifest(self.testdir)
+        manifest.write_plan(filepath_downloads, export_bids.get_export_header('project', 'project'))
+        with self.assertRaises(BIDSExportError):
+            export_bids.download_bids_files(fw, filepath_downloads, False, manifest=manifest)
+        # The manifest records where sidecar info comes from, not the info itself
+        with open(manifest.path) as fp:
+            self.assertNotIn('EchoTime', fp.read())
+        self.assertEqual(manifest.load_header(), export_bids.get_export_header('project', 'project'))
+
+        fw.calls.clear()
+        pending = export_bids.ExportManifest(self.testdir).load_pending(fw)
+        self.assertEqual(fw.calls['get_acquisition'], 2)
+        self.assertEqual(len(pending['acquisition']), 1)
+        self.assertEqual(len(pending['sidecars']), 4)
+        path, download = list(pending['acquisition'].items())[0]
+        self.assertEqual(download, filepath_downloads['acquisition'][path])
+        self.assertEqual(pending['sidecars'][path]['args'][0], {'EchoTime': 2, 'BIDS': {}})
+        self.assertFalse(os.path.exists(path))
+
+        fw.calls.clear()
+        export_bids.download_bids_files(fw, pending, False, manifest=manifest)
+        self.assertEqual(fw.calls['download_file_from_acquisition'], 1)
+        self.assertTrue(os.path.isfile(path))
+        with open(path.replace('.nii.gz', '.json')) as fp:
+            self.assertEqual(json.load(fp), {'EchoTime': 2})
+
+        pending = manifest.load_pending(fw)
+        self.assertEqual(pending, {'project': {}, 'session': {}, 'acquisition': {}, 'sidecars': {}})
+
+    def test_export_bids_resume(self):
+        """ Manifests are only resumed by an export of the same container with the same options """
+        os.mkdir(self.testdir)
+        fw = FakeFlywheel(self._curated_project(2, 1), failures={'download_file_from_acquisition': 1},
+                failure_status=403)
+        def export(**kwargs):
+            export_bids.export_bids(fw, self.testdir, None, container_type='project', container_id='project',
+                    validate=False, **kwargs)
+
+        with self.assertRaises(BIDSExportError):
+            export(subjects=['sub0'])
+
+        # A different export plans again
+        fw.calls.clear()
+        export(resume=True)
+        self.assertEqual(fw.calls['get_project_sessions'], 1)
+        self.assertEqual(fw.calls['download_file_from_acquisition'], 3)
+        self.assertEqual(export_bids.ExportManifest(self.testdir).load_header()['subjects'], [])
+
+        # The same export only continues the unfinished downloads
+        shutil.rmtree(os.path.join(self.testdir, 'sub-sub1'))
+        fw.failures['download_file_from_acquisition'] = 1
+        with self.assertRaises(BIDSExportError):
+            export(subjects=['sub1'])
+        fw.calls.clear()
+        export(subjects=['sub1'], resume=True)
+        self.assertEqual(fw.calls['get_project_sessions'], 0)
+        self.assertEqual(fw.calls['download_file_from_acquisition'], 1)
+        self.assertEqual(len(os.listdir(os.path.join(self.testdir, 'sub-sub1', 'func'))), 2)
+
+    def test_is_file_excluded_size_mismatch(self):
+        """ Files with the right mtime but the wrong size are replaced """
+        os.mkdir(self.testdir)
+        path = os.path.join(self.testdir, 'file.nii.gz')
+        with open(path, 'w') as fp:
+            fp.write('partial')
+        modified = dateutil.parser.parse('2018-01-01T08:00:00Z')
+        modified_time = export_bids.timestamp_to_int(modified)
+        os.utime(path, (modified_time, modified_time))
+
+        is_file_excluded = export_bids.is_file_excluded_options('BIDS', True, True)
+        f = {'info': {'BIDS': {'Path': 'anat'}}, 'modified': modified, 'size': 7}
+        self.assertTrue(is_file_excluded(f, path))
+        f['size'] = 1024
+        self.assertFalse(is_file_excluded(f, path))
+
+    def _curated_project(self, n_sessions, n_acquisitions):
+        project = make_project(n_sessions, n_acquisitions)
+        project['info'] = {'BIDS': {'Name': 'bench', 'BIDSVersion': '1.0.2'}}
+        for session in project['sessions']:
+            for acq in session['acquisitions']:
+                for f in acq['files']:
+                    f['info'] = {'BIDS': {'Filename': '{}_{}'.format(acq['id'], f['name']),
+                        'Path': 'sub-{}/func'.format(session['subject']['code']), 'Folder': 'func'}}
+        return project
+
+    def test_download_bids_dir(self):
+        """ Export planning loads the project tree once """
+        os.mkdir(self.testdir)
+        fw = FakeFlywheel(self._curated_project(2, 3))
+        cache_dir = os.path.join(self.testdir, 'cache')
+
+        export_bids.download_bids_dir(fw, 'project', 'project', self.testdir, workers=4,
+                manifest=export_bids.ExportManifest(self.testdir), cache_dir=cache_dir)
+
+        self.assertEqual(fw.calls['get_session'], 2)
+        self.assertEqual(fw.calls['get_acquisition'], 6)
+        self.assertEqual(fw.calls['download_file_from_acquisition'], 12)
+        self.assertEqual(len(os.listdir(os.path.join(self.testdir, 'sub-sub0', 'func'))), 6)
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, 'dataset_description.json')))
+
+        # Nothing changed, so nothing is fetched or downloaded again
+        fw.calls.clear()
+        export_bids.download_bids_dir(fw, 'project', 'project', self.testdir, replace=True,
+                cache_dir=cache_dir)
+        self.assertEqual(fw.calls['get_session'], 0)
+        self.assertEqual(fw.calls['get_acquisition'], 0)
+        self.assertEqual(fw.calls['download_file_from_acquisition'], 0)
+
+    def test_download_bids_dir_listed_files(self):
+        """ Containers whose listing includes their files are not fetched again """
+        os.mkdir(self.testdir)
+        fw = FakeFlywheel(self._curated_project(2, 3), list_files=True)
+        export_bids.download_bids_dir(fw, 'project', 'project', self.testdir)
+
+        self.assertEqual(fw.calls['get_session'], 0)
+        self.assertEqual(fw.calls['get_acquisition'], 0)
+        self.assertEqual(fw.calls['download_file_from_acquisition'], 12)
+
+        fw.calls.clear()
+        export_bids.download_bids_dir(fw, 'ses1', 'session', os.path.join(self.testdir, 'session'))
+        self.assertEqual(fw.calls['get_session'], 1)
+        self.assertEqual(fw.calls['get_acquisition'], 0)
+        self.assertEqual(fw.calls['download_file_from_acquisition'], 6)
+
+    def test_download_bids_dir_session(self):
+        """ A single session is exported """
+        os.mkdir(self.testdir)
+        fw = FakeFlywheel(self._curated_project(2, 2))
+        export_bids.download_bids_dir(fw, 'ses1', 'session', self.testdir, folders=['func'])
+
+        self.assertEqual(fw.calls['get_session'], 1)
+        self.assertEqual(fw.calls['get_project'], 0)
+        self.assertEqual(fw.calls['get_project_sessions'], 0)
+        self.assertEqual(fw.calls['get_acquisition'], 2)
+        self.assertEqual(os.listdir(self.testdir), ['sub-sub1'])
+        self.assertEqual(len(os.listdir(os.path.join(self.testdir, 'sub-sub1', 'func'))), 4)
+
+    def test_download_bids_dir_filtered(self):
+        """ Sessions that are filtered out are not fetched """
+        os.mkdir(self.testdir)
+        fw = FakeFlywheel(self._curated_project(3, 2))
+        cache_dir = os.path.join(self.testdir, 'cache')
+        export_bids.download_bids_dir(fw, 'project', 'project', self.testdir, subjects=['sub1'],
+                cache_dir=cache_dir)
+
+        self.assertEqual(fw.calls['get_session'], 1)
+        self.assertEqual(fw.calls['get_session_acquisitions'], 1)
+        self.assertEqual(fw.calls['get_acquisition'], 2)
+        self.assertEqual(sorted(os.listdir(self.testdir)), ['dataset_description.json', 'sub-sub1'])
+        # Snapshots of part of the project are not saved
+        self.assertFalse(os.path.exists(cache_dir))
+
+        fw.calls.clear()
+        export_bids.download_bids_dir(fw, 'project', 'project', self.testdir, sessions=['ses0', 'ses2'])
+        self.assertEqual(fw.calls['get_session'], 2)
+        self.assertEqual(fw.calls['get_acquisition'], 4)
+
+    def test_extract_zip(self):
+        """ Zip members are extracted with their mtimes, skipping unchanged members """
+        os.mkdir(self.testdir)
+        zip_path = os.path.join(self.testdir, 'code.zip')
+        with zipfile.ZipFile(zip_path, 'w') as zf:
+            zf.writestr(zipfile.ZipInfo('code/', (2018, 1, 1, 8, 0, 0)), '')
+            zf.writestr(zipfile.ZipInfo('code/run.sh', (2018, 1, 1, 8, 0, 0)), 'echo run')
+            zf.writestr(zipfile.ZipInfo('code/lib/util.py', (2018, 2, 1, 8, 0, 0)), 'pass')
+            zf.writestr(zipfile.ZipInfo('../escape.txt', (2018, 1, 1, 8, 0, 0)), 'escape')
+        dest_dir = os.path.join(self.testdir, 'code')
+
+        export_bids.extract_zip(zip_path, dest_dir, chunk_size=2)
+
+        run_path = os.path.join(dest_dir, 'code', 'run.sh')
+        with open(run_path) as fp:
+            self.assertEqual(fp.read(), 'echo run')
+        self.assertEqual(os.path.getmtime(run_path), time.mktime((2018, 1, 1, 8, 0, 0, 0, 0, -1)))
+        self.assertTrue(os.path.isfile(os.path.join(dest_dir, 'code', 'lib', 'util.py')))
+        self.assertFalse(os.path.exists(os.path.join(self.testdir, 'escape.txt')))
+
+        # Unchanged members are not extracted again
+        modified_time = os.path.getmtime(run_path)
+        with open(run_path, 'w') as fp:
+            fp.write('echo new')
+        os.utime(run_path, (modified_time, modified_time))
+        export_bids.extract_zip(zip_path, dest_dir)
+        with open(run_path) as fp:
+            self.assertEqual(fp.read(), 'echo new')
+
+    def test_download_zip_members(self):
+        """ Project zip files are extracted by downloading only their changed members """
+        os.mkdir(self.testdir)
+        content = io.BytesIO()
+        with zipfile.ZipFile(content, 'w') as zf:
+            zf.writestr(zipfile.ZipInfo('code/', (2018, 1, 1, 8, 0, 0)), '')
+            zf.writestr(zipfile.ZipInfo('code/run.sh', (2018, 1, 1, 8, 0, 0)), 'echo run')
+            zf.writestr(zipfile.ZipInfo('code/lib/util.py', (2018, 2, 1, 8, 0, 0)), 'pass')
+            zf.writestr(zipfile.ZipInfo('../escape.txt', (2018, 1, 1, 8, 0, 0)), 'escape')
+        project = make_project(0, 0)
+        project['files'] = [{'name': 'code.zip', 'content': content.getvalue()}]
+        fw = FakeFlywheel(project)
+        path = os.path.join(self.testdir, 'code.zip')
+        modified = dateutil.parser.parse('2018-01-01T08:00:00Z')
+
+        export_bids.download_file(fw, 'project', ('project', 'code.zip', path), modified)
+
+        self.assertEqual(fw.calls['download_file_from_project'], 0)
+        self.assertEqual(fw.calls['download_project_file_zip_member'], 2)
+        self.assertEqual(os.listdir(self.testdir), ['code'])
+        run_path = os.path.join(self.testdir, 'code', 'code', 'run.sh')
+        with open(run_path) as fp:
+            self.assertEqual(fp.read(), 'echo run')
+        self.assertEqual(os.path.getmtime(run_path), time.mktime((2018, 1, 1, 8, 0, 0, 0, 0, -1)))
+        self.assertTrue(os.path.isfile(os.path.join(self.testdir, 'code', 'code', 'lib', 'util.py')))
+
+        # Only changed members are downloaded again
+        os.utime(run_path, (0, 0))
+        fw.calls.clear()
+        export_bids.download_file(fw, 'project', ('project', 'code.zip', path), modified)
+        self.assertEqual(fw.calls['download_project_file_zip_member'], 1)
+        self.assertEqual(os.path.getmtime(run_path), time.mktime((2018, 1, 1, 8, 0, 0, 0, 0, -1)))
+
 
 if __name__ == "__main__":
 
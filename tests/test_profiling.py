@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+import unittest
+
+from flywheel_bids import curate_bids
+from flywheel_bids.supporting_files import profiling
+from tests.fake_client import FakeApiException, FakeFlywheel, make_project
+
+class ProfilingTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Define testdir
+        self.testdir = 'testdir'
+        self.report = os.path.join(self.testdir, 'profile.json')
+        os.makedirs(self.testdir)
+
+    def tearDown(self):
+        # Cleanup 'testdir', if present
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def _load_report(self):
+        with open(self.report) as f:
+            return json.load(f)
+
+    def test_phase_disabled(self):
+        """ Phases are no-ops unless the run is profiled """
+        fw = FakeFlywheel(make_project(1, 1))
+        self.assertIs(profiling.phase('match'), profiling.NULL_PHASE)
+        with profiling.profile(None, fw) as profiled_fw:
+            self.assertIs(profiled_fw, fw)
+            self.assertIs(profiling.phase('match'), profiling.NULL_PHASE)
+        self.assertFalse(os.path.exists(self.report))
+
+    def test_profile_curate(self):
+        """ Phases and API calls of a curation run are reported """
+        fw = FakeFlywheel(make_project(2, 2))
+        with profiling.profile(self.report, fw) as profiled_fw:
+            curate_bids.curate_bids_dir(profiled_fw, 'project')
+        self.assertIs(profiling.phase('match'), profiling.NULL_PHASE)
+
+        report = self._load_report()
+        self.assertEqual(set(report['phases']), set(['tree_load', 'match', 'validate', 'resolve', 'write_back']))
+        self.assertEqual(report['phases']['tree_load']['count'], 1)
+        self.assertEqual(report['api_calls'], sum(fw.calls.values()))
+        for name, count in fw.calls.items():
+            self.assertEqual(report['calls'][name]['count'], count)
+            self.assertEqual(sum(report['calls'][name]['latency_histogram'].values()), count)
+        self.assertGreater(report['calls']['set_acquisition_file_info']['bytes_sent'], 0)
+        if profiling.resource is not None:
+            self.assertGreater(report['peak_rss'], 0)
+
+    def test_profiled_client(self):
+        """ Transferred bytes and failed calls are recorded """
+        fw = FakeFlywheel(make_project(1, 1), failures={'get_project': 1})
+        profiler = profiling.Profiler()
+        profiled_fw = profiler.wrap_client(fw)
+
+        path = os.path.join(self.testdir, 'data.txt')
+        with open(path, 'w') as f:
+            f.write('0123456789')
+        profiled_fw.upload_file_to_project('project', path)
+        dest_file = os.path.join(self.testdir, 'downloaded.txt')
+        profiled_fw.download_file_from_project('project', 'data.txt', dest_file)
+        with self.assertRaises(FakeApiException):
+            profiled_fw.get_project('project')
+        profiled_fw.get_project('project')
+
+        self.assertIs(profiled_fw.api_client, fw.api_client)
+        report = profiler.get_report()
+        self.assertEqual(report['calls']['upload_file_to_project']['bytes_sent'], 10)
+        self.assertEqual(report['bytes_received'], os.path.getsize(dest_file))
+        self.assertEqual(report['calls']['get_project']['count'], 2)
+        self.assertEqual(report['calls']['get_project']['errors'], 1)
+
+
+if __name__ == "__main__":
+
+    unittest.main()
+    run_module_suite()
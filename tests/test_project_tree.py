@@ -0,0 +1,179 @@
+import json
+import os
+import shutil
+import unittest
+
+from benchmarks.bench_context_iter import copying_context_iter
+from tests.fake_client import FakeFlywheel, make_project
+from flywheel_bids.supporting_files import project_tree, utils
+
+class ProjectTreeTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Define testdir
+        self.testdir = 'testdir'
+
+    def tearDown(self):
+        # Cleanup 'testdir', if present
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def test_get_project_tree_sorted_acquisitions(self):
+        """ Acquisitions are ordered by timestamp, not by listing order """
+        fw = FakeFlywheel(make_project(2, 3))
+        tree = project_tree.get_project_tree(fw, 'project')
+
+        self.assertEqual([s['id'] for s in tree.children], ['ses0', 'ses1'])
+        self.assertEqual([a['id'] for a in tree.children[0].children], ['ses0-acq2', 'ses0-acq1', 'ses0-acq0'])
+        self.assertEqual([f.type for f in tree.children[0].children[0].children], ['file', 'file'])
+
+    def test_get_project_tree_concurrent(self):
+        """ Concurrent fetching produces the same tree with the same calls """
+        project = make_project(6, 4)
+        serial_fw = FakeFlywheel(project)
+        serial = project_tree.get_project_tree(serial_fw, 'project')
+
+        concurrent_fw = FakeFlywheel(project)
+        concurrent = project_tree.get_project_tree(concurrent_fw, 'project', workers=4)
+
+        self.assertEqual(json.dumps(serial.to_json(), sort_keys=True),
+                json.dumps(concurrent.to_json(), sort_keys=True))
+        self.assertEqual(serial_fw.calls, concurrent_fw.calls)
+
+    def test_get_project_tree_listed_files(self):
+        """ Listings that include files produce the same tree, without fetching each container """
+        project = make_project(3, 2)
+        for session in project['sessions']:
+            for acquisition in session['acquisitions']:
+                for f in acquisition['files']:
+                    f['info'] = {}
+        expected = project_tree.get_project_tree(FakeFlywheel(project), 'project')
+
+        fw = FakeFlywheel(project, list_files=True)
+        tree = project_tree.get_project_tree(fw, 'project', workers=2)
+        self.assertEqual(json.dumps(tree.to_json(), sort_keys=True), json.dumps(expected.to_json(), sort_keys=True))
+        self.assertEqual(fw.calls['get_session'], 0)
+        self.assertEqual(fw.calls['get_acquisition'], 0)
+
+        sessions = list(project_tree.iter_session_nodes(fw, 'project'))
+        self.assertEqual([json.dumps(s.to_json(), sort_keys=True) for s in sessions],
+                [json.dumps(s.to_json(), sort_keys=True) for s in expected.children])
+        self.assertEqual(fw.calls['get_acquisition'], 0)
+
+    def test_get_project_tree_session_only(self):
+        """ Only the given session is fetched """
+        fw = FakeFlywheel(make_project(3, 2))
+        tree = project_tree.get_project_tree(fw, 'project', session_id='ses1', session_only=True, workers=2)
+
+        self.assertEqual([s['id'] for s in tree.children], ['ses1'])
+        self.assertEqual(fw.calls['get_acquisition'], 2)
+
+    def test_iter_session_nodes(self):
+        """ Streamed sessions are the sessions of the project tree, in order """
+        fw = FakeFlywheel(make_project(5, 3))
+        expected = project_tree.get_project_tree(fw, 'project')
+
+        for window in (0, 1, 3):
+            sessions = list(project_tree.iter_session_nodes(fw, 'project', window=window))
+            self.assertEqual([json.dumps(s.to_json(), sort_keys=True) for s in sessions],
+                    [json.dumps(s.to_json(), sort_keys=True) for s in expected.children])
+
+        sessions = project_tree.iter_session_nodes(fw, 'project', session_id='ses3', window=2)
+        self.assertEqual([s['id'] for s in sessions], ['ses3'])
+
+    def test_tree_json_roundtrip(self):
+        """ from_json restores the tree produced by to_json """
+        tree = project_tree.get_project_tree(FakeFlywheel(make_project(2, 2)), 'project')
+        restored = project_tree.TreeNode.from_json(json.loads(json.dumps(tree.to_json())))
+        self.assertEqual(restored.to_json(), tree.to_json())
+        self.assertFalse(restored.children[0].children[0].children[0].is_dirty())
+
+    def test_get_project_tree_snapshot_refresh(self):
+        """ Only modified sessions and acquisitions are fetched again from the snapshot """
+        fw = FakeFlywheel(make_project(3, 2))
+        project_tree.get_project_tree(fw, 'project', cache_dir=self.testdir)
+        self.assertTrue(os.path.isfile(project_tree.get_snapshot_path(self.testdir, 'project')))
+
+        # Modify a single acquisition
+        fw.set_acquisition_file_info('ses1-acq0', 'file0.nii.gz', {'changed': True})
+        fw.calls.clear()
+        tree = project_tree.get_project_tree(fw, 'project', cache_dir=self.testdir, workers=2)
+
+        self.assertEqual(fw.calls['get_session'], 0)
+        self.assertEqual(fw.calls['get_acquisition'], 1)
+        expected = project_tree.get_project_tree(fw, 'project')
+        self.assertEqual(json.dumps(tree.to_json(), sort_keys=True),
+                json.dumps(expected.to_json(), sort_keys=True))
+        self.assertEqual(tree.children[1].children[1].children[0]['info'], {'changed': True})
+
+    def test_get_project_tree_snapshot_outdated(self):
+        """ Snapshots of another version are ignored """
+        fw = FakeFlywheel(make_project(1, 1))
+        tree = project_tree.get_project_tree(fw, 'project')
+        path = project_tree.get_snapshot_path(self.testdir, 'project')
+        project_tree.save_snapshot(tree, path)
+        self.assertIsNotNone(project_tree.load_snapshot(path, 'project'))
+        self.assertIsNone(project_tree.load_snapshot(path, 'other_project'))
+
+        project_tree.SNAPSHOT_VERSION += 1
+        try:
+            self.assertIsNone(project_tree.load_snapshot(path, 'project'))
+        finally:
+            project_tree.SNAPSHOT_VERSION -= 1
+
+    def test_context_iter(self):
+        """ Layered contexts have the values of the copying traversal """
+        tree = project_tree.get_project_tree(FakeFlywheel(make_project(2, 2)), 'project')
+        # Copy each context as it is yielded, since the copying traversal modifies them later
+        expected = [dict(context) for context in copying_context_iter(tree)]
+        contexts = list(tree.context_iter())
+
+        self.assertEqual(len(contexts), len(expected))
+        for context, expected_context in zip(contexts, expected):
+            self.assertEqual(dict(context), expected_context)
+        self.assertEqual(utils.dict_lookup(contexts[-1], 'session.subject.code'), 'sub1')
+        self.assertEqual(utils.process_string_template('{subject.code}_{ext}', contexts[-1]), 'sub1_.nii.gz')
+
+    def test_context_iter_set_values(self):
+        """ Values set on a context are seen by the contexts of its children only """
+        tree = project_tree.get_project_tree(FakeFlywheel(make_project(2, 1)), 'project')
+        seen = []
+        for context in tree.context_iter():
+            if context['container_type'] == 'session':
+                context['run_counters'] = context['session']['id']
+            elif context['container_type'] == 'file':
+                seen.append(context.get('run_counters'))
+        self.assertEqual(seen, ['ses0', 'ses0', 'ses1', 'ses1'])
+
+    def test_is_dirty(self):
+        """ Nodes are dirty only when the value of info changes """
+        node = project_tree.TreeNode('file', {'name': 'a', 'info': {'BIDS': {'Folder': 'anat', 'IntendedFor': []},
+                                                                   'other': 1}})
+        self.assertFalse(node.is_dirty())
+
+        # Rebuilding an equal value, in another key order, is not a change
+        node['info']['BIDS'] = {'IntendedFor': [], 'Folder': 'anat'}
+        self.assertFalse(node.is_dirty())
+
+        node['info']['BIDS']['IntendedFor'].append('func/x.nii.gz')
+        self.assertTrue(node.is_dirty())
+        node['info']['BIDS']['IntendedFor'].pop()
+        self.assertFalse(node.is_dirty())
+
+        self.assertFalse(project_tree.TreeNode('file', {'name': 'b'}).is_dirty())
+
+    def test_get_info_changes(self):
+        """ Changed and deleted top-level info keys are reported """
+        node = project_tree.TreeNode('session', {'id': 's', 'info': {'BIDS': {'Label': '1'}, 'keep': 1, 'drop': 2}})
+        self.assertEqual(node.get_info_changes(), (set(), set()))
+
+        node['info']['BIDS']['Label'] = '2'
+        node['info']['new'] = True
+        del node['info']['drop']
+        self.assertEqual(node.get_info_changes(), (set(['BIDS', 'new']), set(['drop'])))
+
+
+if __name__ == "__main__":
+
+    unittest.main()
+    run_module_suite()
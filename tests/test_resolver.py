@@ -0,0 +1,135 @@
+import unittest
+
+from flywheel_bids.supporting_files import utils
+from flywheel_bids.supporting_files.project_tree import TreeNode
+from flywheel_bids.supporting_files.resolver import Filter, IndexCache, Resolver
+
+class ResolverTestCases(unittest.TestCase):
+
+    def _make_session(self):
+        session = TreeNode('session', {'id': 'ses', 'label': 'ses-1', 'subject': {'code': 'sub-1'},
+                                       'info': {'BIDS': {'Label': '1'}}})
+        files = [
+            ('anat', 'T1w', 'sub-1_T1w.nii.gz'),
+            ('func', 'bold', 'sub-1_task-a_run-1_bold.nii.gz'),
+            ('func', 'bold', 'sub-1_task-a_run-2_bold.nii.gz'),
+            ('func', 'sbref', 'sub-1_task-a_sbref.nii.gz'),
+            ('dwi', 'dwi', 'sub-1_dwi.nii.gz'),
+            (['func', 'anat'], 'bold', 'sub-1_weird.nii.gz'),
+            ('fmap', 'phasediff', 'sub-1_phasediff.nii.gz'),
+            ('fmap', 'epi', 'sub-1_dir-AP_epi.nii.gz'),
+        ]
+        for i, (folder, modality, filename) in enumerate(files):
+            acq = TreeNode('acquisition', {'id': 'acq{}'.format(i), 'label': modality, 'info': {}})
+            acq.children.append(TreeNode('file', {'name': filename, 'info': {'BIDS': {
+                'Folder': folder, 'Modality': modality, 'Filename': filename, 'IntendedFor': [
+                    {'Folder': 'func', 'Modality': ['bold', 'sbref']}, {'Folder': 'anat'}, {'Folder': 'func'}
+                ] if folder == 'fmap' else []}}}))
+            session.children.append(acq)
+        return session
+
+    def _scan(self, resolver, context):
+        """ The full scan that resolvers did before they used an index """
+        results = []
+        parent = context.get(resolver.resolve_for)
+        filters = []
+        for entry in utils.dict_lookup(context, resolver.filter_field, {}):
+            fields = {'container_type': resolver.container_type}
+            for k, v in entry.items():
+                fields['{}.info.{}.{}'.format(resolver.container_type, resolver.namespace, k)] = v
+            filters.append(Filter(fields))
+        for ctx in parent.context_iter():
+            for filt in filters:
+                if filt.test(ctx):
+                    if resolver.format:
+                        results.append(utils.process_string_template(resolver.format, ctx))
+                    else:
+                        value = utils.dict_lookup(ctx, resolver.value, None)
+                        if value:
+                            results = value
+        return results
+
+    def _fieldmap_contexts(self, session):
+        return [ctx for ctx in session.context_iter() if ctx['container_type'] == 'file'
+                and ctx['file']['info']['BIDS']['Folder'] == 'fmap']
+
+    def test_resolve_indexed(self):
+        """ Indexed resolution matches a full scan, in order and with duplicates """
+        resolver = Resolver('BIDS', {
+            'update': 'file.info.IntendedFor',
+            'filter': 'file.info.BIDS.IntendedFor',
+            'resolveFor': 'session',
+            'type': 'file',
+            'format': '{file.info.BIDS.Folder}/{file.info.BIDS.Filename}'
+        })
+        session = self._make_session()
+        index_cache = IndexCache()
+        for ctx in self._fieldmap_contexts(session):
+            expected = self._scan(resolver, ctx)
+            resolver.resolve(ctx, index_cache)
+            self.assertEqual(ctx['file']['info']['IntendedFor'], expected)
+            resolver.resolve(ctx)
+            self.assertEqual(ctx['file']['info']['IntendedFor'], expected)
+        self.assertEqual(len(index_cache.indexes), 1)
+        self.assertEqual(expected[:2], ['anat/sub-1_T1w.nii.gz', 'func/sub-1_task-a_run-1_bold.nii.gz'])
+
+    def test_resolve_value_last_match(self):
+        """ Value resolvers take the last match """
+        resolver = Resolver('BIDS', {
+            'update': 'file.info.BIDS.Matched',
+            'filter': 'file.info.BIDS.IntendedFor',
+            'resolveFor': 'session',
+            'type': 'file',
+            'value': 'file.name'
+        })
+        session = self._make_session()
+        index_cache = IndexCache()
+        for ctx in self._fieldmap_contexts(session):
+            expected = self._scan(resolver, ctx)
+            resolver.resolve(ctx, index_cache)
+            self.assertEqual(ctx['file']['info']['BIDS']['Matched'], expected)
+        self.assertEqual(expected, 'sub-1_task-a_sbref.nii.gz')
+
+    def test_index_cache_field_updated(self):
+        """ Resolvers that update indexed fields invalidate the index """
+        resolver = Resolver('BIDS', {
+            'update': 'file.info.BIDS.Folder',
+            'filter': 'file.info.BIDS.IntendedFor',
+            'resolveFor': 'session',
+            'type': 'file',
+            'value': 'file.name'
+        })
+        session = self._make_session()
+        index_cache = IndexCache()
+        for ctx in self._fieldmap_contexts(session):
+            expected = self._scan(resolver, ctx)
+            resolver.resolve(ctx, index_cache)
+            self.assertEqual(ctx['file']['info']['BIDS']['Folder'], expected)
+
+    def test_index_cache_scoped(self):
+        """ Only the index of the current session is kept, and updates only invalidate their ancestors' indexes """
+        first, second = self._make_session(), self._make_session()
+        index_cache = IndexCache()
+        first_index = index_cache.get(first)
+        first_index.find([Filter({'container_type': 'file'})])
+        self.assertIs(index_cache.get(first), first_index)
+
+        second_index = index_cache.get(second)
+        self.assertEqual(list(index_cache.indexes), ['session'])
+        self.assertIs(index_cache.indexes['session'][0], second)
+        self.assertIsNot(second_index, first_index)
+
+        second_index.find([Filter({'container_type': 'file'})])
+        acquisition = TreeNode('acquisition', {'id': 'other', 'info': {}})
+        acquisition_index = index_cache.get(acquisition)
+        acquisition_index.find([Filter({'container_type': 'file'})])
+        ctx = self._fieldmap_contexts(second)[0]
+        index_cache.field_updated('container_type', ctx)
+        self.assertEqual(second_index.fields, {})
+        self.assertIn('container_type', acquisition_index.fields)
+
+
+if __name__ == "__main__":
+
+    unittest.main()
+    run_module_suite()
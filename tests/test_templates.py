@@ -1,7 +1,10 @@
+import copy
+import hashlib
 import os
 import json
 import re
 import shutil
+import sys
 import unittest
 
 from flywheel_bids.supporting_files import utils, templates
@@ -122,6 +125,23 @@ class RuleTestCases(unittest.TestCase):
         rule2.initializeProperties(info, context)
         self.assertEqual( info, { 'Property': 'the_upper_12_key_string'})
 
+    def test_template_compiled_formats(self):
+        """ Format parameter lists are compiled once, when the template is loaded """
+        template = templates.Template({
+            'namespace': 'BIDS',
+            'definitions': {'test': {'properties': {'Folder': {'type': 'string',
+                'auto_update': {'$value': 'acquisition.label', '$format': [{'$lower': True}]}}}}},
+            'rules': [{'template': 'test', 'where': {'x': True}, 'initialize': {
+                'Property': {'value': {'$take': True, '$format': [{'$upper': True}]}}}}]
+        })
+        auto_update = template.definitions['test']['properties']['Folder']['auto_update']
+        self.assertIsInstance(auto_update['_format'], utils.ValueFormat)
+
+        info = {}
+        template.rules[0].initializeProperties(info, {'value': 'label'})
+        self.assertEqual(info, {'Property': 'LABEL'})
+        self.assertIsInstance(template.rules[0].initialize['Property']['value']['_format'], utils.ValueFormat)
+
     def test_rule_where_regex_match(self):
         rule = templates.Rule({
             'template': 'test',
@@ -178,3 +198,231 @@ class RuleTestCases(unittest.TestCase):
         context = {'x': 'Something'}
         self.assertTrue(rule.test(context))
 
+
+    def test_where_clause_matches_process_value_match(self):
+        """ Compiled where clauses agree with processValueMatch """
+        matches = ['a', {'$in': ['a', 'b']}, {'$in': 'abc'}, {'$in': [['a']]},
+                   {'$not': 'a'}, {'$not': {'$in': ['a']}}, {'$regex': '^a'}, {'$unknown': 1}]
+        values = [None, 'a', 'ab', 'c', ['a'], ['c', 'b'], [], 1]
+        for match in matches:
+            for value in values:
+                where = templates.WhereClause({'x.y': match})
+                try:
+                    expected = bool(templates.processValueMatch(value, match))
+                except TypeError:
+                    self.assertRaises(TypeError, where.test, {'x': {'y': value}})
+                    continue
+                self.assertEqual(bool(where.test({'x': {'y': value}})), expected, (match, value))
+
+    def test_candidate_rules(self):
+        """ Candidate rules are filtered by container type, preserving order """
+        template = templates.DEFAULT_TEMPLATE
+        for container_type, parent in (('file', 'acquisition'), ('file', 'session'), ('session', 'project')):
+            context = {'container_type': container_type, 'parent_container_type': parent}
+            for upload in (False, True):
+                candidates = template.get_candidate_rules(context, upload)
+                rules = template.rules + template.upload_rules if upload else template.rules
+                self.assertEqual(candidates, [rule for rule in rules
+                    if rule.may_match(container_type, parent)])
+                self.assertTrue(candidates)
+                for rule in rules:
+                    if rule not in candidates:
+                        self.assertFalse(rule.test(context))
+
+    def test_rule_where_or(self):
+        """ """
+        rule = templates.Rule({
+            'template': 'test',
+            'where': {
+                'container_type': 'file',
+                '$or': [
+                    {'file.type': 'nifti', 'x': {'$regex': '^T1'}},
+                    ['file.type', 'dicom']
+                ]
+            }
+        })
+        context = {'container_type': 'file', 'file': {'type': 'nifti'}, 'x': 'T1w'}
+        self.assertTrue(rule.test(context))
+        self.assertTrue(templates.match_conditions(rule.conditions, context))
+        context = {'container_type': 'file', 'file': {'type': 'nifti'}, 'x': 'T2w'}
+        self.assertFalse(rule.test(context))
+        self.assertFalse(templates.match_conditions(rule.conditions, context))
+        context = {'container_type': 'file', 'file': {'type': 'dicom'}}
+        self.assertTrue(rule.test(context))
+        self.assertTrue(templates.match_conditions(rule.conditions, context))
+        context = {'container_type': 'session', 'file': {'type': 'dicom'}}
+        self.assertFalse(rule.test(context))
+        self.assertFalse(templates.match_conditions(rule.conditions, context))
+
+    def test_rule_where_and(self):
+        """ """
+        rule = templates.Rule({
+            'template': 'test',
+            'where': {
+                '$and': [
+                    ['x', {'$regex': 'bold$'}],
+                    {'x': {'$not': {'$in': ['sbref']}}},
+                    {'$or': [{'y': 'a'}, {'y': 'b'}]}
+                ]
+            }
+        })
+        for x, y, expected in (('task_bold', 'a', True), ('task_bold', 'b', True),
+                ('task_bold', 'c', False), ('task_sbref_bold', 'a', False), ('T1w', 'a', False)):
+            context = {'x': x, 'y': y}
+            self.assertEqual(rule.test(context), expected)
+            self.assertEqual(templates.match_conditions(rule.conditions, context), expected)
+
+    def test_where_clause_cost_order(self):
+        """ Cheap equality tests run before regexes """
+        where = templates.WhereClause({
+            'acquisition.label': {'$regex': 'T1'},
+            'file.classification.Measurement': {'$in': ['T1']},
+            'container_type': 'file'
+        })
+        self.assertEqual([m.field for m in where.matchers],
+            ['container_type', 'file.classification.Measurement', 'acquisition.label'])
+        # The regex is never evaluated against the non-string label
+        self.assertFalse(where.test({'container_type': 'session', 'acquisition': {'label': 1}}))
+
+
+class TemplateLoadingTestCases(unittest.TestCase):
+
+    def setUp(self):
+        # Define testdir
+        self.testdir = 'testdir'
+        self.cache_dir = os.path.join(self.testdir, 'cache')
+        os.makedirs(self.testdir)
+
+    def tearDown(self):
+        # Cleanup 'testdir', if present
+        if os.path.exists(self.testdir):
+            shutil.rmtree(self.testdir)
+
+    def _write_template(self, name, data):
+        path = os.path.join(self.testdir, name + '.json')
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        return path
+
+    def _rule_ids(self, template):
+        return [rule.id for rule in template.rules]
+
+    def test_lazy_templates(self):
+        """ Templates are only loaded when they are first used """
+        loaded = []
+        def loader():
+            loaded.append(True)
+            return {'test': templates.Template({'namespace': 'Test', 'rules': []})}
+
+        lazy = templates.LazyTemplates(loader)
+        self.assertEqual(loaded, [])
+        self.assertEqual(list(lazy), ['test'])
+        self.assertEqual(lazy['test'].namespace, 'Test')
+        self.assertEqual(len(lazy), 1)
+        self.assertEqual(loaded, [True])
+
+        self.assertEqual(templates.DEFAULT_TEMPLATE.namespace, 'BIDS')
+        self.assertEqual(templates.BIDS_TEMPLATE.rules, templates.DEFAULT_TEMPLATES['bids-v1'].rules)
+        self.assertIsInstance(templates.BIDS_TEMPLATE, templates.Template)
+        self.assertIsInstance(copy.copy(templates.BIDS_TEMPLATE), templates.Template)
+
+        lazy = templates.LazyTemplate('bids-v1')
+        self.assertEqual(lazy.namespace, 'BIDS')
+        self.assertIs(lazy.definitions, templates.DEFAULT_TEMPLATES['bids-v1'].definitions)
+        with self.assertRaises(AttributeError):
+            lazy.missing
+
+    def test_load_template_cached(self):
+        """ Compiled templates are cached by content, and broken entries are compiled again """
+        path = self._write_template('test', {
+            'namespace': 'Test',
+            'definitions': {'test': {'properties': {'Value': {'type': 'string', 'default': 'x'}}}},
+            'rules': [{'id': 'test_rule', 'template': 'test', 'where': {'container_type': 'file'}}]
+        })
+
+        template = templates.loadTemplate(path, {}, cache_dir=self.cache_dir)
+        cached = os.listdir(self.cache_dir)
+        self.assertEqual(cached, [templates.get_template_cache_key(template.content_hash) + '.pickle'])
+
+        restored = templates.loadTemplate(path, {}, cache_dir=self.cache_dir)
+        self.assertIsNot(restored, template)
+        self.assertEqual(self._rule_ids(restored), ['test_rule'])
+        self.assertTrue(restored.rules[0].test({'container_type': 'file'}))
+        self.assertEqual(os.listdir(self.cache_dir), cached)
+
+        # Unreadable entries are replaced
+        with open(os.path.join(self.cache_dir, cached[0]), 'wb') as f:
+            f.write(b'broken')
+        self.assertEqual(self._rule_ids(templates.loadTemplate(path, {}, cache_dir=self.cache_dir)), ['test_rule'])
+
+        # Changed templates get a new entry
+        self._write_template('test', {'namespace': 'Changed', 'rules': []})
+        self.assertEqual(templates.loadTemplate(path, {}, cache_dir=self.cache_dir).namespace, 'Changed')
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        # Only the most recently used templates are kept
+        templates.prune_template_cache(self.cache_dir, max_entries=1)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+    @unittest.skipUnless(hasattr(os, 'getuid'), 'Ownership is only checked on POSIX')
+    def test_load_template_cache_permissions(self):
+        """ Cache directories and entries that others can write to are not used """
+        path = self._write_template('test', {'namespace': 'Test', 'rules': []})
+        os.makedirs(self.cache_dir)
+        os.chmod(self.cache_dir, 0o777)
+        templates.loadTemplate(path, {}, cache_dir=self.cache_dir)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+        os.chmod(self.cache_dir, 0o700)
+        template = templates.loadTemplate(path, {}, cache_dir=self.cache_dir)
+        entry = os.path.join(self.cache_dir, templates.get_template_cache_key(template.content_hash) + '.pickle')
+        self.assertEqual(os.stat(entry).st_mode & 0o777, 0o600)
+        self.assertIsNotNone(templates.load_cached_template(entry, {}))
+
+        os.chmod(entry, 0o666)
+        self.assertIsNone(templates.load_cached_template(entry, {}))
+
+    def test_load_template_cached_extends(self):
+        """ Cached templates are only used with the template that they extend """
+        parent_path = self._write_template('parent', {'namespace': 'Test', 'rules': [
+            {'id': 'parent_rule', 'template': 'test', 'where': {'container_type': 'file'}}]})
+        child_path = self._write_template('child', {'extends': 'parent', 'rules': [
+            {'id': 'child_rule', 'template': 'test', 'where': {'container_type': 'session'}}]})
+
+        parent = templates.loadTemplate(parent_path, {}, cache_dir=self.cache_dir)
+        child = templates.loadTemplate(child_path, {'parent': parent}, cache_dir=self.cache_dir)
+        self.assertEqual(self._rule_ids(child), ['child_rule', 'parent_rule'])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+        restored = templates.loadTemplate(child_path, {'parent': parent}, cache_dir=self.cache_dir)
+        self.assertEqual(self._rule_ids(restored), ['child_rule', 'parent_rule'])
+
+        # A changed parent template is not in the cache
+        self._write_template('parent', {'namespace': 'Test', 'rules': []})
+        parent = templates.loadTemplate(parent_path, {}, cache_dir=self.cache_dir)
+        restored = templates.loadTemplate(child_path, {'parent': parent}, cache_dir=self.cache_dir)
+        self.assertEqual(self._rule_ids(restored), ['child_rule'])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+        # Nor is a parent template that was not loaded from a file
+        parent = templates.Template({'namespace': 'Test', 'rules': []})
+        restored = templates.loadTemplate(child_path, {'parent': parent}, cache_dir=self.cache_dir)
+        self.assertEqual(self._rule_ids(restored), ['child_rule'])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+
+    def test_template_code_version(self):
+        """ Sources are only read to key the cache, and the package version is used if they can't be """
+        path = self._write_template('test', {'namespace': 'Test', 'rules': []})
+        code_version, utils_file = templates._code_version, templates.utils.__file__
+        try:
+            templates._code_version = None
+            template = templates.loadTemplate(path, {})
+            self.assertIsNone(templates._code_version)
+
+            templates.utils.__file__ = os.path.join(self.testdir, 'missing', 'utils.pyc')
+            key = templates.get_template_cache_key(template.content_hash)
+            self.assertEqual(templates._code_version, hashlib.sha1('{}.{}{}'.format(
+                sys.version_info[0], sys.version_info[1], templates.get_package_version()).encode('utf-8')).hexdigest())
+            self.assertNotEqual(key, templates.get_template_cache_key(hashlib.sha1(b'other').hexdigest()))
+        finally:
+            templates._code_version, templates.utils.__file__ = code_version, utils_file
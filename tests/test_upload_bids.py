@@ -7,6 +7,7 @@ import unittest
 
 import flywheel
 
+from tests.fake_client import FakeFlywheel
 from flywheel_bids import upload_bids
 
 class BidsUploadTestCases(unittest.TestCase):
@@ -986,6 +987,61 @@ class BidsUploadTestCases(unittest.TestCase):
                 contents_expected)
 
 
+    def _create_bids_dir(self, n_subjects):
+        project_dir = os.path.join(self.testdir, 'project')
+        os.makedirs(project_dir)
+        self._create_json(os.path.join(project_dir, 'dataset_description.json'),
+                {'Name': 'project', 'BIDSVersion': '1.0.2'})
+        for i in range(n_subjects):
+            subject = 'sub-{:02d}'.format(i + 1)
+            for folder, fname in (('anat', 'T1w.nii.gz'), ('func', 'task-rest_bold.nii.gz'),
+                                  ('func', 'task-rest_events.tsv'), ('func', 'task-rest_bold.json')):
+                if not os.path.isdir(os.path.join(project_dir, subject, folder)):
+                    os.makedirs(os.path.join(project_dir, subject, folder))
+                with open(os.path.join(project_dir, subject, folder, '{}_{}'.format(subject, fname)), 'w') as fp:
+                    fp.write(fname)
+        return project_dir
+
+    def _upload(self, project_dir, workers):
+        fw = FakeFlywheel({'id': 'existing', 'label': 'existing', 'group': 'group', 'info': {}, 'files': []})
+        bids_hierarchy = upload_bids.parse_bids_dir(project_dir)
+        bids_hierarchy, rootdir = upload_bids.handle_project_label(bids_hierarchy, None, project_dir,
+                                                                  False, None, None)
+        files_of_interest = upload_bids.upload_bids_dir(fw, bids_hierarchy, 'group', rootdir, 'BIDS',
+                                                        True, True, workers=workers)
+        files = {}
+        for acq in fw.acquisitions.values():
+            session = fw.sessions[acq['session']]
+            for f in acq['files']:
+                files[(session['subject']['code'], acq['label'], f['name'])] = f
+        return fw, files, files_of_interest
+
+    def test_upload_bids_dir_concurrent(self):
+        """ Subjects are uploaded concurrently, each file with a single request """
+        project_dir = self._create_bids_dir(4)
+
+        fw, files, files_of_interest = self._upload(project_dir, 1)
+        self.assertEqual(len(files), 12)
+        self.assertEqual(fw.calls['upload_file_to_acquisition'], 12)
+        self.assertEqual(fw.calls['set_acquisition_file_info'], 0)
+        self.assertEqual(fw.calls['get_acquisition'], 8)
+        f = files[('sub-01', 'anat', 'sub-01_T1w.nii.gz')]
+        self.assertEqual(f['type'], 'nifti')
+        self.assertEqual(f['classification'], {'Measurement': ['T1'], 'Intent': ['Structural']})
+        self.assertEqual(f['info']['BIDS']['template'], 'anat_file')
+        self.assertEqual(f['info']['BIDS']['Path'], 'sub-01/anat')
+        f = files[('sub-02', 'func', 'sub-02_task-rest_bold.nii.gz')]
+        self.assertEqual(f['info']['BIDS']['Task'], 'rest')
+        self.assertEqual(sorted(files_of_interest), ['dataset_description.json'] +
+                         ['sub-{:02d}_task-rest_bold.json'.format(i + 1) for i in range(4)])
+
+        concurrent_fw, concurrent_files, concurrent_files_of_interest = self._upload(project_dir, 4)
+        self.assertEqual(concurrent_files, files)
+        # Containers are created in a different order, so ids differ
+        for fname, file_info in files_of_interest.items():
+            self.assertEqual(concurrent_files_of_interest[fname]['full_filename'], file_info['full_filename'])
+        self.assertEqual(concurrent_fw.calls, fw.calls)
+
 
 if __name__ == "__main__":
 
@@ -1,5 +1,6 @@
 import jsonschema
 import os
+import pickle
 import shutil
 import unittest
 
@@ -101,6 +102,30 @@ class UtilsTestCases(unittest.TestCase):
         project_id_expected = u'58175ad3de26e00012c69306'
         self.assertEqual(project_id, project_id_expected)
 
+    def test_format_value(self):
+        """ Each format parameter is applied in order """
+        self.assertEqual(utils.format_value([{'$replace': {'$pattern': 'ab', '$replacement': 'c'}}], 'dabf'), 'dcf')
+        self.assertEqual(utils.format_value([{'$lower': True}], 'ACQ-Rest'), 'acq-rest')
+        self.assertEqual(utils.format_value([{'$lower': {'$pattern': '^[A-Z]'}}], 'ACQ'), 'aCQ')
+        self.assertEqual(utils.format_value([{'$upper': {'$pattern': 'e'}}, {'$upper': False}], 'rest'), 'REST')
+        self.assertEqual(utils.format_value([{'$camelCase': True}], 'task_rest-run'), 'taskRestRun')
+        self.assertEqual(utils.format_value([{'$camelCase': {'$pattern': 'x'}}], 'taskxrest'), 'taskRest')
+        self.assertEqual(utils.format_value([{'$camelCase': {'$pattern': ['.', '+']}}], 'a.b+c'), 'aBC')
+        self.assertEqual(utils.format_value([{'$camelCase': True}], '__'), '')
+        self.assertEqual(utils.format_value([{'$unknown': True}], 'Value'), 'Value')
+
+    def test_value_format_memo(self):
+        """ Compiled formats remember recent values, up to memo_size """
+        value_format = utils.ValueFormat([{'$replace': {'$pattern': '[^a-z]', '$replacement': ''}}, {'$upper': True}],
+                memo_size=2)
+        for value in ['a1', 'b2', 'a1', 'c3', 'a1']:
+            self.assertEqual(value_format(value), utils.format_value(value_format.params, value))
+        self.assertEqual(list(value_format._memo.keys()), [(str, 'c3'), (str, 'a1')])
+
+        # Compiled formats can be sent to worker processes
+        restored = pickle.loads(pickle.dumps(value_format))
+        self.assertEqual(restored('d4'), 'D')
+
 
 if __name__ == "__main__":
 